@@ -1,10 +1,23 @@
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
 import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Union, BinaryIO, List, Tuple, Literal
-from math import sin, cos, radians, fabs
+from typing import Union, BinaryIO, List, Tuple, Literal, Optional
+from math import sin, cos, radians, fabs, ceil
 
 import cv2
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger(__name__)
 
 
 def load_image(image_data):
@@ -96,6 +109,108 @@ def should_merge(rect1: Tuple[int, int, int, int], rect2: Tuple[int, int, int, i
     return intersection_area > overlap_threshold * min_area
 
 
+def rect_distance(r1, r2):
+    """计算两个矩形边缘之间的最小欧几里得距离，重叠或相接时为0"""
+    # 矩形1的坐标
+    x1, y1, w1, h1 = r1
+    x1_end, y1_end = x1 + w1, y1 + h1
+
+    # 矩形2的坐标
+    x2, y2, w2, h2 = r2
+    x2_end, y2_end = x2 + w2, y2 + h2
+
+    # 计算水平距离
+    if x1_end < x2:
+        dx = x2 - x1_end
+    elif x2_end < x1:
+        dx = x1 - x2_end
+    else:
+        dx = 0
+
+    # 计算垂直距离
+    if y1_end < y2:
+        dy = y2 - y1_end
+    elif y2_end < y1:
+        dy = y1 - y2_end
+    else:
+        dy = 0
+
+    # 返回欧几里得距离
+    return (dx ** 2 + dy ** 2) ** 0.5
+
+
+# 矩形数量不超过此值时直接逐对合并
+PAIRWISE_MERGE_LIMIT = 16
+
+
+def cluster_rectangles(rectangles, predicate, reach=0):
+    """
+    按谓词合并矩形，直到任意两个矩形都不满足谓词为止
+
+    每一轮用均匀网格索引找出满足谓词的矩形对，用并查集合并成连通分量，再用分量的
+    外接矩形进入下一轮。谓词需要满足"矩形变大后只会更容易满足"，此时结果与逐对反复合并的
+    结果唯一且相同；输出顺序按每个分量中最小的原始索引排列，也与逐对合并一致。
+
+    参数:
+        rectangles: 矩形列表，每个矩形表示为(x, y, w, h)
+        predicate: 判断两个矩形是否需要合并的函数
+        reach: 谓词可能成立的最大边缘间隔，间隔更大的矩形不会被比较
+
+    返回:
+        合并后的矩形列表
+    """
+    rects = list(rectangles)
+
+    while len(rects) > 1:
+        parent = list(range(len(rects)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # 均匀网格索引：每个矩形登记到它覆盖的网格中，只与扩展 reach 后覆盖的网格中已登记的矩形比较
+        cell = max(1, int(sum(max(w, h) for _, _, w, h in rects) / len(rects)) + int(reach))
+        grid = defaultdict(list)
+        merged_any = False
+        for i, (x, y, w, h) in enumerate(rects):
+            neighbours = set()
+            for cx in range(int(x - reach) // cell, int(x + w + reach) // cell + 1):
+                for cy in range(int(y - reach) // cell, int(y + h + reach) // cell + 1):
+                    neighbours.update(grid.get((cx, cy), ()))
+
+            for j in neighbours:
+                if predicate(rects[j], rects[i]):
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        # 以较小的索引为根，保证根就是分量中最小的索引
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+                        merged_any = True
+
+            for cx in range(x // cell, (x + w) // cell + 1):
+                for cy in range(y // cell, (y + h) // cell + 1):
+                    grid[(cx, cy)].append(i)
+
+        if not merged_any:
+            break
+
+        # 计算每个分量的外接矩形
+        bounds = {}
+        for i, (x, y, w, h) in enumerate(rects):
+            root = find(i)
+            if root in bounds:
+                x_min, y_min, x_max, y_max = bounds[root]
+                bounds[root] = (min(x_min, x), min(y_min, y), max(x_max, x + w), max(y_max, y + h))
+            else:
+                bounds[root] = (x, y, x + w, y + h)
+
+        rects = [(x_min, y_min, x_max - x_min, y_max - y_min)
+                 for _, (x_min, y_min, x_max, y_max) in sorted(bounds.items())]
+
+    return rects
+
+
 def merge_rectangles(rectangles: List[Tuple[int, int, int, int]],
                      overlap_threshold: float = 0.0) -> List[Tuple[int, int, int, int]]:
     """合并重叠的矩形
@@ -110,6 +225,20 @@ def merge_rectangles(rectangles: List[Tuple[int, int, int, int]],
     if not rectangles:
         return []
 
+    # 阈值大于0时合并后矩形可能不再满足阈值，合并结果依赖顺序，只能逐对合并；
+    # 矩形很少时逐对合并的常数开销更小，两者结果相同
+    if overlap_threshold != 0 or len(rectangles) <= PAIRWISE_MERGE_LIMIT:
+        return merge_rectangles_pairwise(rectangles, overlap_threshold)
+
+    return cluster_rectangles(rectangles, should_merge)
+
+
+def merge_rectangles_pairwise(rectangles: List[Tuple[int, int, int, int]],
+                              overlap_threshold: float = 0.0) -> List[Tuple[int, int, int, int]]:
+    """逐对反复合并重叠的矩形，参数同 merge_rectangles"""
+    if not rectangles:
+        return []
+
     # 创建一个副本以避免修改原始列表
     rects = [rect for rect in rectangles]
     changed = True
@@ -161,36 +290,14 @@ def merge_close_rectangles(rectangles, max_distance):
     返回:
         合并后的矩形列表
     """
+    if len(rectangles) <= PAIRWISE_MERGE_LIMIT:
+        return merge_close_rectangles_pairwise(rectangles, max_distance)
 
-    # 我们需要一个辅助函数来计算两个矩形之间的最小距离
-    def rect_distance(r1, r2):
-        # 矩形1的坐标
-        x1, y1, w1, h1 = r1
-        x1_end, y1_end = x1 + w1, y1 + h1
-
-        # 矩形2的坐标
-        x2, y2, w2, h2 = r2
-        x2_end, y2_end = x2 + w2, y2 + h2
-
-        # 计算水平距离
-        if x1_end < x2:
-            dx = x2 - x1_end
-        elif x2_end < x1:
-            dx = x1 - x2_end
-        else:
-            dx = 0
-
-        # 计算垂直距离
-        if y1_end < y2:
-            dy = y2 - y1_end
-        elif y2_end < y1:
-            dy = y1 - y2_end
-        else:
-            dy = 0
+    return cluster_rectangles(rectangles, lambda r1, r2: rect_distance(r1, r2) <= max_distance, max_distance)
 
-        # 返回欧几里得距离
-        return (dx ** 2 + dy ** 2) ** 0.5
 
+def merge_close_rectangles_pairwise(rectangles, max_distance):
+    """逐对反复合并边缘距离相近的矩形，参数同 merge_close_rectangles"""
     changed = True
     while changed and len(rectangles) > 1:
         changed = False
@@ -229,12 +336,51 @@ def merge_close_rectangles(rectangles, max_distance):
     return rectangles
 
 
+# extract_black_regions 默认使用的区域提取后端，可通过环境变量 ICR_REGION_BACKEND 设置
+REGION_BACKEND = os.getenv("ICR_REGION_BACKEND", "contours")
+
+
+def component_boxes(binary_image) -> np.ndarray:
+    """
+    使用 connectedComponentsWithStats 一次性得到所有外部区域的外接矩形
+
+    先填充孔洞，使孔洞中的孤岛并入外层区域（RETR_EXTERNAL 同样不会返回它们），再按每个区域在
+    光栅扫描中第一个像素的位置倒序排列，与 findContours 返回轮廓的顺序一致。
+
+    参数:
+        binary_image: 二值图像
+
+    返回:
+        N×4 数组，每行为 (x, y, w, h)
+    """
+    # 四周补一圈背景后从角落泛洪，背景中未被填到的部分就是孔洞
+    filled = cv2.copyMakeBorder((binary_image > 0).astype(np.uint8) * 255, 1, 1, 1, 1,
+                                cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(filled, None, (0, 0), 128, flags=4)
+    filled = (filled[1:-1, 1:-1] != 128).astype(np.uint8)
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(filled, connectivity=8)
+    if count <= 1:
+        return np.empty((0, 4), dtype=np.int64)
+
+    # 每个区域第一个像素的光栅位置
+    flat = labels.ravel()
+    positions = np.flatnonzero(flat)
+    first = np.full(count, flat.size, dtype=np.int64)
+    np.minimum.at(first, flat[positions], positions)
+
+    order = np.argsort(first[1:])[::-1] + 1
+    return stats[order, :4].astype(np.int64)
+
+
 def extract_black_regions(
         binary_image,
         min_area: int = 100,
         merged: bool = True,
         merge_distance: int = 0,
-        sort_mode: Literal["area-desc", "area-asc", "position-tl", "position-l"] = "area-desc"
+        sort_mode: Literal["area-desc", "area-asc", "position-tl", "position-l"] = "area-desc",
+        backend: Optional[Literal["contours", "components"]] = None,
+        counts: Optional[dict] = None
 ) -> List[Tuple[int, int, int, int]]:
     """
     提取二值图像中的黑色区域(矩形)
@@ -249,19 +395,33 @@ def extract_black_regions(
             "area-asc": 按面积从小到大
             "position-tl": 按位置从上到下、从左到右
             "position-l": 按位置从左到右
+        backend: 区域提取后端，两者返回的矩形列表完全相同，None表示使用 REGION_BACKEND
+            "contours": findContours 后逐个计算外接矩形，区域较少时更快
+            "components": connectedComponentsWithStats 一次得到全部外接矩形，区域很多（噪声背景）时更快
+        counts: 如果提供字典，将轮廓数量累加到 "contours"，合并后的区域数量累加到 "merged_regions"
 
     返回:
         矩形列表，每个矩形表示为(x, y, w, h)
     """
-    # 寻找轮廓 - 现在寻找白色区域（即原始图像中的黑色区域）
-    contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # 获取每个轮廓的边界矩形并过滤掉太小的区域
-    rectangles = []
-    for cnt in contours:
-        x, y, w, h = cv2.boundingRect(cnt)
-        if w * h >= min_area:  # 忽略面积太小的区域
-            rectangles.append((x, y, w, h))
+    if (backend or REGION_BACKEND) == "components":
+        boxes = component_boxes(binary_image)
+        if counts is not None:
+            counts['contours'] = counts.get('contours', 0) + len(boxes)
+        # 忽略面积太小的区域
+        boxes = boxes[boxes[:, 2] * boxes[:, 3] >= min_area]
+        rectangles = [tuple(box) for box in boxes.tolist()]
+    else:
+        # 寻找轮廓 - 现在寻找白色区域（即原始图像中的黑色区域）
+        contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if counts is not None:
+            counts['contours'] = counts.get('contours', 0) + len(contours)
+
+        # 获取每个轮廓的边界矩形并过滤掉太小的区域
+        rectangles = []
+        for cnt in contours:
+            x, y, w, h = cv2.boundingRect(cnt)
+            if w * h >= min_area:  # 忽略面积太小的区域
+                rectangles.append((x, y, w, h))
 
     if merged:
         # 合并重叠的矩形
@@ -272,6 +432,9 @@ def extract_black_regions(
         # 计算矩形间的距离并合并
         rectangles = merge_close_rectangles(rectangles, merge_distance)
 
+    if counts is not None:
+        counts['merged_regions'] = counts.get('merged_regions', 0) + len(rectangles)
+
     # 根据排序模式进行排序
     if sort_mode == "area-desc":
         rectangles.sort(key=lambda rect: rect[2] * rect[3], reverse=True)
@@ -351,43 +514,684 @@ def opencv_rotate(image, angle, scale=1.0):
     return rotated_image
 
 
-def analyze_rotated_regions(sprite_mask, sprite_black_regions):
-    """分析每个sprite黑色区域在不同旋转角度下的轮廓"""
-    rotation_data = []
+class RotationEngine:
+    """
+    按 (图像尺寸, 角度, 缩放) 缓存旋转映射表的旋转引擎
 
-    for region_idx, (x, y, w, h) in enumerate(sprite_black_regions):
-        # 提取当前区域的ROI
-        region_roi = sprite_mask[y:y + h, x:x + w]
+    与 opencv_rotate 使用相同的画布大小和旋转矩阵，并按 warpAffine 内部的定点算法
+    预先生成 cv2.remap 的映射表，因此输出与 opencv_rotate 逐像素相同。sprite区域只有少数几种尺寸，
+    映射表命中后旋转只剩一次 remap。生成映射表比一次 warpAffine 慢数倍，因此某个 (尺寸, 角度)
+    第一次出现时只记录下来并直接调用 opencv_rotate，再次出现时才生成并缓存映射表。
+    映射表按LRU淘汰，条目数超过 max_entries 或总字节数超过 max_bytes 时淘汰最久未用的条目。
+    每个条目约占 6 字节 × 画布像素数：实际验证码的sprite区域约 10KB/条，30×30 到 80×80 的区域
+    为 8~61KB/条，因此只按条目数限制时内存会随区域尺寸相差数倍。
 
-        # 存储当前区域的所有旋转信息
-        region_data = {
-            'original_region': (x, y, w, h),
-            'rotations': []
+    参数:
+        max_entries: 最多缓存的映射表数量
+        max_bytes: 映射表的最大总字节数
+    """
+
+    # warpAffine 内部使用的定点精度
+    AB_BITS = 10
+    INTER_BITS = 5
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._maps = OrderedDict()
+        self._bytes = 0
+        # 只出现过一次的键
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @classmethod
+    def build_maps(cls, shape, angle, scale=1.0):
+        """
+        生成旋转映射表
+
+        返回:
+            (map1, map2, (画布宽, 画布高))，map1 为整数坐标(CV_16SC2)，map2 为插值表索引(CV_16UC1)
+        """
+        height, width = shape[:2]
+
+        # 与 opencv_rotate 相同的旋转矩阵和画布大小
+        rotation_matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+        new_height = int(width * fabs(sin(radians(angle))) + height * fabs(cos(radians(angle))))
+        new_width = int(height * fabs(sin(radians(angle))) + width * fabs(cos(radians(angle))))
+        rotation_matrix[0, 2] += (new_width - width) / 2
+        rotation_matrix[1, 2] += (new_height - height) / 2
+
+        # 与 warpAffine 相同的方式求逆矩阵
+        m = rotation_matrix.ravel().tolist()
+        det = m[0] * m[4] - m[1] * m[3]
+        det = 1.0 / det if det != 0 else 0.0
+        a11, a22 = m[4] * det, m[0] * det
+        m[0], m[1], m[3], m[4] = a11, -m[1] * det, -m[3] * det, a22
+        m[2], m[5] = -m[0] * m[2] - m[1] * m[5], -m[3] * m[2] - m[4] * m[5]
+
+        # 定点坐标：每列的增量与每行的起点分别取整，再相加后截去多余的小数位
+        ab_scale = 1 << cls.AB_BITS
+        round_delta = ab_scale >> (cls.INTER_BITS + 1)
+        xs = np.arange(new_width, dtype=np.float64)
+        ys = np.arange(new_height, dtype=np.float64)
+        x_delta = np.rint(m[0] * xs * ab_scale).astype(np.int64)
+        y_delta = np.rint(m[3] * xs * ab_scale).astype(np.int64)
+        x_start = np.rint((m[1] * ys + m[2]) * ab_scale).astype(np.int64) + round_delta
+        y_start = np.rint((m[4] * ys + m[5]) * ab_scale).astype(np.int64) + round_delta
+        shift = cls.AB_BITS - cls.INTER_BITS
+        x = (x_start[:, None] + x_delta[None, :]) >> shift
+        y = (y_start[:, None] + y_delta[None, :]) >> shift
+
+        inter_mask = (1 << cls.INTER_BITS) - 1
+        map1 = np.stack([np.clip(x >> cls.INTER_BITS, -32768, 32767),
+                         np.clip(y >> cls.INTER_BITS, -32768, 32767)], axis=-1).astype(np.int16)
+        map2 = ((y & inter_mask) << cls.INTER_BITS | (x & inter_mask)).astype(np.uint16)
+        return map1, map2, (new_width, new_height)
+
+    def maps_for(self, shape, angle, scale=1.0, admit_first=True):
+        """
+        查询（必要时生成并缓存）映射表
+
+        参数:
+            admit_first: 为False时键第一次出现只做记录并返回None
+        """
+        key = (tuple(shape[:2]), angle, scale)
+        with self._lock:
+            entry = self._maps.get(key)
+            if entry is not None:
+                self._maps.move_to_end(key)
+                self.hits += 1
+                return entry
+            if not admit_first and key not in self._seen:
+                self._seen[key] = True
+                while len(self._seen) > self.max_entries:
+                    self._seen.popitem(last=False)
+                self.bypassed += 1
+                return None
+            self._seen.pop(key, None)
+
+        entry = self.build_maps(shape, angle, scale)
+        size = entry[0].nbytes + entry[1].nbytes
+        with self._lock:
+            self.misses += 1
+            if size > self.max_bytes:
+                return entry
+            previous = self._maps.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[0].nbytes + previous[1].nbytes
+            self._maps[key] = entry
+            self._bytes += size
+            while len(self._maps) > self.max_entries or self._bytes > self.max_bytes:
+                map1, map2, _ = self._maps.popitem(last=False)[1]
+                self._bytes -= map1.nbytes + map2.nbytes
+        return entry
+
+    def rotate(self, image, angle, scale=1.0):
+        """与 opencv_rotate(image, angle, scale) 结果相同的旋转"""
+        entry = self.maps_for(image.shape, angle, scale, admit_first=False)
+        if entry is None:
+            return opencv_rotate(image, angle, scale)
+        map1, map2, _ = entry
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'entries': len(self._maps),
+                'bytes': self._bytes
+            }
+
+    def clear(self):
+        with self._lock:
+            self._maps.clear()
+            self._seen.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.bypassed = 0
+
+
+# 默认的全局旋转引擎，可通过环境变量 ICR_REMAP_CACHE_SIZE 设置缓存的映射表数量、ICR_REMAP_CACHE_MB
+# 设置映射表的总内存(MB)，任一为0表示直接使用 opencv_rotate。多进程求解时每个进程各有一份
+_remap_cache_size = int(os.getenv("ICR_REMAP_CACHE_SIZE", "512"))
+_remap_cache_mb = float(os.getenv("ICR_REMAP_CACHE_MB", "8"))
+rotation_engine = (RotationEngine(_remap_cache_size, int(_remap_cache_mb * 1024 * 1024))
+                   if _remap_cache_size > 0 and _remap_cache_mb > 0 else None)
+
+
+class RotationSet:
+    """
+    单个sprite区域在全部角度下的旋转结果
+
+    每个角度只保存紧密裁剪后的图像，依次存放在同一块连续缓冲区中，角度、裁剪尺寸和宽高比
+    保存在并行的数组里，按索引访问。packed=True 时缓冲区按位压缩（以127为阈值二值化，
+    旋转插值产生的灰度边缘会丢失，相似度会有细微差别），内存约为原来的1/8。
+
+    裁剪后完全相同的图像(以及对称图形在一个对称周期之外的角度)只保存一次，对应的全部角度
+    记录在 alias_angles / alias_index 中，每个条目的 angles 为其中最先出现的角度。
+
+    参数:
+        angles: 各条目的角度，int16 数组
+        sizes: 各条目裁剪后的 (宽, 高)，形状为 (N, 2) 的 int32 数组
+        aspect_ratios: 各条目的宽高比
+        bank: 存放全部裁剪图像的一维 uint8 缓冲区
+        packed: bank 是否按位压缩
+        alias_angles: 覆盖的全部角度，为None时与 angles 相同
+        alias_index: alias_angles 中每个角度对应的条目索引
+    """
+
+    __slots__ = ('angles', 'sizes', 'aspect_ratios', 'bank', 'packed', 'offsets', 'alias_angles', 'alias_index')
+
+    def __init__(self, angles, sizes, aspect_ratios, bank, packed=False, alias_angles=None, alias_index=None):
+        self.angles = np.asarray(angles, dtype=np.int16)
+        self.sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)
+        self.aspect_ratios = np.asarray(aspect_ratios, dtype=np.float64)
+        self.bank = bank
+        self.packed = packed
+        if alias_angles is None:
+            self.alias_angles = self.angles
+            self.alias_index = np.arange(len(self.angles), dtype=np.int32)
+        else:
+            self.alias_angles = np.asarray(alias_angles, dtype=np.int16)
+            self.alias_index = np.asarray(alias_index, dtype=np.int32)
+
+        # 每行按位压缩时补齐到整字节
+        widths = (self.sizes[:, 0] + 7) // 8 if packed else self.sizes[:, 0]
+        self.offsets = np.zeros(len(self.angles) + 1, dtype=np.int64)
+        np.cumsum(widths.astype(np.int64) * self.sizes[:, 1], out=self.offsets[1:])
+
+    @classmethod
+    def from_images(cls, angles, images, aspect_ratios, packed=False, aliases=None):
+        """
+        由各角度裁剪后的图像构建，存储内容完全相同的图像合并为一个条目
+
+        参数:
+            aliases: 不单独计算、与某个角度等价的 {角度: 等价角度} 映射(对称剪枝)
+        """
+        sizes = []
+        chunks = []
+        unique_angles = []
+        unique_ratios = []
+        index_of = {}
+        angle_index = {}
+        for angle, image, aspect_ratio in zip(angles, images, aspect_ratios):
+            if packed:
+                chunk = np.packbits(image > 127, axis=1).ravel()
+            else:
+                chunk = np.ascontiguousarray(image, dtype=np.uint8).ravel()
+            key = (image.shape, chunk.tobytes())
+            if key not in index_of:
+                index_of[key] = len(chunks)
+                sizes.append((image.shape[1], image.shape[0]))
+                chunks.append(chunk)
+                unique_angles.append(angle)
+                unique_ratios.append(aspect_ratio)
+            angle_index[int(angle)] = index_of[key]
+        for angle, equivalent in (aliases or {}).items():
+            if equivalent in angle_index:
+                angle_index[int(angle)] = angle_index[equivalent]
+
+        bank = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint8)
+        bank.flags.writeable = False
+        alias_angles = sorted(angle_index)
+        return cls(unique_angles, sizes, unique_ratios, bank, packed, alias_angles,
+                   [angle_index[angle] for angle in alias_angles])
+
+    def __len__(self):
+        return len(self.angles)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.bank.nbytes + self.angles.nbytes + self.sizes.nbytes + self.aspect_ratios.nbytes
+                + self.alias_index.nbytes + (self.alias_angles.nbytes if self.alias_angles is not self.angles else 0))
+
+    @property
+    def dedup_ratio(self) -> float:
+        """合并或剪枝掉的角度比例"""
+        return 1 - len(self) / len(self.alias_angles) if len(self.alias_angles) else 0.0
+
+    def equivalent_angles(self, index: int) -> List[int]:
+        """第 index 个条目代表的全部角度"""
+        return self.alias_angles[self.alias_index == index].tolist()
+
+    def image(self, index: int) -> np.ndarray:
+        """第 index 个角度裁剪后的图像（未压缩时为缓冲区的只读视图）"""
+        w, h = self.sizes[index]
+        chunk = self.bank[self.offsets[index]:self.offsets[index + 1]]
+        if not self.packed:
+            return chunk.reshape(h, w)
+        bits = np.unpackbits(chunk.reshape(h, (w + 7) // 8), axis=1, count=w)
+        return bits * np.uint8(255)
+
+    def index_of(self, angle: int) -> Optional[int]:
+        """角度对应的条目索引，角度不在覆盖范围内时返回None"""
+        position = np.flatnonzero(self.alias_angles == angle)
+        return int(self.alias_index[position[0]]) if len(position) else None
+
+
+class RotationCache:
+    """
+    sprite区域旋转结果缓存
+
+    以预处理后sprite区域ROI的内容哈希为键，缓存该区域在全部角度下的旋转结果。
+    内存中使用LRU淘汰；指定 disk_dir 后同时写入磁盘，磁盘总大小超过 disk_max_bytes 时
+    按最近访问时间淘汰最旧的条目。验证码图标来自一个较小的固定集合，重复出现的图标可以
+    直接跳过整个旋转分析阶段。
+
+    参数:
+        max_entries: 内存中最多保留的区域数量
+        disk_dir: 磁盘缓存目录，为None时不使用磁盘缓存
+        disk_max_bytes: 磁盘缓存的最大总字节数
+    """
+
+    # 旋转分析的参数、算法或存储格式变化时需要修改此版本号，使旧缓存失效
+    VERSION = 3
+
+    def __init__(self, max_entries: int = 128, disk_dir: Optional[Union[str, Path]] = None,
+                 disk_max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def key_for(cls, region_roi: np.ndarray, packed: bool = False, max_angle: int = 45,
+                symmetry_iou: float = 0.0) -> str:
+        """计算区域ROI的内容哈希，压缩与未压缩、不同角度范围和对称剪枝设置的结果分别缓存"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"v{cls.VERSION}:{int(packed)}:{region_roi.shape}:{region_roi.dtype}".encode())
+        # 默认参数不写入键
+        if max_angle != 45:
+            digest.update(f":{max_angle}".encode())
+        if symmetry_iou:
+            digest.update(f":sym{symmetry_iou}".encode())
+        digest.update(np.ascontiguousarray(region_roi).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """查询缓存，未命中返回None"""
+        entry = self.lookup(key)
+        return entry[0] if entry is not None else None
+
+    def lookup(self, key: str):
+        """查询缓存，命中时返回 (旋转结果, 当初计算所用的秒数)，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[1]
+                return entry
+
+        entry = self._load_from_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.saved_seconds += entry[1]
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, rotations: RotationSet, elapsed: float):
+        """
+        写入缓存
+
+        参数:
+            key: 区域ROI的内容哈希
+            rotations: compute_rotations 生成的旋转结果
+            elapsed: 计算这些旋转结果所花费的时间(秒)，命中时计入 saved_seconds
+        """
+        with self._lock:
+            self._remember(key, (rotations, elapsed))
+        self._save_to_disk(key, rotations, elapsed)
+
+    def stats(self) -> dict:
+        """返回命中/未命中计数以及累计节省的时间"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'saved_seconds': self.saved_seconds,
+                'entries': len(self._entries)
+            }
+
+    def clear(self):
+        """清空内存缓存和计数（不删除磁盘文件）"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+            self.saved_seconds = 0.0
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_from_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self.disk_dir / f"{key}.npz"
+        try:
+            with np.load(path) as data:
+                bank = data['bank']
+                bank.flags.writeable = False
+                rotations = RotationSet(data['angles'], data['sizes'], data['aspect_ratios'], bank,
+                                        bool(data['packed']), data['alias_angles'], data['alias_index'])
+                elapsed = float(data['elapsed'])
+            # 更新访问时间，供淘汰时参考
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return rotations, elapsed
+
+    def _save_to_disk(self, key, rotations, elapsed):
+        if self.disk_dir is None:
+            return
+        path = self.disk_dir / f"{key}.npz"
+        tmp_path = self.disk_dir / f"{key}.{threading.get_ident()}.tmp"
+        arrays = {
+            'angles': rotations.angles,
+            'sizes': rotations.sizes,
+            'aspect_ratios': rotations.aspect_ratios,
+            'bank': rotations.bank,
+            'packed': np.bool_(rotations.packed),
+            'alias_angles': rotations.alias_angles,
+            'alias_index': rotations.alias_index,
+            'elapsed': np.float64(elapsed)
         }
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for path in self.disk_dir.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        # 按访问时间从旧到新删除，直到总大小不超过上限
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+
+
+# 默认的全局旋转缓存，可通过环境变量配置:
+#   ICR_CACHE_SIZE: 内存缓存条目数，0表示禁用缓存
+#   ICR_CACHE_DIR: 磁盘缓存目录，不设置则只使用内存缓存
+#   ICR_CACHE_DISK_MB: 磁盘缓存大小上限(MB)
+_default_cache_size = int(os.getenv("ICR_CACHE_SIZE", "128"))
+rotation_cache = RotationCache(
+    _default_cache_size,
+    os.getenv("ICR_CACHE_DIR") or None,
+    int(os.getenv("ICR_CACHE_DISK_MB", "64")) * 1024 * 1024
+) if _default_cache_size > 0 else None
+
+
+class AngleHistogram:
+    """
+    历史上匹配成功的旋转角度直方图
+
+    用于决定提前退出模式下各角度的评估顺序：出现次数越多的角度越先评估，次数相同时
+    绝对值越小的角度越先评估（没有历史数据时即为 0, -1, 1, -2, 2, ...）。
 
-        # 从-45度到45度，步长1度
-        for angle in range(-45, 46):
-            # 旋转图像
+    参数:
+        path: JSON 文件路径，指定后从文件加载，并在每次 record 后写回；为None时只保存在内存中
+        angles: 参与统计的角度范围
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, angles=range(-45, 46)):
+        self.path = Path(path) if path else None
+        self.counts = {angle: 0 for angle in angles}
+        self._lock = threading.Lock()
+        self._order = None
+
+        if self.path is not None and self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding='utf-8'))
+                for angle, count in data.get('counts', {}).items():
+                    if int(angle) in self.counts:
+                        self.counts[int(angle)] = int(count)
+            except (OSError, ValueError, AttributeError):
+                logger.warning(f"角度直方图文件无法读取，将重新统计: {self.path}")
+
+    def record(self, angles):
+        """记录一次成功识别中各sprite的匹配角度"""
+        # 先取出全部角度，迭代出错时不会只记录一部分
+        angles = list(angles)
+        with self._lock:
+            for angle in angles:
+                if angle in self.counts:
+                    self.counts[angle] += 1
+            self._order = None
+            if self.path is not None:
+                data = json.dumps({'counts': {str(k): v for k, v in self.counts.items() if v}})
+                try:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_path = self.path.with_name(f"{self.path.name}.{threading.get_ident()}.tmp")
+                    tmp_path.write_text(data, encoding='utf-8')
+                    os.replace(tmp_path, self.path)
+                except OSError as e:
+                    logger.warning(f"保存角度直方图失败: {e}")
+
+    def order(self) -> List[int]:
+        """按出现次数从多到少排列的角度列表"""
+        with self._lock:
+            if self._order is None:
+                self._order = sorted(self.counts, key=lambda angle: (-self.counts[angle], abs(angle), angle))
+            return self._order
+
+
+# 默认的全局角度直方图，可通过环境变量 ICR_ANGLE_HISTOGRAM 指定保存文件
+angle_histogram = AngleHistogram(os.getenv("ICR_ANGLE_HISTOGRAM") or None)
+
+# 提前退出阈值(相似度百分比)，可通过环境变量 ICR_EARLY_EXIT 设置，不设置时评估全部角度
+EARLY_EXIT = float(os.getenv("ICR_EARLY_EXIT")) if os.getenv("ICR_EARLY_EXIT") else None
+
+
+def order_rotations(rotations, angle_order):
+    """
+    按给定的角度顺序排列角度索引
+
+    参数:
+        rotations: 单个sprite区域的 RotationSet
+        angle_order: 角度序列或 AngleHistogram，未出现在其中的角度按原顺序排在最后
+
+    返回:
+        角度索引列表
+    """
+    if isinstance(angle_order, AngleHistogram):
+        angle_order = angle_order.order()
+    rank = {angle: i for i, angle in enumerate(angle_order)}
+    # 去重或对称剪枝后一个条目代表多个角度，按其中最靠前的角度排序
+    best = [len(rank)] * len(rotations)
+    for angle, index in zip(rotations.alias_angles.tolist(), rotations.alias_index.tolist()):
+        best[index] = min(best[index], rank.get(angle, len(rank)))
+    return sorted(range(len(rotations)), key=lambda rot_idx: best[rot_idx])
+
+
+# 检测旋转对称性时尝试的周期(度)，对应 12、8、6、5、4 重对称
+SYMMETRY_PERIODS = (30, 45, 60, 72, 90)
+
+
+def _crop_mask(img):
+    """二值化并裁剪到前景的边界矩形"""
+    mask = img > 127
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return mask
+    return mask[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+
+
+def rotation_iou(region_roi, angle) -> float:
+    """区域旋转 angle 度后与原图前景的交并比，允许1像素的错位"""
+    original = _crop_mask(region_roi)
+    rotated = _crop_mask(opencv_rotate(region_roi, angle))
+    if original.size == 0 or np.abs(np.subtract(original.shape, rotated.shape)).max() > 2:
+        return 0.0
+
+    h = max(original.shape[0], rotated.shape[0]) + 2
+    w = max(original.shape[1], rotated.shape[1]) + 2
+    base = np.zeros((h, w), dtype=bool)
+    base[1:1 + original.shape[0], 1:1 + original.shape[1]] = original
+    best = 0.0
+    for dy in range(h - rotated.shape[0] + 1):
+        for dx in range(w - rotated.shape[1] + 1):
+            shifted = np.zeros((h, w), dtype=bool)
+            shifted[dy:dy + rotated.shape[0], dx:dx + rotated.shape[1]] = rotated
+            union = np.count_nonzero(base | shifted)
+            if union:
+                best = max(best, np.count_nonzero(base & shifted) / union)
+    return best
+
+
+def rotational_symmetry(region_roi, min_iou: float, max_period: int = 90) -> Optional[int]:
+    """
+    检测区域的旋转对称周期
+
+    返回:
+        SYMMETRY_PERIODS 中不超过 max_period、旋转后与原图交并比不低于 min_iou 的最小周期，没有时返回None
+    """
+    for period in SYMMETRY_PERIODS:
+        if period <= max_period and rotation_iou(region_roi, period) >= min_iou:
+            return period
+    return None
+
+
+def compute_rotations(region_roi, packed: bool = False, max_angle: int = 45,
+                      symmetry_iou: float = 0.0) -> RotationSet:
+    """
+    计算单个sprite区域ROI在-max_angle度到max_angle度下的旋转结果，packed 见 RotationSet
+
+    symmetry_iou 大于0时先检测旋转对称性：周期为 p 的图形只计算以0度为中心的 p 个角度，
+    其余角度作为相差整数个周期的角度的别名
+    """
+    angles = []
+    images = []
+    aspect_ratios = []
+    aliases = {}
+
+    all_angles = range(-max_angle, max_angle + 1)
+    period = rotational_symmetry(region_roi, symmetry_iou, len(all_angles) - 1) if symmetry_iou else None
+    if period is not None:
+        start = -(period // 2)
+        aliases = {angle: (angle - start) % period + start for angle in all_angles
+                   if not start <= angle < start + period}
+
+    # 从-max_angle度到max_angle度，步长1度
+    for angle in all_angles:
+        if angle in aliases:
+            continue
+        # 旋转图像
+        if rotation_engine is not None:
+            rotated_img = rotation_engine.rotate(region_roi, -angle)
+        else:
             rotated_img = opencv_rotate(region_roi, -angle)
 
-            # 获取轮廓的边界矩形
-            rects = extract_black_regions(rotated_img, 0)
+        # 获取轮廓的边界矩形
+        rects = extract_black_regions(rotated_img, 0)
+
+        # 合并所有矩形
+        if rects:
+            x_r, y_r, w_r, h_r = rects[0]  # 取第一个也是唯一一个矩形
+            aspect_ratio = round(float(w_r) / h_r, 12) if h_r != 0 else float('inf')
+
+            # 只保存裁剪后的有效区域
+            angles.append(angle)
+            images.append(rotated_img[y_r:y_r + h_r, x_r:x_r + w_r])
+            aspect_ratios.append(aspect_ratio)
+
+    return RotationSet.from_images(angles, images, aspect_ratios, packed, aliases)
+
 
-            # 合并所有矩形
-            if rects:
-                x_r, y_r, w_r, h_r = rects[0]  # 取第一个也是唯一一个矩形
-                aspect_ratio = round(float(w_r) / h_r, 12) if h_r != 0 else float('inf')
+# 是否按位压缩旋转结果，可通过环境变量 ICR_PACK_ROTATIONS=1 开启，见 RotationSet
+PACK_ROTATIONS = os.getenv("ICR_PACK_ROTATIONS", "0") == "1"
 
-                # 存储旋转信息
-                rotation_info = {
-                    'angle': angle,
-                    'rect': (x_r, y_r, w_r, h_r),
-                    'aspect_ratio': aspect_ratio,
-                    'rotated_image': rotated_img
-                }
-                region_data['rotations'].append(rotation_info)
 
-        rotation_data.append(region_data)
+def analyze_rotated_regions(sprite_mask, sprite_black_regions, cache: Optional[RotationCache] = None,
+                            packed: Optional[bool] = None, max_angle: int = 45, symmetry_iou: float = 0.0,
+                            counts: Optional[dict] = None, timings: Optional[dict] = None):
+    """
+    分析每个sprite黑色区域在不同旋转角度下的轮廓
+
+    参数:
+        sprite_mask: 预处理后的sprite二值图像
+        sprite_black_regions: sprite中的黑色区域列表
+        cache: 旋转结果缓存，为None时每次重新计算
+        packed: 是否按位压缩旋转结果，None表示使用 PACK_ROTATIONS
+        max_angle: 旋转角度范围为 -max_angle 到 max_angle 度
+        symmetry_iou: 旋转对称检测的交并比阈值，0表示不做对称剪枝，见 compute_rotations
+        counts: 如果提供字典，将本次的缓存命中、未命中数累加到 "cache_hits"、"cache_misses"
+        timings: 如果提供字典，将缓存命中省下的旋转分析耗时(秒)累加到 "cache_saved"
+
+    返回:
+        每个区域一个字典，包含 'original_region' 和 'rotations'(RotationSet)
+    """
+    if packed is None:
+        packed = PACK_ROTATIONS
+    rotation_data = []
+
+    for region_idx, (x, y, w, h) in enumerate(sprite_black_regions):
+        # 提取当前区域的ROI
+        region_roi = sprite_mask[y:y + h, x:x + w]
+
+        if cache is None:
+            rotations = compute_rotations(region_roi, packed, max_angle, symmetry_iou)
+        else:
+            key = cache.key_for(region_roi, packed, max_angle, symmetry_iou)
+            entry = cache.lookup(key)
+            if entry is None:
+                start_time = time.perf_counter()
+                rotations = compute_rotations(region_roi, packed, max_angle, symmetry_iou)
+                cache.put(key, rotations, time.perf_counter() - start_time)
+                if counts is not None:
+                    counts['cache_misses'] = counts.get('cache_misses', 0) + 1
+            else:
+                rotations, elapsed = entry
+                if counts is not None:
+                    counts['cache_hits'] = counts.get('cache_hits', 0) + 1
+                if timings is not None:
+                    timings['cache_saved'] = timings.get('cache_saved', 0.0) + elapsed
+
+        # 存储当前区域的所有旋转信息
+        rotation_data.append({
+            'original_region': (x, y, w, h),
+            'rotations': rotations
+        })
 
     return rotation_data
 
@@ -412,26 +1216,26 @@ def display_rotation_analysis(rotation_data, original_sprite):
         plt.subplot(2, 1, 2)
 
         # 计算最大宽度和高度，确定网格单元大小
-        max_width = max(rot['rect'][2] for rot in region_data['rotations'])
-        max_height = max(rot['rect'][3] for rot in region_data['rotations'])
+        rotations = region_data['rotations']
+        max_width = int(rotations.sizes[:, 0].max())
+        max_height = int(rotations.sizes[:, 1].max())
         cell_size = max(max_width, max_height) + 20  # 加上边距
 
         # 创建网格参数
-        num_angles = len(region_data['rotations'])
+        num_angles = len(rotations)
         cols = 10  # 每行显示10个角度
         rows = (num_angles + cols - 1) // cols
 
         # 创建网格图像
         grid = np.zeros((rows * cell_size, cols * cell_size), dtype=np.uint8) + 200  # 灰色背景
 
-        for i, rot in enumerate(region_data['rotations']):
+        for i in range(num_angles):
             row = i // cols
             col = i % cols
 
             # 获取旋转后的图像和其矩形信息
-            rotated_img = rot['rotated_image']
-            x_r, y_r, w_r, h_r = rot['rect']
-            roi = rotated_img[y_r:y_r + h_r, x_r:x_r + w_r]
+            roi = rotations.image(i)
+            h_r, w_r = roi.shape
 
             # 计算在网格中的位置(居中放置)
             y_start = row * cell_size + (cell_size - h_r) // 2
@@ -443,7 +1247,7 @@ def display_rotation_analysis(rotation_data, original_sprite):
             # 添加角度标签(放在图像下方)
             label_y = row * cell_size + cell_size - 5
             label_x = col * cell_size + 5
-            cv2.putText(grid, f"{rot['angle']} deg", (label_x, label_y),
+            cv2.putText(grid, f"{rotations.angles[i]} deg", (label_x, label_y),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.4, 0, 1)  # 黑色文字
 
         plt.imshow(grid, cmap='gray', vmin=0, vmax=255)
@@ -456,9 +1260,9 @@ def display_rotation_analysis(rotation_data, original_sprite):
         # 打印旋转信息
         print(f"\nRegion {idx + 1} Rotation Analysis:")
         print("Angle | Width | Height | Aspect Ratio")
-        for rot in region_data['rotations']:
-            x_r, y_r, w_r, h_r = rot['rect']
-            print(f"{rot['angle']:5}° | {w_r:5} | {h_r:6} | {rot['aspect_ratio']:.12f}")
+        for i in range(num_angles):
+            w_r, h_r = rotations.sizes[i]
+            print(f"{rotations.angles[i]:5}° | {w_r:5} | {h_r:6} | {rotations.aspect_ratios[i]:.12f}")
 
 
 def binary_similarity(img1, img2):
@@ -467,24 +1271,143 @@ def binary_similarity(img1, img2):
     return (matching_pixels / img1.size) * 100
 
 
+# numpy 2.0 起提供逐元素的位计数，旧版本退回到按字节查表
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        """逐元素统计置位数"""
+        return np.bitwise_count(words)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """逐元素统计置位数（按字节查表后合并回原来的元素）"""
+        words = np.ascontiguousarray(words)
+        counts = _POPCOUNT_TABLE[words.view(np.uint8)]
+        return counts.reshape(words.shape + (words.itemsize,)).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_mask(mask):
+    """
+    将二值图像（以127为阈值）沿最后一维按位压缩为 uint64 字，行尾补零位
+
+    参数:
+        mask: 形状为 (..., h, w) 的图像或图像堆叠
+
+    返回:
+        形状为 (..., h, ceil(w / 64)) 的 uint64 数组
+    """
+    bits = np.packbits(mask > 127, axis=-1)
+    padded = np.zeros(bits.shape[:-1] + (-(-bits.shape[-1] // 8) * 8,), dtype=np.uint8)
+    padded[..., :bits.shape[-1]] = bits
+    return padded.view(np.uint64)
+
+
+def packed_window_matches(template, search_area):
+    """
+    一个模板与搜索区域内所有同尺寸窗口逐像素比较，返回每个窗口中相同的像素数
+
+    搜索区域每个水平偏移只按位压缩一次，之后按行滑动与模板做异或和位计数，
+    结果与对每个窗口调用 binary_similarity 的计数完全相同。
+
+    返回:
+        形状为 (窗口行数, 窗口列数) 的 int64 数组
+    """
+    h_r, w_r = template.shape[:2]
+    bg_h, bg_w = search_area.shape[:2]
+    packed_template = pack_mask(template)
+
+    # (水平偏移, 行, 字)：每个水平偏移下搜索区域各行的压缩结果
+    shifted = pack_mask(sliding_window_view(search_area, w_r, axis=1).transpose(1, 0, 2))
+    # (水平偏移, 垂直偏移, 字, 模板行) 的窗口视图
+    windows = sliding_window_view(shifted, h_r, axis=1)
+    mismatches = popcount(windows ^ packed_template.T).sum(axis=(2, 3), dtype=np.int64)
+    return template.size - mismatches.T
+
+
+def packed_batch_similarity(templates, image):
+    """
+    多个与 image 同尺寸的模板分别与 image 逐像素比较，返回相似度百分比数组
+
+    模板堆叠只压缩一次，结果与对每个模板调用 binary_similarity 完全相同。
+    """
+    mismatches = popcount(pack_mask(np.asarray(templates)) ^ pack_mask(image)).sum(axis=(1, 2), dtype=np.int64)
+    return ((image.size - mismatches) / image.size) * 100
+
+
+# 窗口数不少于该值时 brute_search 使用按位压缩的批量比较，更少时逐窗口比较的固定开销更小
+BRUTE_PACKED_MIN_WINDOWS = 12
+
+
 def brute_search(rotated_roi, bg_roi, bg_rect, w_r, h_r):
-    max_similarity = -1
-    best_bg_sub_rect = None
+    """逐窗口比较二值像素，窗口较多时通过按位压缩后的异或与位计数批量打分"""
     bg_x, bg_y, bg_w, bg_h = bg_rect
 
-    # 计算滑动窗口的范围
-    for y in range(0, bg_h - h_r + 1):
-        for x in range(0, bg_w - w_r + 1):
-            # 获取当前窗口的ROI
-            bg_sub_roi = bg_roi[y:y + h_r, x:x + w_r]
+    if (bg_h - h_r + 1) * (bg_w - w_r + 1) < BRUTE_PACKED_MIN_WINDOWS:
+        max_similarity = -1
+        best_bg_sub_rect = None
+
+        # 计算滑动窗口的范围
+        for y in range(0, bg_h - h_r + 1):
+            for x in range(0, bg_w - w_r + 1):
+                # 获取当前窗口的ROI
+                bg_sub_roi = bg_roi[y:y + h_r, x:x + w_r]
+
+                # 计算相似度
+                current_sim = binary_similarity(rotated_roi, bg_sub_roi)
+
+                # 更新最大相似度和最佳位置
+                if current_sim > max_similarity:
+                    max_similarity = current_sim
+                    best_bg_sub_rect = (bg_x + x, bg_y + y, w_r, h_r)
+        return best_bg_sub_rect, max_similarity
+
+    matching = packed_window_matches(rotated_roi, bg_roi[:bg_h, :bg_w])
 
-            # 计算相似度
-            current_sim = binary_similarity(rotated_roi, bg_sub_roi)
+    # 取按行优先顺序的第一个最大值
+    y, x = np.unravel_index(int(np.argmax(matching)), matching.shape)
+    max_similarity = (int(matching[y, x]) / rotated_roi.size) * 100
 
-            # 更新最大相似度和最佳位置
-            if current_sim > max_similarity:
-                max_similarity = current_sim
-                best_bg_sub_rect = (bg_x + x, bg_y + y, w_r, h_r)
+    best_bg_sub_rect = (bg_x + int(x), bg_y + int(y), w_r, h_r)
+    return best_bg_sub_rect, max_similarity
+
+
+# vectorized_search 中使用 einsum 计算相关的最大运算量（窗口数 × 模板像素数）
+VECTORIZED_EINSUM_LIMIT = 1 << 20
+
+
+def vectorized_search(rotated_roi, bg_roi, bg_rect, w_r, h_r):
+    """
+    brute_search 的向量化版本，结果与 brute_search 完全一致
+
+    每个窗口中相同的像素数 = 模板像素总数 - 模板前景数 - 窗口前景数 + 2 * 两者同为前景的像素数，
+    其中同为前景的像素数通过一次相关运算得到，窗口前景数通过积分图得到。
+    """
+    bg_x, bg_y, bg_w, bg_h = bg_rect
+
+    template = (rotated_roi > 127).astype(np.float32)
+    search_area = (bg_roi[:bg_h, :bg_w] > 127).astype(np.float32)
+
+    # 所有偏移位置上模板与窗口同为前景的像素数（结果为整数，取整消除浮点误差）
+    # 窗口数量较少时直接在滑动窗口视图上做张量收缩，比 matchTemplate 的固定开销更小
+    windows = (bg_h - h_r + 1) * (bg_w - w_r + 1)
+    if windows * template.size <= VECTORIZED_EINSUM_LIMIT:
+        both = np.einsum('ijkl,kl->ij', sliding_window_view(search_area, (h_r, w_r)), template)
+    else:
+        both = cv2.matchTemplate(search_area, template, cv2.TM_CCORR)
+    both = np.rint(both).astype(np.int64)
+
+    # 利用积分图计算每个窗口内的前景像素数
+    integral = cv2.integral(search_area.astype(np.uint8))
+    window = (integral[h_r:, w_r:] - integral[:-h_r, w_r:]
+              - integral[h_r:, :-w_r] + integral[:-h_r, :-w_r])
+
+    matching = template.size - int(np.count_nonzero(template)) - window + 2 * both
+
+    # argmax 返回按行优先顺序的第一个最大值，与 brute_search 的遍历顺序一致
+    y, x = np.unravel_index(int(np.argmax(matching)), matching.shape)
+    max_similarity = (int(matching[y, x]) / rotated_roi.size) * 100
+
+    best_bg_sub_rect = (bg_x + int(x), bg_y + int(y), w_r, h_r)
     return best_bg_sub_rect, max_similarity
 
 
@@ -507,106 +1430,856 @@ def template_search(rotated_roi, bg_roi, bg_rect, w_r, h_r):
     return best_bg_sub_rect, max_similarity
 
 
-def match_sprite_to_background(bg_black_regions, preprocessed_bg, rotation_data, method='template'):
+def crop_rotated_roi(rotations, rot_idx, bg_w, bg_h):
     """
-    将sprite区域与背景黑色区域进行匹配
+    取出旋转后sprite的有效区域，超出背景区域的维度会被缩小到背景区域的大小
+
+    参数:
+        rotations: 单个sprite区域的 RotationSet
+        rot_idx: 角度索引
+        bg_w: 背景区域宽度
+        bg_h: 背景区域高度
+
+    返回:
+        旋转后sprite ROI
+    """
+    rotated_roi = rotations.image(rot_idx)
+    h_r, w_r = rotated_roi.shape
+
+    # 检查是否需要调整rotated_roi的大小
+    if h_r > bg_h or w_r > bg_w:
+        # 计算新的尺寸，只缩小较大的维度
+        new_w = min(w_r, bg_w)  # 如果w_r > bg_w则缩小宽度，否则保持
+        new_h = min(h_r, bg_h)  # 如果h_r > bg_h则缩小高度，否则保持
+
+        # 缩放rotated_roi
+        rotated_roi = cv2.resize(rotated_roi, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+
+    return rotated_roi
+
+
+def match_rotation(rotations, rot_idx, bg_rect, preprocessed_bg, func):
+    """
+    将sprite的某一个旋转角度与一个背景区域进行匹配
+
+    参数:
+        rotations: 单个sprite区域的 RotationSet
+        rot_idx: 角度索引
+        bg_rect: 背景区域 (x, y, w, h)
+        preprocessed_bg: 预处理后的二值化背景图像
+        func: 滑动窗口匹配函数，为None时使用缩放后直接比较
+
+    返回:
+        (最佳匹配矩形, 相似度, 参与匹配的旋转后sprite ROI)
+    """
+    # 准备背景ROI
+    bg_x, bg_y, bg_w, bg_h = bg_rect
+    bg_roi = preprocessed_bg[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w]
+
+    if func is None:
+        # 旋转后的有效区域
+        rotated_roi = rotations.image(rot_idx)
+        h_r, w_r = rotated_roi.shape
+
+        # 速度匹配
+        # 调整大小使两个ROI相同尺寸
+        max_width = max(w_r, bg_w)
+        max_height = max(h_r, bg_h)
+
+        # 调整sprite ROI
+        sprite_resized = cv2.resize(rotated_roi, (max_width, max_height),
+                                    interpolation=cv2.INTER_NEAREST)
+
+        # 调整背景ROI
+        bg_resized = cv2.resize(bg_roi, (max_width, max_height),
+                                interpolation=cv2.INTER_NEAREST)
+
+        # 计算相似度
+        similarity = binary_similarity(sprite_resized, bg_resized)
+
+        best_bg_sub_rect = bg_rect
+    else:
+        rotated_roi = crop_rotated_roi(rotations, rot_idx, bg_w, bg_h)
+        h_r, w_r = rotated_roi.shape[:2]
+
+        # 在bg_roi上滑动窗口进行比较
+        best_bg_sub_rect, similarity = func(rotated_roi, bg_roi, bg_rect, w_r, h_r)
+
+    return best_bg_sub_rect, similarity, rotated_roi
+
+
+def direct_batch_similarity(rotations, bg_roi):
+    """
+    直接比较模式（match_rotation 的 func=None 分支）下，一次计算全部角度与一个背景区域的相似度
+
+    缩放到同一尺寸的sprite按尺寸分组后批量按位压缩比较，每种尺寸的背景只缩放和压缩一次，
+    结果与逐个角度调用 match_rotation 完全相同。
+
+    返回:
+        与角度索引一一对应的相似度列表
+    """
+    bg_h, bg_w = bg_roi.shape[:2]
+    groups = defaultdict(list)
+    for rot_idx, (w_r, h_r) in enumerate(rotations.sizes.tolist()):
+        groups[(max(w_r, bg_w), max(h_r, bg_h))].append(rot_idx)
+
+    similarities = [0.0] * len(rotations)
+    for (width, height), indices in groups.items():
+        sprites = [cv2.resize(rotations.image(rot_idx), (width, height), interpolation=cv2.INTER_NEAREST)
+                   for rot_idx in indices]
+        bg_resized = cv2.resize(bg_roi, (width, height), interpolation=cv2.INTER_NEAREST)
+        for rot_idx, similarity in zip(indices, packed_batch_similarity(sprites, bg_resized).tolist()):
+            similarities[rot_idx] = similarity
+    return similarities
+
+
+def prepare_fft_background(bg_roi):
+    """
+    预先计算背景ROI的频域表示和积分图，供 fft_batch_search 在多个模板之间复用
+
+    参数:
+        bg_roi: 背景区域ROI
+
+    返回:
+        包含频谱和积分图的字典
+    """
+    search_area = bg_roi.astype(np.float64) / 255
+    height, width = search_area.shape
+
+    # 积分图多补一行一列0，窗口和可以直接用四个角相减得到
+    sums = np.zeros((height + 1, width + 1))
+    sq_sums = np.zeros((height + 1, width + 1))
+    sums[1:, 1:] = search_area.cumsum(0).cumsum(1)
+    sq_sums[1:, 1:] = (search_area ** 2).cumsum(0).cumsum(1)
+
+    return {
+        'shape': (height, width),
+        'spectrum': np.fft.rfft2(search_area),
+        'sum': sums,
+        'sq_sum': sq_sums
+    }
+
+
+def fft_batch_search(templates, prepared_bg, bg_rect):
+    """
+    在频域中一次性将多个模板与同一个背景区域做相关，得分等价于 TM_CCOEFF_NORMED
+
+    所有模板补零到背景区域大小后批量做FFT，与背景频谱相乘后逆变换得到每个模板在每个偏移上的
+    互相关；再结合积分图得到的窗口均值和方差进行归一化。模板不会超出背景区域，因此循环相关在
+    有效偏移范围内不会发生回绕。
+
+    参数:
+        templates: 旋转后sprite ROI列表，尺寸不能超过背景区域
+        prepared_bg: prepare_fft_background 的返回值
+        bg_rect: 背景区域 (x, y, w, h)
+
+    返回:
+        与 templates 一一对应的 (最佳匹配矩形, 相似度) 列表
+    """
+    bg_x, bg_y = bg_rect[:2]
+    height, width = prepared_bg['shape']
+    sums, sq_sums = prepared_bg['sum'], prepared_bg['sq_sum']
+
+    if not templates:
+        return []
+
+    # 将所有模板补零到背景区域大小并批量变换
+    stack = np.zeros((len(templates), height, width))
+    for i, template in enumerate(templates):
+        h_r, w_r = template.shape[:2]
+        stack[i, :h_r, :w_r] = template / 255
+    correlations = np.fft.irfft2(np.conj(np.fft.rfft2(stack)) * prepared_bg['spectrum'], s=(height, width))
+
+    results = []
+    for i, template in enumerate(templates):
+        h_r, w_r = template.shape[:2]
+        count = h_r * w_r
+        template_values = stack[i, :h_r, :w_r]
+        template_sum = template_values.sum()
+        template_norm = np.sqrt(max((template_values ** 2).sum() - template_sum ** 2 / count, 0))
+
+        # 与 OpenCV 一致：纯色模板在所有位置的得分都为1
+        if template_norm < 1e-6:
+            results.append(((bg_x, bg_y, w_r, h_r), 100.0))
+            continue
+
+        # 每个窗口的像素和与平方和
+        window_sum = sums[h_r:, w_r:] - sums[:-h_r, w_r:] - sums[h_r:, :-w_r] + sums[:-h_r, :-w_r]
+        window_sq_sum = (sq_sums[h_r:, w_r:] - sq_sums[:-h_r, w_r:]
+                         - sq_sums[h_r:, :-w_r] + sq_sums[:-h_r, :-w_r])
+
+        numerator = correlations[i, :height - h_r + 1, :width - w_r + 1] - template_sum * window_sum / count
+        denominator = np.sqrt(np.maximum(window_sq_sum - window_sum ** 2 / count, 0)) * template_norm
+
+        # 与 OpenCV 相同的归一化规则：分母接近0时按分子的大小取 ±1 或 0
+        abs_numerator = np.abs(numerator)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(abs_numerator < denominator, numerator / denominator,
+                              np.where(abs_numerator < denominator * 1.125, np.sign(numerator), 0.0))
+
+        y, x = np.unravel_index(int(np.argmax(scores)), scores.shape)
+        max_similarity = float(scores[y, x]) * 100  # 转换为百分比
+        results.append(((bg_x + int(x), bg_y + int(y), w_r, h_r), max_similarity))
+
+    return results
+
+
+def coarse_to_fine_rotations(rotations, bg_indices, evaluate, coarse_step=23, top_k=3):
+    """
+    由粗到细的角度搜索
+
+    先在间隔为 coarse_step 的粗角度网格上评估所有背景区域，再逐级细化：每一级保留每个sprite
+    得分最高的 top_k 个(背景区域, 角度)候选，以约1/3的间隔评估候选两侧到相邻采样点之间的角度，
+    直到间隔为1度。每一级的采样覆盖上一级的整个间隔，因此单峰的得分总能细化到峰值所在的角度。
+
+    参数:
+        rotations: 单个sprite区域的 RotationSet
+        bg_indices: 参与匹配的背景区域索引
+        evaluate: 评估函数 evaluate(bg_idx, 角度索引) -> 相似度，由调用方记录匹配结果
+        coarse_step: 粗搜索的角度间隔
+        top_k: 每一级进入细化的候选数量
+    """
+    if not len(rotations):
+        return
+    # 角度网格基于全部角度(包括去重或对称剪枝掉的)，每个角度映射回代表它的条目再评估
+    angles = rotations.alias_angles.tolist()
+    entries = rotations.alias_index.tolist()
+
+    evaluated = set()
+    candidates = []
+
+    def visit(bg_idx, i):
+        if (bg_idx, entries[i]) in evaluated:
+            return
+        similarity = evaluate(bg_idx, entries[i])
+        evaluated.add((bg_idx, entries[i]))
+        candidates.append((similarity, bg_idx, angles[i]))
+
+    # 粗网格：从第一个角度开始每隔 coarse_step 取一个，并保证包含最后一个角度
+    coarse = [i for i, angle in enumerate(angles) if (angle - angles[0]) % coarse_step == 0]
+    if coarse[-1] != len(angles) - 1:
+        coarse.append(len(angles) - 1)
+    for bg_idx in bg_indices:
+        for i in coarse:
+            visit(bg_idx, i)
+
+    # 逐级在得分最高的候选附近细化
+    step = coarse_step
+    while step > 1:
+        fine = max(1, step // 3)
+        candidates.sort(key=lambda c: -c[0])
+        for _, bg_idx, center in candidates[:top_k]:
+            for i, angle in enumerate(angles):
+                if abs(angle - center) < step and (angle - center) % fine == 0:
+                    visit(bg_idx, i)
+        step = fine
+
+
+def pyramid_level(image, level):
+    """将图像缩小到金字塔的第 level 层（每层边长减半，第0层为原图）"""
+    if level == 0:
+        return image
+    factor = 2 ** level
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA)
+
+
+def pyramid_search(rotations, bg_black_regions, preprocessed_bg, record, levels=2, top_k=5, timings=None,
+                   bg_indices=None, counts=None):
+    """
+    多分辨率金字塔匹配
+
+    在最顶层（分辨率缩小 2**levels 倍）上用模板匹配评估所有(背景区域, 角度)组合，保留得分最高的
+    top_k 个候选；之后逐层提高分辨率，只在上一层候选位置附近的小窗口内重新匹配，最后在原分辨率
+    下记录候选的匹配结果。
 
     参数:
+        rotations: 单个sprite区域的 RotationSet
         bg_black_regions: 背景中的黑色区域列表
         preprocessed_bg: 预处理后的二值化背景图像
-        rotation_data: sprite旋转分析数据
-        method: 匹配背景块方法
+        record: 记录函数 record(bg_idx, 角度索引, 最佳匹配矩形, 相似度)
+        levels: 金字塔层数，0表示直接在原分辨率上搜索
+        top_k: 每层保留的候选数量
+        timings: 如果提供字典，将每层耗时(秒)累加到 "pyramid_level_<层号>" 键中
+        bg_indices: 参与匹配的背景区域索引，None表示全部
+        counts: 如果提供字典，将顶层批量相关的模板数累加到 "fft_templates"，细化时的 matchTemplate
+            调用次数累加到 "match_calls"
+    """
+    if bg_indices is None:
+        bg_indices = range(len(bg_black_regions))
+    if not len(rotations) or not bg_indices:
+        return
+
+    bg_rois = [preprocessed_bg[y:y + h, x:x + w] for x, y, w, h in bg_black_regions]
+    level_bgs = {}
+    level_templates = {}
+
+    def get_bg(bg_idx, level):
+        key = (bg_idx, level)
+        if key not in level_bgs:
+            level_bgs[key] = pyramid_level(bg_rois[bg_idx], level)
+        return level_bgs[key]
+
+    def get_template(bg_idx, rot_idx, level):
+        key = (bg_idx, rot_idx, level)
+        if key not in level_templates:
+            bg_h, bg_w = bg_rois[bg_idx].shape[:2]
+            template = crop_rotated_roi(rotations, rot_idx, bg_w, bg_h)
+            if level > 0:
+                # 缩小后的模板同样不能超过缩小后的背景区域
+                small_h, small_w = get_bg(bg_idx, level).shape[:2]
+                template = pyramid_level(template, level)
+                if template.shape[0] > small_h or template.shape[1] > small_w:
+                    template = cv2.resize(template, (min(template.shape[1], small_w), min(template.shape[0], small_h)),
+                                          interpolation=cv2.INTER_NEAREST)
+            level_templates[key] = template
+        return level_templates[key]
+
+    def add_timing(level, start_time):
+        if start_time is not None:
+            key = f"pyramid_level_{level}"
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start_time
+
+    # 顶层：完整搜索所有组合，小尺寸下 matchTemplate 的固定开销占主导，因此用批量频域相关
+    start_time = time.perf_counter() if timings is not None else None
+    candidates = []
+    for bg_idx in bg_indices:
+        templates = [get_template(bg_idx, rot_idx, levels) for rot_idx in range(len(rotations))]
+        bg_small = get_bg(bg_idx, levels)
+        results = fft_batch_search(templates, prepare_fft_background(bg_small),
+                                   (0, 0, bg_small.shape[1], bg_small.shape[0]))
+        for rot_idx, ((x, y, _, _), similarity) in enumerate(results):
+            candidates.append((similarity / 100, bg_idx, rot_idx, (x, y)))
+        if counts is not None:
+            counts['fft_templates'] = counts.get('fft_templates', 0) + len(templates)
+    candidates.sort(key=lambda c: -c[0])
+    candidates = candidates[:top_k]
+    add_timing(levels, start_time)
+
+    # 逐层细化：只在上一层位置放大后的邻域内搜索
+    margin = 2
+    for level in range(levels - 1, -1, -1):
+        start_time = time.perf_counter() if timings is not None else None
+        refined = []
+        for _, bg_idx, rot_idx, (x, y) in candidates:
+            bg_level = get_bg(bg_idx, level)
+            template = get_template(bg_idx, rot_idx, level)
+            t_h, t_w = template.shape[:2]
+            max_x = bg_level.shape[1] - t_w
+            max_y = bg_level.shape[0] - t_h
+            x0, x1 = min(max(x * 2 - margin, 0), max_x), min(max(x * 2 + margin, 0), max_x)
+            y0, y1 = min(max(y * 2 - margin, 0), max_y), min(max(y * 2 + margin, 0), max_y)
+
+            window = bg_level[y0:y1 + t_h, x0:x1 + t_w]
+            res = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_pos = cv2.minMaxLoc(res)
+            refined.append((max_val, bg_idx, rot_idx, (x0 + max_pos[0], y0 + max_pos[1])))
+        refined.sort(key=lambda c: -c[0])
+        candidates = refined[:top_k]
+        if counts is not None:
+            counts['match_calls'] = counts.get('match_calls', 0) + len(refined)
+        add_timing(level, start_time)
+
+    for max_val, bg_idx, rot_idx, (x, y) in candidates:
+        bg_x, bg_y = bg_black_regions[bg_idx][:2]
+        template = get_template(bg_idx, rot_idx, 0)
+        t_h, t_w = template.shape[:2]
+        record(bg_idx, rot_idx, (bg_x + x, bg_y + y, t_w, t_h), max_val * 100)
+
+
+def shape_descriptor(mask):
+    """
+    计算二值区域的旋转不变形状描述子（取对数的Hu矩）
+
+    参数:
+        mask: 区域ROI，以127为阈值二值化，旋转插值产生的灰度边缘不计入区域
 
     返回:
-        匹配结果列表，每个元素是一个字典包含匹配信息
+        长度为7的描述子数组
     """
-    func = {
-        'template': template_search,
-        'brute': brute_search
-    }.get(method, None)
+    hu = cv2.HuMoments(cv2.moments((mask > 127).astype(np.uint8), binaryImage=True)).flatten()
+    # Hu矩数量级差别很大，取带符号的对数使各分量可比
+    return -np.sign(hu) * np.log10(np.abs(hu) + 1e-30)
 
-    # 存储所有可能的匹配（包括冲突的）
-    all_matches = []
 
-    # 第一阶段：收集所有可能的匹配
-    for sprite_idx, sprite_data in enumerate(rotation_data):
+def prefilter_pairs(sprite_descriptors, bg_descriptors, keep=None, max_distance=None):
+    """
+    根据形状描述子剔除明显不可能匹配的 sprite×背景区域 组合
+
+    参数:
+        sprite_descriptors: 每个sprite区域的描述子
+        bg_descriptors: 每个背景区域的描述子
+        keep: 每个sprite最多保留的背景区域数量（按描述子距离从近到远），None表示不限制
+        max_distance: 描述子距离上限，超过的组合被剔除，None表示不限制；
+            每个sprite至少保留距离最近的一个背景区域
+
+    返回:
+        (每个sprite保留的背景区域索引列表, 被剔除的组合数量)
+    """
+    candidates = []
+    pruned = 0
+    bg_descriptors = np.asarray(bg_descriptors).reshape(len(bg_descriptors), -1)
+
+    for descriptor in sprite_descriptors:
+        # 只比较前4个Hu矩，高阶矩对二值化和插值噪声过于敏感
+        distances = np.abs(bg_descriptors[:, :4] - descriptor[:4]).sum(axis=1)
+        order = [int(i) for i in np.argsort(distances, kind='stable')]
+        kept = order if keep is None else order[:max(keep, 1)]
+        if max_distance is not None:
+            kept = kept[:1] + [i for i in kept[1:] if distances[i] <= max_distance]
+
+        # 保持背景区域原有的顺序
+        kept = sorted(kept)
+        pruned += len(order) - len(kept)
+        candidates.append(kept)
+
+    return candidates, pruned
+
+
+class Match:
+    """
+    一个sprite区域与一个背景区域的匹配结果
+
+    旋转后的模板不随匹配结果复制，而是通过 rotations 和 rot_idx 引用，需要时由 rotated_sprite 生成。
+    为兼容旧代码，也可以像字典一样用 match['angle'] 访问属性。
+    最终匹配的 runner_up 由 match_sprite_to_background 填入，为同一sprite在其他背景区域上的最高相似度。
+    """
+
+    __slots__ = ('sprite_idx', 'bg_idx', 'rot_idx', 'angle', 'similarity', 'sprite_rect', 'bg_rect',
+                 'rotations', 'fit_size', 'runner_up')
+
+    def __init__(self, sprite_idx, bg_idx, rotations, rot_idx, similarity, sprite_rect, bg_rect, fit_size=None):
+        """
+        参数:
+            sprite_idx: sprite区域索引
+            bg_idx: 背景区域索引
+            rotations: 该sprite区域的 RotationSet
+            rot_idx: 匹配角度在 rotations 中的索引
+            similarity: 相似度(百分比)
+            sprite_rect: sprite区域矩形
+            bg_rect: 背景中的最佳匹配矩形
+            fit_size: 滑动窗口匹配时模板被限制到的背景区域 (宽, 高)，直接比较时为None
+        """
+        self.sprite_idx = sprite_idx
+        self.bg_idx = bg_idx
+        self.rotations = rotations
+        self.rot_idx = rot_idx
+        self.angle = int(rotations.angles[rot_idx])
+        self.similarity = similarity
+        self.sprite_rect = sprite_rect
+        self.bg_rect = bg_rect
+        self.fit_size = fit_size
+        self.runner_up = None
+
+    @property
+    def confidence(self) -> float:
+        """0~1 的置信度，即相似度百分比/100"""
+        return min(1.0, max(0.0, float(self.similarity) / 100))
+
+    @property
+    def margin(self) -> float:
+        """与次优候选(其他背景区域)的相似度差(百分点)，没有其他候选时等于相似度"""
+        return float(self.similarity) - (self.runner_up if self.runner_up is not None else 0.0)
+
+    @property
+    def rotated_sprite(self) -> np.ndarray:
+        """参与匹配的旋转后sprite ROI"""
+        if self.fit_size is None:
+            return self.rotations.image(self.rot_idx)
+        return crop_rotated_roi(self.rotations, self.rot_idx, *self.fit_size)
+
+    @property
+    def equivalent_angles(self) -> List[int]:
+        """与匹配角度得到相同模板的全部角度，见 RotationSet"""
+        return self.rotations.equivalent_angles(self.rot_idx)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return (f"Match(sprite_idx={self.sprite_idx}, bg_idx={self.bg_idx}, angle={self.angle}, "
+                f"similarity={self.similarity:.3f}, bg_rect={self.bg_rect})")
+
+
+# 各匹配方法在单个背景区域内使用的滑动窗口匹配函数，不在表中的方法（None）缩放后直接比较
+MATCH_FUNCTIONS = {
+    'template': template_search,
+    'coarse': template_search,
+    'brute': brute_search,
+    'vectorized': vectorized_search,
+    'fft': template_search,
+    'pyramid': template_search
+}
+
+
+def collect_sprite_matches(sprite_idx, sprite_data, bg_indices, bg_black_regions, preprocessed_bg, method,
+                           search_options, prepared_bgs=None, timings=None, counts=None):
+    """
+    收集单个sprite区域与背景区域之间所有可能的匹配（match_sprite_to_background 的第一阶段）
+
+    参数:
+        sprite_idx: sprite区域索引
+        sprite_data: 该sprite区域的旋转分析数据
+        bg_indices: 参与匹配的背景区域索引
+        bg_black_regions: 背景中的黑色区域列表
+        preprocessed_bg: 预处理后的二值化背景图像
+        method: 匹配背景块方法，见 match_sprite_to_background
+        search_options: coarse_step、coarse_top_k、pyramid_levels、pyramid_top_k、early_exit、angle_order 组成的字典
+        prepared_bgs: "fft" 模式下已变换的背景区域缓存，可在多个sprite之间共享
+        timings: 各阶段耗时字典
+        counts: 各项计数字典，滑动窗口匹配(或直接比较)的次数累加到 "match_calls"，
+            批量频域相关的模板数累加到 "fft_templates"
+
+    返回:
+        Match 列表，每个背景区域只保留相似度最高的角度（相同时保留先评估的），
+        按这些最佳匹配的评估顺序排列
+    """
+    func = MATCH_FUNCTIONS.get(method, None)
+    rotations = sprite_data['rotations']
+    # bg_idx -> (评估序号, 匹配结果)
+    best = {}
+    if prepared_bgs is None:
+        prepared_bgs = {}
+
+    def record(bg_idx, rot_idx, best_bg_sub_rect, similarity):
+        # 只存储每个背景区域的最佳匹配
+        current = best.get(bg_idx)
+        if current is not None and similarity <= current[1].similarity:
+            return
+        fit_size = None if func is None else tuple(bg_black_regions[bg_idx][2:])
+        best[bg_idx] = (record.order, Match(sprite_idx, bg_idx, rotations, rot_idx, similarity,
+                                            sprite_data['original_region'], best_bg_sub_rect, fit_size))
+        record.order += 1
+
+    record.order = 0
+
+    def evaluate(bg_idx, rot_idx):
+        bg_rect = bg_black_regions[bg_idx]
+        best_bg_sub_rect, similarity, _ = match_rotation(rotations, rot_idx, bg_rect, preprocessed_bg, func)
+        record(bg_idx, rot_idx, best_bg_sub_rect, similarity)
+        if counts is not None:
+            counts['match_calls'] = counts.get('match_calls', 0) + 1
+        return similarity
+
+    if method == 'fft':
+        for bg_idx in bg_indices:
+            bg_rect = bg_black_regions[bg_idx]
+            bg_x, bg_y, bg_w, bg_h = bg_rect
+            if bg_idx not in prepared_bgs:
+                prepared_bgs[bg_idx] = prepare_fft_background(
+                    preprocessed_bg[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w])
+
+            templates = [crop_rotated_roi(rotations, rot_idx, bg_w, bg_h) for rot_idx in range(len(rotations))]
+            results = fft_batch_search(templates, prepared_bgs[bg_idx], bg_rect)
+            if counts is not None:
+                counts['fft_templates'] = counts.get('fft_templates', 0) + len(templates)
+            for rot_idx, (best_bg_sub_rect, similarity) in enumerate(results):
+                record(bg_idx, rot_idx, best_bg_sub_rect, similarity)
+    elif method == 'pyramid':
+        pyramid_search(rotations, bg_black_regions, preprocessed_bg, record,
+                       search_options['pyramid_levels'], search_options['pyramid_top_k'], timings, bg_indices, counts)
+    elif method == 'coarse':
+        coarse_to_fine_rotations(rotations, bg_indices, evaluate,
+                                 search_options['coarse_step'], search_options['coarse_top_k'])
+    elif search_options.get('early_exit') is not None:
+        # 按历史上最可能的角度顺序评估，相似度达到阈值后跳过该背景区域剩余的角度
+        early_exit = search_options['early_exit']
+        order = order_rotations(rotations, search_options['angle_order'])
+        for bg_idx in bg_indices:
+            for rot_idx in order:
+                if evaluate(bg_idx, rot_idx) >= early_exit:
+                    break
+    elif func is None:
+        # 直接比较时每个背景区域的全部角度一次批量计算
+        for bg_idx in bg_indices:
+            bg_x, bg_y, bg_w, bg_h = bg_rect = bg_black_regions[bg_idx]
+            similarities = direct_batch_similarity(rotations, preprocessed_bg[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w])
+            for rot_idx, similarity in enumerate(similarities):
+                record(bg_idx, rot_idx, bg_rect, similarity)
+            if counts is not None:
+                counts['match_calls'] = counts.get('match_calls', 0) + len(similarities)
+    else:
         # 遍历每个背景区域
-        for bg_idx, bg_rect in enumerate(bg_black_regions):
+        for bg_idx in bg_indices:
             # 比较这些角度
-            for rotation in sprite_data['rotations']:
-                # 获取旋转后的图像
-                rotated_img = rotation['rotated_image']
-                x_r, y_r, w_r, h_r = rotation['rect']
+            for rot_idx in range(len(rotations)):
+                evaluate(bg_idx, rot_idx)
 
-                # 裁剪出旋转后的有效区域
-                rotated_roi = rotated_img[y_r:y_r + h_r, x_r:x_r + w_r]
+    return [match for _, match in sorted(best.values(), key=lambda item: item[0])]
 
-                # 准备背景ROI
-                bg_x, bg_y, bg_w, bg_h = bg_rect
-                bg_roi = preprocessed_bg[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w]
 
-                if func is None:
-                    # 速度匹配
-                    # 调整大小使两个ROI相同尺寸
-                    max_width = max(w_r, bg_w)
-                    max_height = max(h_r, bg_h)
+# 并行匹配默认使用的进程数，可通过环境变量 ICR_MATCH_WORKERS 设置，0表示在当前进程中串行匹配
+MATCH_WORKERS = int(os.getenv("ICR_MATCH_WORKERS", "0"))
 
-                    # 调整sprite ROI
-                    sprite_resized = cv2.resize(rotated_roi, (max_width, max_height),
-                                                interpolation=cv2.INTER_NEAREST)
+# 按进程数缓存的进程池，保持预热避免每次求解都重新启动进程并导入 cv2
+_match_pools = {}
+_match_pools_lock = threading.Lock()
 
-                    # 调整背景ROI
-                    bg_resized = cv2.resize(bg_roi, (max_width, max_height),
-                                            interpolation=cv2.INTER_NEAREST)
 
-                    # 计算相似度
-                    similarity = binary_similarity(sprite_resized, bg_resized)
+def get_match_pool(workers):
+    """获取（必要时创建）指定进程数的匹配进程池"""
+    with _match_pools_lock:
+        pool = _match_pools.get(workers)
+        if pool is None:
+            # 调用方通常是多线程的签到任务，fork 可能复制其他线程持有的锁，因此使用 spawn
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_worker_threads,
+                                       initargs=(thread_budget.per_process(workers),))
+            _match_pools[workers] = pool
+        return pool
 
-                    best_bg_sub_rect = bg_rect
-                else:
-                    # 检查是否需要调整rotated_roi的大小
-                    if h_r > bg_h or w_r > bg_w:
-                        # 计算新的尺寸，只缩小较大的维度
-                        new_w = min(w_r, bg_w)  # 如果w_r > bg_w则缩小宽度，否则保持
-                        new_h = min(h_r, bg_h)  # 如果h_r > bg_h则缩小高度，否则保持
-
-                        # 缩放rotated_roi
-                        rotated_roi = cv2.resize(rotated_roi, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
-                        w_r, h_r = new_w, new_h
-
-                    # 在bg_roi上滑动窗口进行比较
-                    best_bg_sub_rect, similarity = func(rotated_roi, bg_roi, bg_rect, w_r, h_r)
-
-                # 存储最佳匹配
-                all_matches.append({
-                    'sprite_idx': sprite_idx,
-                    'bg_idx': bg_idx,
-                    'angle': rotation['angle'],
-                    'similarity': similarity,
-                    'sprite_rect': sprite_data['original_region'],
-                    'bg_rect': best_bg_sub_rect,
-                    'rotated_sprite': rotated_roi
-                })
 
-    # 第二阶段：解决冲突，选择最佳匹配
+def attach_shared_memory(name):
+    """在子进程中附加到已存在的共享内存，不把它登记为本进程创建的资源"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.13 之前没有 track 参数；spawn 出的子进程与父进程共用同一个 resource_tracker，
+        # 重复登记同名资源不会产生影响，由父进程 unlink 时统一注销
+        return shared_memory.SharedMemory(name=name)
+
+
+def match_sprite_worker(task):
+    """
+    进程池中执行的单个sprite匹配任务
+
+    背景掩码和旋转模板库通过共享内存传入，返回不含图像的匹配结果元组
+    (bg_idx, 旋转索引, 相似度, 最佳匹配矩形) 列表、各阶段耗时和各项计数
+    """
+    bg_shm = attach_shared_memory(task['bg_name'])
+    bank_shm = attach_shared_memory(task['bank_name'])
+    try:
+        preprocessed_bg = np.ndarray(task['bg_shape'], dtype=np.uint8, buffer=bg_shm.buf)
+        offset, size = task['bank_range']
+        bank = np.ndarray((size,), dtype=np.uint8, buffer=bank_shm.buf, offset=offset)
+
+        angles, sizes, aspect_ratios, packed, alias_angles, alias_index = task['rotations']
+        rotations = RotationSet(angles, sizes, aspect_ratios, bank, packed, alias_angles, alias_index)
+
+        sprite_data = {'original_region': task['original_region'], 'rotations': rotations}
+        timings = {}
+        counts = {}
+        matches = collect_sprite_matches(task['sprite_idx'], sprite_data, task['bg_indices'],
+                                         task['bg_black_regions'], preprocessed_bg, task['method'],
+                                         task['search_options'], None, timings, counts)
+        results = [(match.bg_idx, match.rot_idx, match.similarity, match.bg_rect) for match in matches]
+
+        # 关闭共享内存前必须释放所有指向它的数组视图
+        del preprocessed_bg, bank, rotations, sprite_data, matches
+        return results, timings, counts
+    finally:
+        bg_shm.close()
+        bank_shm.close()
+
+
+def parallel_sprite_matches(bg_black_regions, preprocessed_bg, rotation_data, candidate_bgs, method,
+                            search_options, workers, timings=None, counts=None):
+    """
+    将每个sprite的匹配分发到进程池中并行执行
+
+    背景掩码和所有sprite的旋转模板缓冲区分别写入一块共享内存，子进程直接映射使用而不经过pickle。
+    返回的匹配按sprite顺序拼接，与串行执行的结果完全相同。
+    """
+    preprocessed_bg = np.ascontiguousarray(preprocessed_bg, dtype=np.uint8)
+
+    # 将所有sprite的 RotationSet 缓冲区依次写入同一块共享内存
+    bank_ranges = []
+    offset = 0
+    for sprite_data in rotation_data:
+        size = sprite_data['rotations'].bank.nbytes
+        bank_ranges.append((offset, size))
+        offset += size
+
+    bg_shm = shared_memory.SharedMemory(create=True, size=max(preprocessed_bg.nbytes, 1))
+    bank_shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        np.ndarray(preprocessed_bg.shape, dtype=np.uint8, buffer=bg_shm.buf)[:] = preprocessed_bg
+        bank = np.ndarray((offset,), dtype=np.uint8, buffer=bank_shm.buf)
+        for sprite_data, (start, size) in zip(rotation_data, bank_ranges):
+            bank[start:start + size] = sprite_data['rotations'].bank
+        del bank
+
+        tasks = [{
+            'bg_name': bg_shm.name,
+            'bg_shape': preprocessed_bg.shape,
+            'bank_name': bank_shm.name,
+            'bank_range': bank_ranges[sprite_idx],
+            'sprite_idx': sprite_idx,
+            'original_region': sprite_data['original_region'],
+            'rotations': (sprite_data['rotations'].angles, sprite_data['rotations'].sizes,
+                          sprite_data['rotations'].aspect_ratios, sprite_data['rotations'].packed,
+                          sprite_data['rotations'].alias_angles, sprite_data['rotations'].alias_index),
+            'bg_indices': list(candidate_bgs[sprite_idx]),
+            'bg_black_regions': [tuple(rect) for rect in bg_black_regions],
+            'method': method,
+            'search_options': search_options
+        } for sprite_idx, sprite_data in enumerate(rotation_data)]
+
+        results = list(get_match_pool(workers).map(match_sprite_worker, tasks))
+    finally:
+        bg_shm.close()
+        bg_shm.unlink()
+        bank_shm.close()
+        bank_shm.unlink()
+
+    # 在父进程中还原完整的匹配信息
+    func = MATCH_FUNCTIONS.get(method, None)
+    all_matches = []
+    for sprite_idx, (sprite_results, sprite_timings, sprite_counts) in enumerate(results):
+        sprite_data = rotation_data[sprite_idx]
+        for bg_idx, rot_idx, similarity, best_bg_sub_rect in sprite_results:
+            fit_size = None if func is None else tuple(bg_black_regions[bg_idx][2:])
+            all_matches.append(Match(sprite_idx, bg_idx, sprite_data['rotations'], rot_idx, similarity,
+                                     sprite_data['original_region'], best_bg_sub_rect, fit_size))
+        if timings is not None:
+            for key, value in sprite_timings.items():
+                timings[key] = timings.get(key, 0.0) + value
+        if counts is not None:
+            for key, value in sprite_counts.items():
+                counts[key] = counts.get(key, 0) + value
+
+    return all_matches
+
+
+# 冲突解决方式，可通过环境变量 ICR_ASSIGNMENT 设置，见 match_sprite_to_background
+ASSIGNMENT = os.getenv("ICR_ASSIGNMENT", "greedy")
+
+
+def linear_assignment(cost):
+    """
+    求解矩形代价矩阵的最小代价完全匹配（匈牙利算法，最短增广路实现）
+
+    参数:
+        cost: 形状为 (n, m) 的代价矩阵，n <= m 时每一行分配到不同的列，否则每一列分配到不同的行
+
+    返回:
+        (行索引数组, 列索引数组)，按行索引升序
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = linear_assignment(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+
+    n, m = cost.shape
+    # 行势 u、列势 v，列 j 匹配到的行为 row_of[j]-1（0表示未匹配），下标0为虚拟列
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        min_v = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            # 更新所有未使用列的最短距离
+            free = ~used
+            free[0] = False
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improve = free[1:] & (reduced < min_v[1:])
+            min_v[1:][improve] = reduced[improve]
+            way[1:][improve] = j0
+
+            candidates = np.where(free[1:], min_v[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_v[free] -= delta
+
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+
+        # 沿增广路翻转匹配
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
+
+    cols = np.nonzero(row_of[1:])[0]
+    rows = row_of[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def assign_matches(all_matches, sprite_count, bg_count, unique_bg=True, assignment='greedy'):
+    """
+    从候选匹配中为每个sprite选出一个背景区域（match_sprite_to_background 的第二阶段）
+
+    参数:
+        all_matches: 候选匹配列表，每个(sprite, 背景区域)组合只需保留最佳角度
+        sprite_count: sprite区域数量
+        bg_count: 背景区域数量
+        unique_bg: 贪心模式下是否禁止多个sprite使用同一个背景区域
+        assignment: "greedy" 按相似度从高到低依次选择不冲突的匹配；
+            "optimal" 求相似度总和最大且背景区域互不相同的分配；
+            两种方式下分不到不同区域的sprite都退回到各自得分最高的区域
+
+    返回:
+        按 sprite_idx 排序的最终匹配列表
+    """
     final_matches = []
+
+    if assignment == 'optimal':
+        if not all_matches:
+            return final_matches
+
+        # sprite × 背景区域 得分矩阵，未评估的组合不能被选中
+        cells = {}
+        scores = np.full((sprite_count, bg_count), -np.inf)
+        for match in all_matches:
+            key = (match.sprite_idx, match.bg_idx)
+            if key not in cells or match.similarity > cells[key].similarity:
+                cells[key] = match
+                scores[key] = match.similarity
+
+        valid = np.isfinite(scores)
+        # 不可用组合给一个比任何真实组合都差的代价，求解后再丢弃
+        penalty = (np.abs(scores[valid]).max() + 1) * (sprite_count + 1)
+        cost = np.where(valid, -scores, penalty)
+        assigned = {}
+        for sprite_idx, bg_idx in zip(*linear_assignment(cost)):
+            if valid[sprite_idx, bg_idx]:
+                assigned[int(sprite_idx)] = cells[(int(sprite_idx), int(bg_idx))]
+
+        # 背景区域比sprite少或预筛选后没有可用的不同区域时，剩下的sprite使用各自得分最高的区域(允许与其他sprite共用)，
+        # 保证每个有候选的sprite都有结果，否则验证码无法提交
+        for sprite_idx in range(sprite_count):
+            if sprite_idx not in assigned and valid[sprite_idx].any():
+                assigned[sprite_idx] = cells[(sprite_idx, int(np.argmax(scores[sprite_idx])))]
+        return [assigned[sprite_idx] for sprite_idx in sorted(assigned)]
+
     used_bg_regions = set()
     used_sprites = set()
 
     # 按相似度降序排序所有匹配
-    all_matches.sort(key=lambda x_: -x_['similarity'])
+    all_matches.sort(key=lambda x_: -x_.similarity)
 
     # 遍历排序后的匹配，选择最佳且不冲突的
     for match in all_matches:
-        sprite_idx = match['sprite_idx']
-        bg_idx = match['bg_idx']
+        sprite_idx = match.sprite_idx
+        bg_idx = match.bg_idx
 
         # 如果sprite已被使用，跳过
         if sprite_idx in used_sprites:
             continue
 
         # 如果不使用滑动窗口匹配，跳过同一个背景区域
-        if func is None and bg_idx in used_bg_regions:
+        if unique_bg and bg_idx in used_bg_regions:
             continue
 
         # 添加到最终匹配结果
@@ -615,15 +2288,127 @@ def match_sprite_to_background(bg_black_regions, preprocessed_bg, rotation_data,
         used_bg_regions.add(bg_idx)
 
         # 如果所有sprite或背景区域都已匹配，提前退出
-        if len(used_sprites) == len(rotation_data):
+        if len(used_sprites) == sprite_count:
             break
 
-        if func is None and len(used_bg_regions) == len(bg_black_regions):
+        if unique_bg and len(used_bg_regions) == bg_count:
             break
 
+    # 背景区域比sprite少或预筛选后剩下的区域都已被占用时，剩下的sprite使用各自得分最高的区域(允许共用)，
+    # 与 "optimal" 相同，保证每个有候选的sprite都有结果
+    for match in all_matches:
+        if match.sprite_idx not in used_sprites:
+            final_matches.append(match)
+            used_sprites.add(match.sprite_idx)
+
     # 按照 sprite_idx 从小到大排序
-    final_matches = sorted(final_matches, key=lambda x: x.get('sprite_idx', 'inf'))
+    return sorted(final_matches, key=lambda x: x.sprite_idx)
+
+
+def match_sprite_to_background(bg_black_regions, preprocessed_bg, rotation_data, method='template',
+                               coarse_step=23, coarse_top_k=3, pyramid_levels=2, pyramid_top_k=5, timings=None,
+                               prefilter_keep=None, prefilter_max_distance=None, workers=None, counts=None,
+                               assignment=None, early_exit=None, angle_order=None):
+    """
+    将sprite区域与背景黑色区域进行匹配
+
+    参数:
+        bg_black_regions: 背景中的黑色区域列表
+        preprocessed_bg: 预处理后的二值化背景图像
+        rotation_data: sprite旋转分析数据
+        method: 匹配背景块方法
+            "template": 对每个角度使用模板匹配
+            "coarse": 先在粗角度网格上模板匹配，再在最佳候选附近逐级细化到1度
+            "fft": 在频域中批量计算全部角度的归一化相关，得分等价于 "template"
+            "pyramid": 先在缩小的背景和模板上搜索候选，再逐层提高分辨率重新评分
+            "brute": 逐像素滑动窗口比较
+            "vectorized": 与 "brute" 结果相同的向量化实现
+            None: 缩放到相同尺寸后直接比较
+        coarse_step: "coarse" 模式下粗搜索的角度间隔
+        coarse_top_k: "coarse" 模式下每个sprite每一级进入细化的候选数量
+        pyramid_levels: "pyramid" 模式下的金字塔层数
+        pyramid_top_k: "pyramid" 模式下每层保留的候选数量
+        timings: 如果提供字典，"pyramid" 模式会将每层耗时(秒)写入其中
+        prefilter_keep: 形状预筛选时每个sprite保留的背景区域数量，与 prefilter_max_distance 都为None时不预筛选。
+            Hu矩区分度有限，预筛选会降低识别率（30个3图标合成验证码上 keep=1/2/3 分别为 20/24/29，不筛选为 29），
+            只适合对速度要求高于准确率的场景
+        prefilter_max_distance: 形状预筛选的描述子距离上限。合成验证码上正确组合的距离最大达到 13，
+            超过几乎所有错误组合，不存在只剔除错误组合的取值
+        workers: 匹配进程数，大于0时每个sprite分发到预热的进程池中匹配，0表示在当前进程串行匹配，
+            None表示使用 MATCH_WORKERS
+        counts: 如果提供字典，将匹配次数等计数累加到其中，见 collect_sprite_matches
+        assignment: 冲突解决方式，None表示使用 ASSIGNMENT
+            "greedy": 按相似度从高到低依次选择，滑动窗口类方法允许多个sprite落在同一背景区域
+            "optimal": 在 sprite×背景区域 得分矩阵上求线性分配，背景区域互不相同且相似度总和最大
+            两种方式下背景区域不够分时，剩下的sprite都使用各自得分最高的区域，结果数量与有候选的sprite数量相同
+        early_exit: 提前退出阈值(相似度百分比)，"template"、"brute"、"vectorized" 和 None 模式下
+            某个角度的相似度达到该值后不再评估同一背景区域的其余角度；None表示使用 EARLY_EXIT
+        angle_order: 提前退出模式下的角度评估顺序，可以是角度序列或 AngleHistogram，
+            None表示使用全局的 angle_histogram
+
+    返回:
+        按 sprite 顺序排列的 Match 列表，每个 Match 记录背景区域、角度、相似度、匹配矩形和次优相似度(runner_up)
+    """
+    func = MATCH_FUNCTIONS.get(method, None)
 
+    # 存储所有可能的匹配（包括冲突的）
+    all_matches = []
+
+    # "fft" 模式下每个背景区域只变换一次，在所有sprite之间复用
+    prepared_bgs = {}
+
+    # 预筛选：用旋转不变的形状描述子剔除明显不可能的组合
+    all_bg_indices = list(range(len(bg_black_regions)))
+    if (prefilter_keep is not None or prefilter_max_distance is not None) and bg_black_regions:
+        bg_descriptors = [shape_descriptor(preprocessed_bg[y:y + h, x:x + w]) for x, y, w, h in bg_black_regions]
+        sprite_descriptors = []
+        for sprite_data in rotation_data:
+            # 与背景区域一样使用未旋转的二值化区域（0度条目只做了紧密裁剪）
+            rot_idx = sprite_data['rotations'].index_of(0)
+            if rot_idx is not None:
+                sprite_descriptors.append(shape_descriptor(sprite_data['rotations'].image(rot_idx)))
+            else:
+                sprite_descriptors.append(np.zeros(7))
+        candidate_bgs, pruned = prefilter_pairs(sprite_descriptors, bg_descriptors,
+                                                prefilter_keep, prefilter_max_distance)
+        logger.info(f"形状预筛选剔除了 {pruned}/{len(rotation_data) * len(bg_black_regions)} 个 sprite×背景区域 组合")
+    else:
+        candidate_bgs = [all_bg_indices] * len(rotation_data)
+
+    search_options = {
+        'coarse_step': coarse_step,
+        'coarse_top_k': coarse_top_k,
+        'pyramid_levels': pyramid_levels,
+        'pyramid_top_k': pyramid_top_k,
+        'early_exit': early_exit if early_exit is not None else EARLY_EXIT,
+        'angle_order': None
+    }
+    if search_options['early_exit'] is not None:
+        # 只传递角度列表，进程池中的任务不需要整个直方图对象
+        order = angle_order if angle_order is not None else angle_histogram
+        search_options['angle_order'] = order.order() if isinstance(order, AngleHistogram) else list(order)
+
+    # 第一阶段：收集所有可能的匹配
+    if workers is None:
+        workers = MATCH_WORKERS
+    if workers > 0 and rotation_data:
+        all_matches = parallel_sprite_matches(bg_black_regions, preprocessed_bg, rotation_data, candidate_bgs,
+                                              method, search_options, workers, timings, counts)
+    else:
+        for sprite_idx, sprite_data in enumerate(rotation_data):
+            all_matches.extend(collect_sprite_matches(
+                sprite_idx, sprite_data, candidate_bgs[sprite_idx], bg_black_regions, preprocessed_bg,
+                method, search_options, prepared_bgs, timings, counts))
+
+    # 第二阶段：解决冲突，选择最佳匹配
+    final_matches = assign_matches(all_matches, len(rotation_data), len(bg_black_regions), func is None,
+                                   assignment or ASSIGNMENT)
+
+    # 记录每个最终匹配的次优候选，用于计算置信度差距
+    for match in final_matches:
+        others = [float(other.similarity) for other in all_matches
+                  if other.sprite_idx == match.sprite_idx and other.bg_idx != match.bg_idx]
+        match.runner_up = max(others) if others else None
     return final_matches
 
 
@@ -641,12 +2426,12 @@ def display_matches_on_background(original_bg, matches):
     # 为每个匹配绘制信息
     for match in matches:
         # 绘制背景区域矩形
-        bg_x, bg_y, bg_w, bg_h = match['bg_rect']
+        bg_x, bg_y, bg_w, bg_h = match.bg_rect
         cv2.rectangle(bg_with_matches, (bg_x, bg_y),
                       (bg_x + bg_w, bg_y + bg_h), (0, 255, 0), 2)
 
         # 添加文本信息
-        text = f"Sprite {match['sprite_idx'] + 1} (Angle: {match['angle']} deg, Sim: {match['similarity']:.1f}%)"
+        text = f"Sprite {match.sprite_idx + 1} (Angle: {match.angle} deg, Sim: {match.similarity:.1f}%)"
         cv2.putText(bg_with_matches, text, (bg_x, bg_y - 10),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
 
@@ -687,29 +2472,100 @@ def display_match_comparisons(original_bg, original_sprite, matches):
 
     for i, match in enumerate(matches):
         # 显示sprite区域
-        sprite_x, sprite_y, sprite_w, sprite_h = match['sprite_rect']
+        sprite_x, sprite_y, sprite_w, sprite_h = match.sprite_rect
         sprite_roi = original_sprite[sprite_y:sprite_y + sprite_h, sprite_x:sprite_x + sprite_w]
         axes[i, 0].imshow(cv2.cvtColor(sprite_roi, cv2.COLOR_BGR2RGB))
-        axes[i, 0].set_title(f'Sprite {match["sprite_idx"] + 1} (Original)')
+        axes[i, 0].set_title(f'Sprite {match.sprite_idx + 1} (Original)')
         axes[i, 0].axis('off')
 
         # 显示旋转后的sprite
-        rotated_sprite = cv2.cvtColor(match['rotated_sprite'], cv2.COLOR_GRAY2BGR)
+        rotated_sprite = cv2.cvtColor(match.rotated_sprite, cv2.COLOR_GRAY2BGR)
         axes[i, 1].imshow(rotated_sprite)
-        axes[i, 1].set_title(f'Rotated {match["angle"]}°')
+        axes[i, 1].set_title(f'Rotated {match.angle}°')
         axes[i, 1].axis('off')
 
         # 显示匹配的背景区域
-        bg_x, bg_y, bg_w, bg_h = match['bg_rect']
+        bg_x, bg_y, bg_w, bg_h = match.bg_rect
         bg_roi = original_bg[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w]
         axes[i, 2].imshow(cv2.cvtColor(bg_roi, cv2.COLOR_BGR2RGB))
-        axes[i, 2].set_title(f'Matched BG Region\nSimilarity: {match["similarity"]:.1f}%')
+        axes[i, 2].set_title(f'Matched BG Region\nSimilarity: {match.similarity:.1f}%')
         axes[i, 2].axis('off')
 
     plt.tight_layout()
     plt.show()
 
 
+class SolveStats:
+    """
+    单次识别的统计信息，传给 main / find_part_positions 后由其填充
+
+    timings 记录各阶段耗时(秒)：preprocess(加载与预处理)、regions(区域提取)、rotation(旋转分析)、
+    matching(匹配)，以及 "pyramid" 模式下的 pyramid_level_<n>、旋转缓存命中省下的 cache_saved(不计入总耗时)；
+    counts 记录 contours(轮廓数)、merged_regions(合并后的区域数)、rotations(去重后的旋转模板数)、
+    rotation_angles(旋转模板覆盖的角度数)、match_calls(滑动窗口匹配/直接比较次数)、
+    fft_templates(批量频域相关的模板数)、cache_hits / cache_misses(旋转缓存命中与未命中的sprite区域数)，solve_image_batch 中复用了同一批其他任务结果时还有
+    shared_sprite、shared_background；dedup_ratios 为每个sprite合并或剪枝掉的角度比例。
+    不传入时不会进行任何计时和计数。
+    """
+
+    STAGES = ('preprocess', 'regions', 'rotation', 'matching')
+
+    def __init__(self, callback=None):
+        """
+        参数:
+            callback: 每个阶段结束时调用 callback(阶段名, 耗时秒数)
+        """
+        self.timings = {}
+        self.counts = {}
+        # 各sprite匹配到的旋转角度，识别成功后可记录到 AngleHistogram
+        self.angles = []
+        self.dedup_ratios = []
+        # 各sprite的置信度、与次优候选的相似度差和整体得分，见 solve_score
+        self.confidences = []
+        self.margins = []
+        self.score = None
+        self.callback = callback
+
+    def add_time(self, stage: str, seconds: float):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+    @property
+    def total(self) -> float:
+        """四个主要阶段的总耗时(秒)"""
+        return sum(self.timings.get(stage, 0.0) for stage in self.STAGES)
+
+    def as_dict(self) -> dict:
+        return {
+            'timings_ms': {key: round(value * 1000, 3) for key, value in self.timings.items()},
+            'total_ms': round(self.total * 1000, 3),
+            'counts': dict(self.counts),
+            'dedup_ratios': list(self.dedup_ratios),
+            'score': self.score
+        }
+
+    def summary(self) -> str:
+        """适合写入日志的一行摘要"""
+        stages = ", ".join(f"{stage} {self.timings[stage] * 1000:.1f}ms"
+                           for stage in self.STAGES if stage in self.timings)
+        counts = ", ".join(f"{key}={value}" for key, value in self.counts.items())
+        dedup = f"; 旋转去重比例 {self.dedup_ratios}" if any(self.dedup_ratios) else ""
+        score = f"; 得分 {self.score:.3f}" if self.score is not None else ""
+        cache = ""
+        lookups = self.counts.get('cache_hits', 0) + self.counts.get('cache_misses', 0)
+        if lookups:
+            cache = (f"; 旋转缓存命中 {self.counts.get('cache_hits', 0)}/{lookups}，"
+                     f"节省 {self.timings.get('cache_saved', 0.0) * 1000:.1f}ms")
+        pipeline = ""
+        if 'critical_path' in self.timings:
+            # main_pipelined 记录的下载耗时：顺序执行时关键路径为两次下载加上全部识别阶段
+            sequential = self.timings['fetch_bg'] + self.timings['fetch_sprite'] + self.total
+            pipeline = (f"; 流水线关键路径 {self.timings['critical_path'] * 1000:.1f}ms "
+                        f"(顺序执行约 {sequential * 1000:.1f}ms)")
+        return f"总耗时 {self.total * 1000:.1f}ms ({stages}); {counts}{dedup}{score}{cache}{pipeline}"
+
+
 def preprocess_mask(img, scale_factor: Union[int, float] = 4, kernel_size=2, iterations=1):
     # 创建膨胀核
     kernel = np.ones((kernel_size, kernel_size), np.uint8)
@@ -734,31 +2590,312 @@ def preprocess_mask(img, scale_factor: Union[int, float] = 4, kernel_size=2, ite
     return img
 
 
-def main(bg_data, sprite_data, match_method='template', show_results=False, show_preprocessed=False):
+class ThreadBudget:
+    """
+    OpenCV 线程预算
+
+    cv2.setNumThreads 对整个进程生效，matchTemplate、warpAffine、resize 默认按全部核心数并行。
+    多个签到线程同时识别时按正在进行的识别数平分预算，避免与 Chrome 一起造成 CPU 过度订阅。
+
+    参数:
+        total: 本进程 OpenCV 可用的线程总数，0表示不管理，使用 OpenCV 默认值
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def threads_for(self, active: int) -> int:
+        """active 个识别同时进行时每个识别可用的线程数"""
+        return max(1, self.total // max(1, active))
+
+    def per_process(self, processes: int) -> int:
+        """平分给 processes 个子进程后每个子进程的预算，不管理时返回0"""
+        return max(1, self.total // max(1, processes)) if self.total else 0
+
+    def acquire(self):
+        if not self.total:
+            return
+        with self._lock:
+            self.active += 1
+            cv2.setNumThreads(self.threads_for(self.active))
+
+    def release(self):
+        if not self.total:
+            return
+        with self._lock:
+            self.active -= 1
+            cv2.setNumThreads(self.threads_for(self.active))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def limit(self, func):
+        """装饰器：调用期间占用一份线程预算；只需在部分代码中占用时使用 with thread_budget:"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.release()
+
+        return wrapper
+
+
+# OpenCV 线程总预算，可通过环境变量 ICR_CV_THREADS 设置，默认为CPU核心数，0表示不管理
+thread_budget = ThreadBudget(int(os.getenv("ICR_CV_THREADS", str(os.cpu_count() or 1))))
+
+
+def init_worker_threads(total: int):
+    """进程池 initializer：设置子进程的线程预算，total 为 ThreadBudget.per_process 的结果"""
+    thread_budget.total = total
+    if total:
+        cv2.setNumThreads(total)
+
+
+# main 中预处理与区域提取参数的默认值，可以用 benchmarks/tune_profile.py 在标注数据上搜索更优的组合
+DEFAULT_PROFILE = {
+    'sprite_scale': 1.55,  # sprite 图放大倍数
+    'bg_threshold': 25,  # 背景图二值化阈值
+    'sprite_threshold': 30,  # sprite 图二值化阈值
+    'bg_mask_scale': 4,  # 背景掩码降采样倍数
+    'mask_kernel': 2,  # 掩码膨胀核大小
+    'bg_min_area': 50,  # 背景区域最小面积
+    'sprite_min_area': 100,  # sprite 区域最小面积
+    'merge_distance': 5,  # 背景区域合并距离
+    'max_bg_regions': 10,  # 参与匹配的最大背景区域数
+    'max_angle': 45,  # 旋转角度范围
+    'symmetry_iou': 0.0  # 旋转对称剪枝的交并比阈值，0表示不剪枝
+}
+
+# 命名参数配置文件(JSON，配置名到参数字典的映射)，可通过环境变量 ICR_PROFILE_FILE 指定
+PROFILE_FILE = Path(os.getenv("ICR_PROFILE_FILE") or Path(__file__).with_name("icr_profiles.json"))
+# 未指定 profile 时使用的配置名，可通过环境变量 ICR_PROFILE 指定
+PROFILE = os.getenv("ICR_PROFILE", "default")
+
+_profiles = {'mtime': None, 'profiles': {}}
+_profiles_lock = threading.Lock()
+
+
+def load_profiles(path: Optional[Union[str, Path]] = None) -> dict:
+    """读取命名参数配置文件，文件不存在时返回空字典；默认文件按修改时间缓存"""
+    if path is not None:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    try:
+        mtime = PROFILE_FILE.stat().st_mtime
+    except OSError:
+        return {}
+    with _profiles_lock:
+        if _profiles['mtime'] != mtime:
+            _profiles['profiles'] = json.loads(PROFILE_FILE.read_text(encoding="utf-8"))
+            _profiles['mtime'] = mtime
+        return _profiles['profiles']
+
+
+def load_profile(profile: Optional[Union[str, dict]] = None) -> dict:
+    """
+    解析参数配置
+
+    参数:
+        profile: 配置名(内置的 "default" 或 PROFILE_FILE 中的名字)、参数字典(未给出的参数使用默认值)，
+            None表示使用 PROFILE
+
+    返回:
+        包含 DEFAULT_PROFILE 全部参数的字典
+
+    异常:
+        KeyError: 配置名不存在或包含未知参数
+    """
+    if profile is None:
+        profile = PROFILE
+    if isinstance(profile, str):
+        if profile == "default":
+            return dict(DEFAULT_PROFILE)
+        profiles = load_profiles()
+        if profile not in profiles:
+            raise KeyError(f"未知的参数配置: {profile}")
+        profile = profiles[profile]
+
+    unknown = set(profile) - set(DEFAULT_PROFILE)
+    if unknown:
+        raise KeyError(f"未知的参数: {', '.join(sorted(unknown))}")
+    return {**DEFAULT_PROFILE, **profile}
+
+
+def _add_time(timings: dict, stage: str, start_time: float):
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start_time
+
+
+def prepare_background(bg_data, params: dict, timings: Optional[dict] = None, counts: Optional[dict] = None):
+    """
+    加载并预处理背景图，提取背景区域（main 中不依赖 sprite 图的部分）
+
+    参数:
+        bg_data: 背景图像数据，见 load_image
+        params: load_profile 返回的参数字典
+        timings: 如果提供字典，将 preprocess、regions 阶段耗时(秒)累加到其中
+        counts: 如果提供字典，将区域提取的计数累加到其中
+
+    返回:
+        (原始背景图, 预处理后的背景掩码, 背景区域列表)
+    """
+    if timings is not None:
+        start_time = time.perf_counter()
+
     # 加载原始背景图像
     original_bg = load_image(bg_data)
+    if original_bg is None:
+        raise ValueError("背景图加载失败，请检查输入数据是否正确")
+
+    # 预处理图像
+    bg_mask = load_and_preprocess(original_bg, params['bg_threshold'])
+    bg_mask = preprocess_mask(bg_mask, params['bg_mask_scale'], params['mask_kernel'])
+    if timings is not None:
+        _add_time(timings, 'preprocess', start_time)
+
+    # 提取背景图像中的黑色区域并合并重叠的（默认选取最大的10个）
+    if timings is not None:
+        start_time = time.perf_counter()
+    bg_black_regions = extract_black_regions(bg_mask, params['bg_min_area'], merge_distance=params['merge_distance'],
+                                             counts=counts)[:params['max_bg_regions']]
+    if timings is not None:
+        _add_time(timings, 'regions', start_time)
+
+    return original_bg, bg_mask, bg_black_regions
+
+
+def prepare_sprite(sprite_data, params: dict, use_cache=True, timings: Optional[dict] = None,
+                   counts: Optional[dict] = None):
+    """
+    加载并预处理 sprite 图，提取 sprite 区域并做旋转分析（main 中不依赖背景图的部分）
+
+    参数:
+        sprite_data: sprite图像数据，见 load_image
+        params: load_profile 返回的参数字典
+        use_cache: 是否使用旋转结果缓存
+        timings: 如果提供字典，将 preprocess、regions、rotation 阶段耗时(秒)累加到其中
+        counts: 如果提供字典，将区域提取和旋转模板的计数累加到其中
+
+    返回:
+        (放大后的原始sprite图, 预处理后的sprite掩码, sprite区域列表, 旋转分析数据)
+    """
+    if timings is not None:
+        start_time = time.perf_counter()
 
     # 加载Sprite图像
     original_sprite = load_image(sprite_data)
+    if original_sprite is None:
+        raise ValueError("sprite图加载失败，请检查输入数据是否正确")
 
     height, width = original_sprite.shape[:2]
     original_sprite = cv2.resize(
         original_sprite,
-        (int(width * 1.55), int(height * 1.55)),
+        (int(width * params['sprite_scale']), int(height * params['sprite_scale'])),
         interpolation=cv2.INTER_NEAREST
     )
 
     # 预处理图像
-    bg_mask = load_and_preprocess(original_bg, 25)
-    sprite_mask = load_and_preprocess(original_sprite)
+    sprite_mask = load_and_preprocess(original_sprite, params['sprite_threshold'])
+    sprite_mask = preprocess_mask(sprite_mask, 1, params['mask_kernel'])
+    if timings is not None:
+        _add_time(timings, 'preprocess', start_time)
+
+    # 提取Sprite图像中的黑色区域
+    if timings is not None:
+        start_time = time.perf_counter()
+    sprite_black_regions = extract_black_regions(sprite_mask, params['sprite_min_area'], sort_mode="position-l",
+                                                 counts=counts)
+    if timings is not None:
+        _add_time(timings, 'regions', start_time)
+
+    # 分析旋转后的sprite区域
+    if timings is not None:
+        start_time = time.perf_counter()
+    rotation_data = analyze_rotated_regions(sprite_mask, sprite_black_regions,
+                                            rotation_cache if use_cache else None, max_angle=params['max_angle'],
+                                            symmetry_iou=params['symmetry_iou'], counts=counts, timings=timings)
+    if timings is not None:
+        _add_time(timings, 'rotation', start_time)
 
-    bg_mask = preprocess_mask(bg_mask)
-    sprite_mask = preprocess_mask(sprite_mask, 1)
+    if counts is not None:
+        counts['rotations'] = counts.get('rotations', 0) + sum(len(data['rotations']) for data in rotation_data)
+        counts['rotation_angles'] = counts.get('rotation_angles', 0) + sum(
+            len(data['rotations'].alias_angles) for data in rotation_data)
+
+    return original_sprite, sprite_mask, sprite_black_regions, rotation_data
+
+
+def match_prepared(background, sprite, params: dict, match_method='template', show_results=False,
+                   stats: Optional[SolveStats] = None, **match_options):
+    """
+    匹配 prepare_background 和 prepare_sprite 的结果（main 的最后阶段）
+
+    返回:
+        按 sprite 顺序排列的匹配结果列表，sprite_rect 已换算回原始 sprite 图的坐标
+    """
+    original_bg, bg_mask, bg_black_regions = background
+    original_sprite, _, _, rotation_data = sprite
+
+    if stats is not None:
+        match_options.setdefault('timings', stats.timings)
+        match_options['counts'] = stats.counts
+        stats.dedup_ratios = [round(data['rotations'].dedup_ratio, 4) for data in rotation_data]
+        start_time = time.perf_counter()
+
+    # 匹配sprite到背景区域
+    matches = match_sprite_to_background(bg_black_regions, bg_mask, rotation_data, match_method, **match_options)
+
+    if stats is not None:
+        stats.add_time('matching', time.perf_counter() - start_time)
+        stats.angles = [match.angle for match in matches]
+        stats.confidences = [round(match.confidence, 4) for match in matches]
+        stats.margins = [round(match.margin, 3) for match in matches]
+        stats.score = round(solve_score(matches, len(rotation_data)), 4)
+
+    # 显示匹配结果
+    if show_results:
+        display_matches_on_background(original_bg, matches)
+        display_match_comparisons(original_bg, original_sprite, matches)
+
+    for match in matches:
+        original_tuple = match.sprite_rect
+        scaled_tuple = tuple(int(x // params['sprite_scale']) for x in original_tuple)
+        match.sprite_rect = scaled_tuple
+
+    return matches
+
+
+@thread_budget.limit
+def main(bg_data, sprite_data, match_method='template', show_results=False, show_preprocessed=False,
+         use_cache=True, stats: Optional[SolveStats] = None, profile: Optional[Union[str, dict]] = None,
+         **match_options):
+    params = load_profile(profile)
+    timings = {} if stats is not None else None
+    counts = stats.counts if stats is not None else None
+
+    background = prepare_background(bg_data, params, timings, counts)
+    sprite = prepare_sprite(sprite_data, params, use_cache, timings, counts)
+
+    if stats is not None:
+        for stage in ('preprocess', 'regions', 'rotation'):
+            stats.add_time(stage, timings[stage])
+        if 'cache_saved' in timings:
+            stats.timings['cache_saved'] = timings['cache_saved']
 
     # 如果需要显示预处理结果
     if show_preprocessed:
         import matplotlib.pyplot as plt
 
+        original_bg, bg_mask, bg_black_regions = background
+        original_sprite, sprite_mask, sprite_black_regions, rotation_data = sprite
+
         plt.figure(figsize=(12, 6))
 
         plt.subplot(1, 2, 1)
@@ -772,53 +2909,399 @@ def main(bg_data, sprite_data, match_method='template', show_results=False, show
         plt.tight_layout()
         plt.show()
 
-    # 提取背景图像中的黑色区域并合并重叠的（选取最大的10个）
-    bg_black_regions = extract_black_regions(bg_mask, 50, merge_distance=5)[:10]
-    # 提取Sprite图像中的黑色区域
-    sprite_black_regions = extract_black_regions(sprite_mask, sort_mode="position-l")
-
-    # 分析旋转后的sprite区域
-    rotation_data = analyze_rotated_regions(sprite_mask, sprite_black_regions)
-
-    if show_preprocessed:
         display_black_regions(original_bg, bg_black_regions)
         display_black_regions(original_sprite, sprite_black_regions)
 
         display_rotation_analysis(rotation_data, original_sprite)
 
-    # 匹配sprite到背景区域
-    matches = match_sprite_to_background(bg_black_regions, bg_mask, rotation_data, match_method)
+    return match_prepared(background, sprite, params, match_method, show_results, stats, **match_options)
 
-    # 显示匹配结果
-    if show_results:
-        display_matches_on_background(original_bg, matches)
-        display_match_comparisons(original_bg, original_sprite, matches)
 
-    for match in matches:
-        if 'sprite_rect' in match:
-            original_tuple = match['sprite_rect']
-            scaled_tuple = tuple(int(x // 1.55) for x in original_tuple)
-            match['sprite_rect'] = scaled_tuple
+def main_pipelined(bg_source, sprite_source, match_method='template', use_cache=True,
+                   stats: Optional[SolveStats] = None, profile: Optional[Union[str, dict]] = None,
+                   **match_options):
+    """
+    流水线求解：sprite 图在后台线程中获取并立即做预处理和旋转分析，同时背景图在当前线程中获取并预处理，
+    两边都完成后再匹配。获取图像通常是网络下载，这样背景图的处理与 sprite 图的下载重叠，
+    旋转分析也不必等背景图下载完成。结果与先获取两张图再调用 main 完全相同。
 
+    参数:
+        bg_source, sprite_source: 无参数的可调用对象，返回 load_image 支持的图像数据，例如下载函数
+        其余参数同 main；传入 SolveStats 时 timings 中额外记录 fetch_bg、fetch_sprite(获取耗时)和
+            critical_path(从开始获取到匹配完成的实际耗时)
+
+    返回:
+        匹配结果列表，与 main 相同
+    """
+    # 线程预算只在计算期间占用，等待下载时不占用，避免并发识别的计算因别的识别在等网络而分不到线程
+    from concurrent.futures import ThreadPoolExecutor
+
+    params = load_profile(profile)
+    # 两个分支各自记录耗时和计数，结束后在当前线程中合并到 stats
+    if stats is not None:
+        start_time = time.perf_counter()
+        bg_timings, bg_counts = {}, {}
+        sprite_timings, sprite_counts = {}, {}
+    else:
+        bg_timings = bg_counts = sprite_timings = sprite_counts = None
+
+    def sprite_branch():
+        if stats is not None:
+            fetch_start = time.perf_counter()
+        sprite_data = sprite_source()
+        if stats is not None:
+            _add_time(sprite_timings, 'fetch_sprite', fetch_start)
+        with thread_budget:
+            return prepare_sprite(sprite_data, params, use_cache, sprite_timings, sprite_counts)
+
+    with ThreadPoolExecutor(1, thread_name_prefix="icr-sprite") as pool:
+        sprite_future = pool.submit(sprite_branch)
+        bg_data = bg_source()
+        if stats is not None:
+            _add_time(bg_timings, 'fetch_bg', start_time)
+        with thread_budget:
+            background = prepare_background(bg_data, params, bg_timings, bg_counts)
+        sprite = sprite_future.result()
+
+    if stats is not None:
+        for key, value in list(bg_counts.items()) + list(sprite_counts.items()):
+            stats.counts[key] = stats.counts.get(key, 0) + value
+        for stage in ('preprocess', 'regions', 'rotation'):
+            stats.add_time(stage, bg_timings.get(stage, 0.0) + sprite_timings.get(stage, 0.0))
+        stats.timings['fetch_bg'] = bg_timings['fetch_bg']
+        stats.timings['fetch_sprite'] = sprite_timings['fetch_sprite']
+        if 'cache_saved' in sprite_timings:
+            stats.timings['cache_saved'] = sprite_timings['cache_saved']
+
+    with thread_budget:
+        matches = match_prepared(background, sprite, params, match_method, False, stats, **match_options)
+
+    if stats is not None:
+        stats.timings['critical_path'] = time.perf_counter() - start_time
     return matches
 
 
+# 计算整体得分时，与次优候选的相似度差达到这么多个百分点即视为没有歧义
+SCORE_MARGIN = 10.0
+
+
+def solve_score(matches, sprite_count: int) -> float:
+    """
+    整体识别得分(0~1)
+
+    每个sprite的得分为置信度乘以 min(1, 与次优候选的相似度差 / SCORE_MARGIN)，整体得分取最小值，
+    有sprite没有匹配时为0。合成验证码上识别错误的结果大多低于0.2，可用于在提交前放弃明显不可靠的结果。
+    """
+    if sprite_count == 0 or len(matches) < sprite_count:
+        return 0.0
+    return min(match.confidence * min(1.0, max(0.0, match.margin) / SCORE_MARGIN) for match in matches)
+
+
 def convert_matches_to_positions(matches):
     positions = []
     for data in matches:
-        x, y, w, h = data['bg_rect']
+        x, y, w, h = data.bg_rect
         positions.append((x + w / 2, y + h / 2))
     return positions
 
 
-def find_part_positions(bg_img, sprite_img, match_method='template'):
-    """在图像中查找所有sprite部分的位置，返回中心点坐标列表"""
+def find_part_positions(bg_img, sprite_img, match_method='template', use_cache=True,
+                        stats: Optional[SolveStats] = None, profile: Optional[Union[str, dict]] = None,
+                        **match_options):
+    """
+    在图像中查找所有sprite部分的位置，返回中心点坐标列表
+
+    额外的关键字参数(如 pyramid_levels、coarse_step 等)会传给 match_sprite_to_background，
+    传入 SolveStats 时会记录各阶段耗时、计数以及各sprite的置信度、差距和整体得分(stats.score)，
+    profile 为命名参数配置或参数字典，见 load_profile
+    """
     return convert_matches_to_positions(
-        main(bg_img, sprite_img, match_method, False, False)
+        main(bg_img, sprite_img, match_method, False, False, use_cache, stats, profile, **match_options)
     )
 
 
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def find_captcha_pairs(directory):
+    """
+    递归查找目录中的验证码图片对
+
+    文件名中包含 "captcha" 的图片与把其中的 "captcha" 替换为 "sprite" 后的同目录文件组成一对，
+    例如 temp/captcha.jpg 与 temp/sprite.jpg，或 001_captcha.png 与 001_sprite.png。
+
+    返回:
+        按路径排序的 (背景图路径, sprite图路径) 生成器
+    """
+    for bg_path in sorted(Path(directory).rglob("*captcha*")):
+        if bg_path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        sprite_path = bg_path.with_name(bg_path.name.replace("captcha", "sprite"))
+        if sprite_path.exists():
+            yield bg_path, sprite_path
+
+
+def solve_images(bg_data, sprite_data, match_method='template', use_cache=True, **match_options):
+    """
+    求解一对图片，返回可直接序列化为JSON的结果字典
+
+    返回:
+        包含 positions(中心点)、size(背景图宽高)、angles(匹配角度)、similarities(相似度)、
+        margins(与次优候选的相似度差)、score(整体得分，见 solve_score)、stats(各阶段耗时与计数) 的字典，
+        出错时只包含 error
+    """
+    try:
+        original_bg = load_image(bg_data)
+        stats = SolveStats()
+        matches = main(original_bg, sprite_data, match_method, use_cache=use_cache, stats=stats, **match_options)
+        return solve_result(original_bg, matches, stats)
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+
+def solve_result(original_bg, matches, stats: SolveStats) -> dict:
+    """将一次识别的匹配结果整理为 solve_images 返回的字典"""
+    return {
+        'positions': [[round(x, 1), round(y, 1)] for x, y in convert_matches_to_positions(matches)],
+        'size': [int(original_bg.shape[1]), int(original_bg.shape[0])],
+        'angles': [match.angle for match in matches],
+        'similarities': [round(float(match.similarity), 3) for match in matches],
+        'margins': stats.margins,
+        'score': stats.score,
+        'stats': stats.as_dict()
+    }
+
+
+def _image_key(image_data):
+    """图片数据的内容哈希，路径按文件名区分"""
+    if isinstance(image_data, np.ndarray):
+        return hashlib.sha1(image_data.tobytes()).hexdigest() + str(image_data.shape)
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return hashlib.sha1(image_data).hexdigest()
+    return str(image_data)
+
+
+@thread_budget.limit
+def solve_image_batch(tasks, callback=None) -> List[dict]:
+    """
+    求解一批图片，sprite 图片内容、参数配置和缓存设置都相同的任务只做一次 sprite 预处理和旋转分析，
+    背景图也相同时只做一次背景预处理，其余任务直接复用结果后匹配
+
+    复用的阶段只计入组内第一个任务的耗时，其余任务的 counts 中 shared_sprite / shared_background 记为1。
+
+    参数:
+        tasks: (背景图数据, sprite图数据, 匹配方法, 是否使用缓存, 传给 main 的参数字典) 列表，
+            参数字典中可以包含 profile
+        callback: 每个任务完成时立即调用 callback(任务索引, 结果字典)，不必等整批完成
+
+    返回:
+        与 tasks 一一对应的 solve_images 结果字典列表，单个任务出错时只有该任务的结果包含 error
+    """
+    results = [None] * len(tasks)
+    groups = defaultdict(list)
+    for task_idx, (_, sprite_data, _, use_cache, match_options) in enumerate(tasks):
+        profile = json.dumps(match_options.get('profile'), sort_keys=True)
+        groups[(_image_key(sprite_data), profile, use_cache)].append(task_idx)
+
+    for task_indices in groups.values():
+        first = tasks[task_indices[0]]
+        try:
+            params = load_profile(first[4].get('profile'))
+            sprite_timings, sprite_counts = {}, {}
+            sprite = prepare_sprite(first[1], params, first[3], sprite_timings, sprite_counts)
+        except Exception as e:
+            for task_idx in task_indices:
+                results[task_idx] = {'error': f"{type(e).__name__}: {e}"}
+                if callback is not None:
+                    callback(task_idx, results[task_idx])
+            continue
+
+        backgrounds = {}
+        for position, task_idx in enumerate(task_indices):
+            bg_data, _, match_method, _, match_options = tasks[task_idx]
+            match_options = {key: value for key, value in match_options.items() if key != 'profile'}
+            stats = SolveStats()
+            try:
+                timings, bg_counts = {}, {}
+                bg_key = _image_key(bg_data)
+                if bg_key in backgrounds:
+                    background, bg_counts = backgrounds[bg_key]
+                    stats.counts['shared_background'] = 1
+                else:
+                    background = prepare_background(bg_data, params, timings, bg_counts)
+                    backgrounds[bg_key] = (background, bg_counts)
+                for counts in (bg_counts, sprite_counts):
+                    for key, value in counts.items():
+                        stats.counts[key] = stats.counts.get(key, 0) + value
+                if position == 0:
+                    for stage, seconds in sprite_timings.items():
+                        timings[stage] = timings.get(stage, 0.0) + seconds
+                else:
+                    stats.counts['shared_sprite'] = 1
+                for stage in ('preprocess', 'regions', 'rotation'):
+                    stats.add_time(stage, timings.get(stage, 0.0))
+                if 'cache_saved' in timings:
+                    stats.timings['cache_saved'] = timings['cache_saved']
+
+                matches = match_prepared(background, sprite, params, match_method, stats=stats, **match_options)
+                results[task_idx] = solve_result(background[0], matches, stats)
+            except Exception as e:
+                results[task_idx] = {'error': f"{type(e).__name__}: {e}"}
+            if callback is not None:
+                callback(task_idx, results[task_idx])
+
+    return results
+
+
+def solve_pair_files(task):
+    """
+    批量求解时的单个任务：读取一对图片并求解
+
+    参数:
+        task: (背景图路径, sprite图路径, 匹配方法, 是否使用缓存, 传给 match_sprite_to_background 的参数)
+
+    返回:
+        solve_images 的结果字典，另外包含图片路径和总耗时 latency_ms
+    """
+    bg_path, sprite_path, match_method, use_cache, match_options = task
+    start_time = time.perf_counter()
+    result = {'captcha': str(bg_path), 'sprite': str(sprite_path)}
+    try:
+        result.update(solve_images(Path(bg_path).read_bytes(), Path(sprite_path).read_bytes(), match_method,
+                                   use_cache, **match_options))
+    except OSError as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['latency_ms'] = round((time.perf_counter() - start_time) * 1000, 3)
+    return result
+
+
+def latency_percentile(values, q):
+    """最近秩法百分位数"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, ceil(q / 100 * len(ordered)) - 1))]
+
+
+def solve_directory(directory, match_method='template', jobs=1, use_cache=True, output=None, as_json=False,
+                    **match_options):
+    """
+    批量求解目录中的全部验证码，逐条输出结果，最后输出吞吐量与延迟统计
+
+    参数:
+        directory: 图片目录，配对规则见 find_captcha_pairs
+        match_method: 匹配方法
+        jobs: 并行进程数，1表示在当前进程中依次求解
+        use_cache: 是否使用旋转结果缓存
+        output: 输出流，默认标准输出
+        as_json: 以JSON行输出，否则输出便于阅读的文本
+
+    返回:
+        统计信息字典
+    """
+    import sys
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    output = output or sys.stdout
+    tasks = ((bg_path, sprite_path, match_method, use_cache, match_options)
+             for bg_path, sprite_path in find_captcha_pairs(directory))
+
+    def emit(result):
+        if as_json:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        elif 'error' in result:
+            output.write(f"{result['captcha']}: 失败 {result['error']}\n")
+        else:
+            positions = ", ".join(f"({x:.0f}, {y:.0f})" for x, y in result['positions'])
+            output.write(f"{result['captcha']}: {positions} [{result['latency_ms']:.1f}ms]\n")
+        output.flush()
+
+    latencies = []
+    errors = 0
+    start_time = time.perf_counter()
+
+    def collect(result):
+        nonlocal errors
+        if 'error' in result:
+            errors += 1
+        else:
+            latencies.append(result['latency_ms'])
+        emit(result)
+
+    if jobs <= 1:
+        for task in tasks:
+            collect(solve_pair_files(task))
+    else:
+        # 最多同时提交 2 × jobs 个任务，边读取目录边求解
+        with ProcessPoolExecutor(jobs, initializer=init_worker_threads,
+                                 initargs=(thread_budget.per_process(jobs),)) as pool:
+            pending = set()
+            for task in tasks:
+                pending.add(pool.submit(solve_pair_files, task))
+                if len(pending) >= jobs * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future.result())
+            for future in pending:
+                collect(future.result())
+
+    elapsed = time.perf_counter() - start_time
+    summary = {
+        'summary': True,
+        'solved': len(latencies),
+        'errors': errors,
+        'jobs': jobs,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+        'p50_ms': latency_percentile(latencies, 50),
+        'p95_ms': latency_percentile(latencies, 95),
+        'p99_ms': latency_percentile(latencies, 99)
+    }
+    if as_json:
+        output.write(json.dumps(summary) + "\n")
+    else:
+        output.write(f"共求解 {summary['solved']} 个，失败 {errors} 个，耗时 {summary['elapsed_s']} 秒，"
+                     f"吞吐量 {summary['throughput_per_s']} 个/秒，延迟 p50/p95/p99 = "
+                     f"{summary['p50_ms']}/{summary['p95_ms']}/{summary['p99_ms']} ms\n")
+    output.flush()
+    return summary
+
+
+def cli(argv=None):
+    """命令行入口：python -m ICR solve <目录> [--jobs N] [--method template] [--json]"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m ICR", description="ICR 图标点选验证码识别")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    solve_parser = subparsers.add_parser("solve", help="批量求解目录中的验证码图片对")
+    solve_parser.add_argument("directory", help="图片目录，xxx_captcha.jpg 与 xxx_sprite.jpg 组成一对")
+    solve_parser.add_argument("--jobs", "-j", type=int, default=1, help="并行进程数")
+    solve_parser.add_argument("--method", default="template",
+                              help="匹配方法，见 match_sprite_to_background，none 表示直接比较")
+    solve_parser.add_argument("--assignment", choices=["greedy", "optimal"], help="冲突解决方式")
+    solve_parser.add_argument("--no-cache", action="store_true", help="不使用旋转结果缓存")
+    solve_parser.add_argument("--profile", help="命名参数配置，见 load_profile")
+    solve_parser.add_argument("--json", action="store_true", help="以JSON行输出")
+
+    args = parser.parse_args(argv)
+    match_options = {}
+    if args.assignment:
+        match_options['assignment'] = args.assignment
+    if args.profile:
+        match_options['profile'] = args.profile
+    method = None if args.method.lower() == "none" else args.method
+    summary = solve_directory(args.directory, method, args.jobs, not args.no_cache, None, args.json,
+                              **match_options)
+    return 1 if summary['errors'] else 0
+
+
 if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        sys.exit(cli())
+
     # 使用示例图片路径
     bg = "temp/captcha.jpg"
     sprite = "temp/sprite.jpg"
@@ -833,5 +3316,5 @@ if __name__ == "__main__":
         end_time = time.time()
         execution_time = end_time - start_time
         for info in result:
-            print(f"Sprite {info['sprite_idx']} -> {info['bg_rect']}")
+            print(f"Sprite {info.sprite_idx} -> {info.bg_rect}")
         print(f"识别耗时: {execution_time:.4f} 秒")
@@ -0,0 +1,172 @@
+"""
+ICR 准确率与耗时基准
+
+使用 synthetic.py 生成的确定性合成验证码，对每种匹配方法统计识别准确率和各阶段耗时
+(预处理、区域提取、旋转分析、匹配)，结果以 JSON 输出，便于在每次改动后比较速度和准确率。
+
+用法:
+    python benchmarks/icr_suite.py [--count 50] [--methods template fft] [--output result.json]
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+import ICR  # noqa: E402
+import synthetic  # noqa: E402
+
+STAGES = ICR.SolveStats.STAGES
+
+# 学习角度顺序时使用的种子偏移，保证训练集与测试集不重叠
+LEARN_SEED_OFFSET = 1000000
+
+
+def solve_with_stages(bg, sprite, method, use_cache=False, **match_options):
+    """调用 ICR.main 求解，返回 (中心点列表, SolveStats)"""
+    stats = ICR.SolveStats()
+    matches = ICR.main(bg, sprite, method, use_cache=use_cache, stats=stats, **match_options)
+    return ICR.convert_matches_to_positions(matches), stats
+
+
+def summarize(samples):
+    return {
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(ICR.latency_percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(ICR.latency_percentile(samples, 95) * 1000, 3)
+    }
+
+
+def learn_angle_order(method, args):
+    """在与测试集不重叠的合成验证码上统计识别成功时的匹配角度"""
+    histogram = ICR.AngleHistogram()
+    for seed in range(args.seed + LEARN_SEED_OFFSET, args.seed + LEARN_SEED_OFFSET + args.learn):
+        bg, sprite, truth = synthetic.generate(seed, args.icons)
+        positions, stats = solve_with_stages(bg, sprite, method, args.cache, assignment=args.assignment)
+        if synthetic.is_solved(positions, truth, args.tolerance):
+            histogram.record(stats.angles)
+    return histogram
+
+
+def fast_fail_report(scores, min_score, submit_seconds):
+    """
+    得分低于 min_score 时跳过提交的效果：拦截的失败数、误拦的成功数，
+    以及按每次失败提交耗时 submit_seconds 估算的每次失败平均节省秒数(误拦的成功按多一轮提交计)
+    """
+    caught = sum(score < min_score for score in scores[False])
+    rejected = sum(score < min_score for score in scores[True])
+    failures = len(scores[False])
+    return {
+        'min_score': min_score,
+        'failures_caught': caught,
+        'failures': failures,
+        'successes_rejected': rejected,
+        'successes': len(scores[True]),
+        'saved_seconds_per_failure': round((caught - rejected) * submit_seconds / failures, 3) if failures else None
+    }
+
+
+def run_method(method, cases, args):
+    solved = 0
+    stage_samples = {stage: [] for stage in STAGES}
+    totals = []
+    count_totals = {}
+    dedup_ratios = []
+    failures = []
+    scores = {True: [], False: []}
+
+    match_options = {'assignment': args.assignment, 'early_exit': args.early_exit}
+    if args.early_exit is not None and args.learn:
+        match_options['angle_order'] = learn_angle_order(method, args)
+
+    for seed, bg, sprite, truth in cases:
+        positions, stats = solve_with_stages(bg, sprite, method, args.cache, **match_options)
+        for stage in STAGES:
+            stage_samples[stage].append(stats.timings[stage])
+        totals.append(stats.total)
+        for key, value in stats.counts.items():
+            count_totals[key] = count_totals.get(key, 0) + value
+        dedup_ratios.extend(stats.dedup_ratios)
+
+        if synthetic.is_solved(positions, truth, args.tolerance):
+            solved += 1
+            scores[True].append(stats.score)
+        else:
+            failures.append(seed)
+            scores[False].append(stats.score)
+
+    return {
+        'accuracy': round(solved / len(cases), 4) if cases else None,
+        'solved': solved,
+        'count': len(cases),
+        'failed_seeds': failures,
+        'total': summarize(totals),
+        'stages': {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        'mean_counts': {key: round(value / len(cases), 2) for key, value in count_totals.items()},
+        'mean_dedup_ratio': round(statistics.fmean(dedup_ratios), 4) if dedup_ratios else None,
+        'fast_fail': fast_fail_report(scores, args.min_score, args.submit_seconds)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=50, help='合成验证码数量')
+    parser.add_argument('--seed', type=int, default=0, help='第一个验证码的种子')
+    parser.add_argument('--icons', type=int, default=3)
+    parser.add_argument('--methods', nargs='+', default=['template', 'coarse', 'fft', 'pyramid', 'vectorized', 'none'],
+                        help='要测试的匹配方法，none 表示 match_method=None')
+    parser.add_argument('--tolerance', type=float, default=15, help='中心点允许的误差(像素)')
+    parser.add_argument('--cache', action='store_true', help='使用旋转结果缓存')
+    parser.add_argument('--early-exit', type=float, help='提前退出阈值(相似度百分比)，默认使用 ICR.EARLY_EXIT')
+    parser.add_argument('--learn', type=int, default=0,
+                        help='提前退出时先在这么多个额外的合成验证码上学习角度顺序，0表示使用 ICR.angle_histogram')
+    parser.add_argument('--assignment', choices=['greedy', 'optimal'], help='冲突解决方式，默认使用 ICR.ASSIGNMENT')
+    parser.add_argument('--min-score', type=float, default=0.1, help='统计低于该得分时跳过提交的效果')
+    parser.add_argument('--submit-seconds', type=float, default=10,
+                        help='一次失败提交从点击到可以刷新所花的秒数(rainyun 中固定等待 5+5 秒)')
+    parser.add_argument('--output', help='将结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    cases = []
+    for seed in range(args.seed, args.seed + args.count):
+        bg, sprite, truth = synthetic.generate(seed, args.icons)
+        cases.append((seed, bg, sprite, truth))
+
+    # 预热：首次调用 OpenCV 各函数有额外开销
+    solve_with_stages(cases[0][1], cases[0][2], 'template')
+
+    report = {
+        'config': {
+            'count': args.count,
+            'seed': args.seed,
+            'icons': args.icons,
+            'tolerance': args.tolerance,
+            'cache': args.cache,
+            'assignment': args.assignment or ICR.ASSIGNMENT,
+            'early_exit': args.early_exit if args.early_exit is not None else ICR.EARLY_EXIT,
+            'learn': args.learn,
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__
+        },
+        'methods': {}
+    }
+    for method in args.methods:
+        report['methods'][method] = run_method(None if method == 'none' else method, cases, args)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+矩形合并微基准：比较网格索引+并查集实现与逐对合并实现在 10 到 10000 个矩形时的耗时
+
+用法:
+    python benchmarks/merge_rectangles.py [--max-pairwise 2000] [--repeat 3]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ICR  # noqa: E402
+
+
+def random_rectangles(count, seed=0):
+    """生成密度固定的随机小矩形，画布面积随数量增长，模拟噪声背景中的轮廓"""
+    rng = random.Random(seed)
+    side = int((count * 400) ** 0.5) + 50
+    return [(rng.randint(0, side), rng.randint(0, side), rng.randint(1, 12), rng.randint(1, 12))
+            for _ in range(count)]
+
+
+def measure(func, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--max-pairwise', type=int, default=2000, help='超过此数量时跳过逐对合并实现')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--distance', type=int, default=5, help='merge_close_rectangles 的合并距离')
+    args = parser.parse_args()
+
+    # 直接调用 cluster_rectangles，避免数量较少时 merge_* 自动退回逐对合并
+    cases = [
+        ('merge_rectangles',
+         lambda r: ICR.cluster_rectangles(r, ICR.should_merge),
+         lambda r: ICR.merge_rectangles_pairwise(r)),
+        ('merge_close_rectangles',
+         lambda r: ICR.cluster_rectangles(r, lambda a, b: ICR.rect_distance(a, b) <= args.distance, args.distance),
+         lambda r: ICR.merge_close_rectangles_pairwise(r, args.distance)),
+    ]
+
+    for size in args.sizes:
+        rectangles = random_rectangles(size)
+        for name, fast, pairwise in cases:
+            fast_time, fast_result = measure(lambda: fast(rectangles), args.repeat)
+            row = {'function': name, 'rectangles': size, 'merged': len(fast_result), 'grid_s': round(fast_time, 6)}
+            if size <= args.max_pairwise:
+                pairwise_time, pairwise_result = measure(lambda: pairwise(rectangles), args.repeat)
+                row['pairwise_s'] = round(pairwise_time, 6)
+                row['speedup'] = round(pairwise_time / fast_time, 2) if fast_time else None
+                row['identical'] = fast_result == pairwise_result
+            print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+并行匹配基准：比较串行匹配与进程池在 1/2/4/8 个进程时 match_sprite_to_background 的耗时
+
+默认使用 synthetic.py 生成的合成验证码，也可以用 --bg/--sprite 指定一对真实图片。匹配之前的步骤直接调用
+ICR.prepare_background / ICR.prepare_sprite，与 ICR.main 使用同一套参数(--profile)。
+进程池只有在多核机器上才可能加速，输出中的 cpu_count 为当前进程可用的核心数。
+
+用法:
+    python benchmarks/parallel_matching.py [--count 4] [--method template] [--workers 1 2 4 8]
+    python benchmarks/parallel_matching.py --bg temp/captcha.jpg --sprite temp/sprite.jpg
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import ICR  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def prepare(bg, sprite, params):
+    """执行 ICR.main 中匹配之前的所有步骤，返回匹配阶段的输入"""
+    _, bg_mask, bg_black_regions = ICR.prepare_background(bg, params)
+    rotation_data = ICR.prepare_sprite(sprite, params, use_cache=False)[3]
+    return bg_black_regions, bg_mask, rotation_data
+
+
+def measure(args, cases, workers):
+    # 预热：启动进程池并让子进程完成导入
+    ICR.match_sprite_to_background(*cases[0], args.method, workers=workers)
+
+    samples = []
+    for _ in range(args.repeat):
+        for inputs in cases:
+            start_time = time.perf_counter()
+            ICR.match_sprite_to_background(*inputs, args.method, workers=workers)
+            samples.append(time.perf_counter() - start_time)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bg', help='背景图片，与 --sprite 一起指定时代替合成验证码')
+    parser.add_argument('--sprite', help='sprite图片')
+    parser.add_argument('--count', type=int, default=4, help='合成验证码数量')
+    parser.add_argument('--icons', type=int, default=3)
+    parser.add_argument('--profile', help='命名参数配置，见 ICR.load_profile')
+    parser.add_argument('--method', default='template')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    params = ICR.load_profile(args.profile)
+    if args.bg and args.sprite:
+        pairs = [(args.bg, args.sprite)]
+    else:
+        pairs = [synthetic.generate(seed, args.icons)[:2] for seed in range(args.count)]
+    cases = [prepare(bg, sprite, params) for bg, sprite in pairs]
+
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    serial = measure(args, cases, 0)
+    print(json.dumps({'cpu_count': cpu_count, 'workers': 0, 'median_s': round(serial, 6), 'speedup': 1.0}))
+
+    for workers in args.workers:
+        elapsed = measure(args, cases, workers)
+        print(json.dumps({'cpu_count': cpu_count, 'workers': workers, 'median_s': round(elapsed, 6),
+                          'speedup': round(serial / elapsed, 2) if elapsed else None}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+旋转映射表缓存基准：比较 opencv_rotate 与 RotationEngine 旋转一个区域全部91个角度的耗时
+
+对每种区域尺寸分别测量：每次调用 warpAffine(opencv_rotate)、生成映射表(build)、映射表已缓存(warm)
+的 RotationEngine，以及包含轮廓提取在内的完整 compute_rotations，并校验两种方式的输出逐像素相同。
+
+用法:
+    python benchmarks/rotation_engine.py [--sizes 40x40 48x44 62x58] [--repeat 50]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+import ICR  # noqa: E402
+
+ANGLES = range(-45, 46)
+
+
+def make_region(width, height, seed):
+    """生成一个类似预处理后sprite图标的二值区域"""
+    rng = np.random.default_rng(seed)
+    region = np.zeros((height, width), dtype=np.uint8)
+    points = rng.integers(0, [width, height], size=(6, 2)).astype(np.int32)
+    cv2.fillPoly(region, [cv2.convexHull(points)], 255)
+    return region
+
+
+def median_ms(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start_time)
+    return round(statistics.median(samples) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=['30x30', '40x40', '48x44', '62x58', '80x80'],
+                        help='区域尺寸，格式为 宽x高')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split('x'))
+        region = make_region(width, height, width * 1000 + height)
+        engine = ICR.RotationEngine(len(ANGLES), max_bytes=1 << 30)
+
+        identical = all(np.array_equal(engine.rotate(region, -angle), ICR.opencv_rotate(region, -angle))
+                        for angle in ANGLES)
+
+        def rotate_warp():
+            for angle in ANGLES:
+                ICR.opencv_rotate(region, -angle)
+
+        def build_maps():
+            for angle in ANGLES:
+                engine.maps_for(region.shape, -angle)
+
+        def rotate_engine():
+            for angle in ANGLES:
+                engine.rotate(region, -angle)
+
+        warp_ms = median_ms(rotate_warp, args.repeat)
+        build_ms = median_ms(build_maps, args.repeat, engine.clear)
+        warm_ms = median_ms(rotate_engine, args.repeat)
+
+        # 完整的旋转分析（包含每个角度的轮廓提取）
+        default_engine = ICR.rotation_engine
+        try:
+            ICR.rotation_engine = None
+            compute_warp_ms = median_ms(lambda: ICR.compute_rotations(region), args.repeat)
+            ICR.rotation_engine = engine
+            build_maps()
+            compute_remap_ms = median_ms(lambda: ICR.compute_rotations(region), args.repeat)
+        finally:
+            ICR.rotation_engine = default_engine
+
+        print(json.dumps({
+            'size': size,
+            'identical': identical,
+            'warp_affine_ms': warp_ms,
+            'build_maps_ms': build_ms,
+            'remap_warm_ms': warm_ms,
+            'speedup_warm': round(warp_ms / warm_ms, 2) if warm_ms else None,
+            'compute_rotations_warp_ms': compute_warp_ms,
+            'compute_rotations_remap_ms': compute_remap_ms,
+            'table_kb': round(engine.stats()['bytes'] / 1024, 1)
+        }))
+
+
+if __name__ == '__main__':
+    main()
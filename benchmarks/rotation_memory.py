@@ -0,0 +1,76 @@
+"""
+多账号并发识别时的峰值内存基准
+
+用多个线程同时对合成验证码调用 ICR.main（模拟多个账号同时签到），用 tracemalloc 统计
+Python 与 numpy 分配的峰值内存，并报告旋转结果本身占用的字节数。旋转结果只占峰值的一小部分，
+峰值主要来自解码后的图像、预处理中间结果和全局的旋转映射表缓存，因此 --packed 主要减少的是旋转结果本身。
+
+用法:
+    python benchmarks/rotation_memory.py [--threads 4] [--method template] [--packed]
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import ICR  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def rotation_bytes(sprite):
+    """单次识别中所有sprite区域旋转结果占用的字节数"""
+    params = ICR.load_profile()
+    rotation_data = ICR.prepare_sprite(sprite, params, use_cache=False)[3]
+    return sum(data['rotations'].nbytes for data in rotation_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=4, help='同时识别的线程数')
+    parser.add_argument('--rounds', type=int, default=3, help='每个线程识别的验证码数量')
+    parser.add_argument('--method', default='template')
+    parser.add_argument('--packed', action='store_true', help='按位压缩旋转结果')
+    args = parser.parse_args()
+
+    ICR.PACK_ROTATIONS = args.packed
+    cases = [synthetic.generate(seed) for seed in range(args.threads * args.rounds)]
+    # 预热，避免把 OpenCV 首次调用的分配计入峰值
+    ICR.main(cases[0][0], cases[0][1], args.method, use_cache=False)
+
+    def worker(thread_idx):
+        for bg, sprite, _ in cases[thread_idx::args.threads]:
+            matches = ICR.main(bg, sprite, args.method, use_cache=False)
+            # 模拟调用方持有结果的时间
+            time.sleep(0.01)
+            del matches
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(json.dumps({
+        'threads': args.threads,
+        'rounds': args.rounds,
+        'method': args.method,
+        'packed': args.packed,
+        'peak_mb': round(peak / 1024 / 1024, 3),
+        'rotation_kb_per_solve': round(rotation_bytes(cases[0][1]) / 1024, 1),
+        'elapsed_s': round(elapsed, 3)
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+确定性的合成验证码生成器
+
+在带纹理的背景上以已知位置和角度绘制若干黑色图标，并生成对应的未旋转图标条(sprite)。
+相同的种子总是生成完全相同的图片，可用于比较不同匹配方法的准确率和耗时。
+"""
+import math
+import random
+
+import cv2
+import numpy as np
+
+# 背景和sprite图片尺寸，与验证码实际下发的图片一致
+BG_SIZE = (672, 480)
+SPRITE_SIZE = (130, 40)
+
+# sprite图片在 ICR.main 中会放大 1.55 倍，背景中的图标是sprite中图标的 1.55 倍大
+ICON_SIZE = 40
+SPRITE_ICON_SIZE = 26
+
+
+def _canvas():
+    return np.zeros((ICON_SIZE, ICON_SIZE), np.uint8)
+
+
+def _star(points, outer, inner):
+    coords = []
+    for k in range(points * 2):
+        radius = outer if k % 2 == 0 else inner
+        angle = math.pi * k / points - math.pi / 2
+        coords.append([20 + radius * math.cos(angle), 20 + radius * math.sin(angle)])
+    mask = _canvas()
+    cv2.fillPoly(mask, [np.array(coords, np.int32)], 255)
+    return mask
+
+
+def icon_shapes():
+    """返回图标形状字典，每个形状是 ICON_SIZE×ICON_SIZE 的二值掩码"""
+    shapes = {}
+
+    mask = _canvas()
+    cv2.fillPoly(mask, [np.array([[20, 3], [37, 34], [3, 34]])], 255)
+    shapes['triangle'] = mask
+
+    mask = _canvas()
+    cv2.rectangle(mask, (5, 8), (35, 20), 255, -1)
+    cv2.rectangle(mask, (5, 8), (14, 36), 255, -1)
+    shapes['corner'] = mask
+
+    mask = _canvas()
+    cv2.circle(mask, (20, 20), 16, 255, -1)
+    cv2.circle(mask, (26, 14), 9, 0, -1)
+    shapes['moon'] = mask
+
+    shapes['star'] = _star(5, 17, 7)
+
+    mask = _canvas()
+    cv2.rectangle(mask, (4, 16), (36, 24), 255, -1)
+    cv2.rectangle(mask, (16, 4), (24, 24), 255, -1)
+    shapes['tee'] = mask
+
+    mask = _canvas()
+    cv2.ellipse(mask, (20, 20), (17, 9), 0, 0, 360, 255, -1)
+    cv2.rectangle(mask, (17, 4), (23, 36), 255, -1)
+    shapes['cross'] = mask
+
+    mask = _canvas()
+    cv2.fillPoly(mask, [np.array([[4, 36], [20, 4], [36, 36], [20, 26]])], 255)
+    shapes['arrow'] = mask
+
+    mask = _canvas()
+    cv2.circle(mask, (20, 20), 17, 255, -1)
+    cv2.circle(mask, (20, 20), 9, 0, -1)
+    cv2.rectangle(mask, (18, 0), (22, 12), 0, -1)
+    shapes['ring'] = mask
+
+    return shapes
+
+
+def rotate_mask(mask, angle):
+    """将掩码绕中心旋转 angle 度（与 ICR 约定一致：正角度为顺时针）"""
+    height, width = mask.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+    return cv2.warpAffine(mask, matrix, (width, height), flags=cv2.INTER_NEAREST)
+
+
+def textured_background(rng):
+    """生成颜色丰富、没有接近黑色像素的随机纹理背景"""
+    width, height = BG_SIZE
+    seed = rng.randrange(2 ** 32)
+    np_rng = np.random.default_rng(seed)
+    coarse = np_rng.integers(70, 255, (height // 8, width // 8, 3)).astype(np.uint8)
+    bg = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = np_rng.integers(-20, 20, bg.shape)
+    return np.clip(bg.astype(int) + noise, 60, 255).astype(np.uint8)
+
+
+def generate(seed, icons=3, max_angle=40):
+    """
+    生成一组合成验证码
+
+    参数:
+        seed: 随机种子
+        icons: 图标数量
+        max_angle: 背景中图标旋转角度的绝对值上限
+
+    返回:
+        (背景图像, sprite图像, 真实值列表)，真实值按sprite中从左到右的顺序排列，
+        每项包含 'shape'、'angle' 和背景中的中心点 'center'
+    """
+    rng = random.Random(seed)
+    shapes = icon_shapes()
+    names = rng.sample(sorted(shapes), icons)
+
+    bg = textured_background(rng)
+    sprite_w, sprite_h = SPRITE_SIZE
+    sprite_w = max(sprite_w, 20 + icons * SPRITE_ICON_SIZE + (icons - 1) * 14)
+    sprite = np.full((sprite_h, sprite_w, 3), 235, np.uint8)
+
+    truth = []
+    placed = []
+    width, height = BG_SIZE
+    for i, name in enumerate(names):
+        angle = rng.randint(-max_angle, max_angle)
+
+        # 图标之间保持足够距离，避免在背景中粘连
+        while True:
+            x = rng.randint(20, width - ICON_SIZE - 32)
+            y = rng.randint(20, height - ICON_SIZE - 40)
+            if all(abs(x - px) > 70 or abs(y - py) > 70 for px, py in placed):
+                break
+        placed.append((x, y))
+
+        rotated = rotate_mask(shapes[name], angle)
+        bg[y:y + ICON_SIZE, x:x + ICON_SIZE][rotated > 0] = rng.randint(0, 15)
+
+        small = cv2.resize(shapes[name], (SPRITE_ICON_SIZE, SPRITE_ICON_SIZE), interpolation=cv2.INTER_NEAREST)
+        offset_x = 10 + i * (SPRITE_ICON_SIZE + 14)
+        offset_y = (sprite_h - SPRITE_ICON_SIZE) // 2
+        sprite[offset_y:offset_y + SPRITE_ICON_SIZE, offset_x:offset_x + SPRITE_ICON_SIZE][small > 0] = 10
+
+        truth.append({'shape': name, 'angle': angle, 'center': (x + ICON_SIZE / 2, y + ICON_SIZE / 2)})
+
+    return bg, sprite, truth
+
+
+def is_solved(positions, truth, tolerance=15):
+    """判断识别出的位置是否与真实值一一对应且都在容差范围内"""
+    if len(positions) != len(truth):
+        return False
+    return all(math.hypot(px - item['center'][0], py - item['center'][1]) <= tolerance
+               for (px, py), item in zip(positions, truth))
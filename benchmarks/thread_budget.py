@@ -0,0 +1,122 @@
+"""
+OpenCV 线程预算基准
+
+模拟多个签到线程同时识别验证码：在 1~8 个并发识别下分别测量开启 ICR.thread_budget(按并发数平分
+OpenCV 线程)与不管理(每个识别都使用 OpenCV 默认线程数)时的单次识别延迟和总吞吐量，结果以 JSON 输出。
+--busy 可以启动若干个占满CPU的进程，模拟同时运行的 Chrome。
+
+用法:
+    python benchmarks/thread_budget.py [--concurrency 1 2 4 8] [--rounds 4] [--busy 0]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import cv2  # noqa: E402
+
+import ICR  # noqa: E402
+import synthetic  # noqa: E402
+
+DEFAULT_THREADS = cv2.getNumThreads()
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        pass
+
+
+def run(cases, concurrency, rounds, method):
+    """concurrency 个线程各自依次求解 rounds 个验证码，返回每次求解的延迟(秒)和总耗时"""
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency)
+
+    def worker(index):
+        barrier.wait()
+        for i in range(rounds):
+            bg, sprite = cases[(index * rounds + i) % len(cases)]
+            start_time = time.perf_counter()
+            ICR.main(bg, sprite, method, use_cache=False)
+            elapsed = time.perf_counter() - start_time
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start_time
+
+
+def summarize(latencies, elapsed):
+    return {
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'p50_ms': round(ICR.latency_percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(ICR.latency_percentile(latencies, 95) * 1000, 3),
+        'throughput_per_s': round(len(latencies) / elapsed, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='并发识别数')
+    parser.add_argument('--rounds', type=int, default=4, help='每个线程求解的验证码数量')
+    parser.add_argument('--method', default='template', help='匹配方法，none 表示 match_method=None')
+    parser.add_argument('--budget', type=int, default=os.cpu_count() or 1, help='开启预算时的线程总数')
+    parser.add_argument('--busy', type=int, default=0, help='同时运行的占满CPU的进程数')
+    args = parser.parse_args()
+
+    method = None if args.method == 'none' else args.method
+    cases = [synthetic.generate(seed)[:2] for seed in range(max(args.concurrency) * args.rounds)]
+
+    stop = multiprocessing.Event()
+    busy = [multiprocessing.Process(target=busy_loop, args=(stop,), daemon=True) for _ in range(args.busy)]
+    for process in busy:
+        process.start()
+
+    # 预热：首次调用 OpenCV 各函数有额外开销
+    ICR.main(cases[0][0], cases[0][1], method, use_cache=False)
+
+    report = {
+        'config': {
+            'cpu_count': os.cpu_count(),
+            'opencv_default_threads': DEFAULT_THREADS,
+            'budget': args.budget,
+            'rounds': args.rounds,
+            'method': args.method,
+            'busy': args.busy,
+            'opencv': cv2.__version__
+        },
+        'results': []
+    }
+    try:
+        for concurrency in args.concurrency:
+            row = {'concurrency': concurrency}
+            for name, total in (('unmanaged', 0), ('budget', args.budget)):
+                ICR.thread_budget.total = total
+                cv2.setNumThreads(DEFAULT_THREADS)
+                row[name] = summarize(*run(cases, concurrency, args.rounds, method))
+            row['threads_per_solve'] = ICR.ThreadBudget(args.budget).threads_for(concurrency)
+            row['p95_speedup'] = round(row['unmanaged']['p95_ms'] / row['budget']['p95_ms'], 3)
+            report['results'].append(row)
+    finally:
+        stop.set()
+        for process in busy:
+            process.join()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
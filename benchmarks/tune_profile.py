@@ -0,0 +1,275 @@
+"""
+ICR 参数配置搜索
+
+在标注验证码集上用随机搜索或逐次减半(successive halving)搜索 ICR.main 的预处理与区域提取参数
+(sprite 放大倍数、二值化阈值、掩码降采样倍数、膨胀核、最小面积、合并距离、背景区域数、角度范围、对称剪枝)，
+输出准确率与平均识别耗时的 Pareto 前沿，可将选中的配置以指定名字保存到 ICR.PROFILE_FILE，
+之后通过 find_part_positions(..., profile=名字) 或环境变量 ICR_PROFILE 使用。
+
+标注数据默认使用 synthetic.py 生成的合成验证码，也可以使用 captcha_corpus.py 记录的语料库
+(以判定为通过的识别位置作为真实值)。
+
+用法:
+    python benchmarks/tune_profile.py [--count 48] [--trials 32] [--search halving] [--save fast --min-accuracy 0.95]
+    python benchmarks/tune_profile.py --corpus corpus --method template --save tuned
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import ICR  # noqa: E402
+import captcha_corpus  # noqa: E402
+import synthetic  # noqa: E402
+
+# 每个参数的候选值，均包含 ICR.DEFAULT_PROFILE 中的默认值
+SEARCH_SPACE = {
+    'sprite_scale': [1.3, 1.45, 1.55, 1.7, 1.85],
+    'bg_threshold': [15, 20, 25, 30, 35],
+    'sprite_threshold': [20, 25, 30, 35, 40],
+    'bg_mask_scale': [2, 3, 4, 5, 6],
+    'mask_kernel': [1, 2, 3],
+    'bg_min_area': [25, 50, 100, 150],
+    'sprite_min_area': [50, 100, 150],
+    'merge_distance': [0, 3, 5, 8, 12],
+    'max_bg_regions': [5, 6, 8, 10, 15],
+    'max_angle': [30, 35, 40, 45, 50],
+    'symmetry_iou': [0.0, 0.8, 0.85, 0.9]
+}
+
+
+def synthetic_cases(count, seed, icons):
+    """合成验证码，真实值为按 sprite 中从左到右顺序排列的中心点"""
+    cases = []
+    for case_seed in range(seed, seed + count):
+        bg, sprite, truth = synthetic.generate(case_seed, icons)
+        cases.append((str(case_seed), bg, sprite, [item['center'] for item in truth]))
+    return cases
+
+
+def corpus_cases(directory):
+    """语料库中最后一次判定为通过的验证码，真实值为当时的识别位置"""
+    cases = []
+    for bg_path, sprite_path in ICR.find_captcha_pairs(directory):
+        record_path = bg_path.with_name(bg_path.name.replace('_captcha', '')).with_suffix('.json')
+        try:
+            entry = json.loads(record_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            continue
+        attempt = captcha_corpus.verdict(entry)
+        if attempt is not None and attempt['passed']:
+            cases.append((entry['hash'], ICR.load_image(bg_path.read_bytes()), ICR.load_image(sprite_path.read_bytes()),
+                          attempt['positions']))
+    return cases
+
+
+def sample_profiles(trials, rng):
+    """默认配置加上 trials 个不重复的随机配置"""
+    profiles = [dict(ICR.DEFAULT_PROFILE)]
+    seen = {tuple(sorted(ICR.DEFAULT_PROFILE.items()))}
+    attempts = 0
+    while len(profiles) < trials + 1 and attempts < trials * 100:
+        attempts += 1
+        profile = {name: rng.choice(values) for name, values in SEARCH_SPACE.items()}
+        key = tuple(sorted(profile.items()))
+        if key not in seen:
+            seen.add(key)
+            profiles.append(profile)
+    return profiles
+
+
+class Trial:
+    """一个参数配置在已评估样本上的累计结果"""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.solved = 0
+        self.times = []
+        self.errors = 0
+
+    @property
+    def evaluated(self):
+        return len(self.times)
+
+    @property
+    def accuracy(self):
+        return self.solved / self.evaluated if self.evaluated else 0.0
+
+    @property
+    def mean_ms(self):
+        return statistics.fmean(self.times) * 1000 if self.times else float('inf')
+
+    def evaluate(self, cases, method, tolerance, match_options):
+        """评估尚未评估过的样本"""
+        for case_id, bg, sprite, truth in cases[self.evaluated:]:
+            stats = ICR.SolveStats()
+            try:
+                matches = ICR.main(bg, sprite, method, use_cache=False, stats=stats, profile=self.profile,
+                                   **match_options)
+                positions = ICR.convert_matches_to_positions(matches)
+            except Exception:
+                self.errors += 1
+                positions = []
+            self.times.append(stats.total)
+            if captcha_corpus.same_positions(positions, truth, tolerance):
+                self.solved += 1
+
+    def as_dict(self):
+        return {
+            'profile': {name: value for name, value in self.profile.items() if ICR.DEFAULT_PROFILE[name] != value},
+            'evaluated': self.evaluated,
+            'accuracy': round(self.accuracy, 4),
+            'mean_ms': round(self.mean_ms, 3),
+            'errors': self.errors
+        }
+
+
+def pareto_ranks(trials):
+    """非支配排序：准确率越高、平均耗时越低越好，前沿上的配置为0"""
+    ranks = {}
+    remaining = list(trials)
+    rank = 0
+    while remaining:
+        front = [t for t in remaining
+                 if not any(o.accuracy >= t.accuracy and o.mean_ms <= t.mean_ms
+                            and (o.accuracy > t.accuracy or o.mean_ms < t.mean_ms) for o in remaining)]
+        for trial in front:
+            ranks[id(trial)] = rank
+        remaining = [t for t in remaining if id(t) not in ranks]
+        rank += 1
+    return ranks
+
+
+def search(trials, cases, method, tolerance, match_options, mode, min_cases, eta):
+    """
+    逐次减半：所有配置先在 min_cases 个样本上评估，按 Pareto 层级(其次准确率、耗时)保留前 1/eta，
+    样本数乘以 eta 后继续，直到剩余配置在全部样本上评估完毕；随机搜索直接在全部样本上评估所有配置
+
+    返回:
+        在全部样本上评估过的配置
+    """
+    if mode == 'random':
+        for trial in trials:
+            trial.evaluate(cases, method, tolerance, match_options)
+        return trials
+
+    budget = min(min_cases, len(cases))
+    survivors = trials
+    while True:
+        for trial in survivors:
+            trial.evaluate(cases[:budget], method, tolerance, match_options)
+        if budget >= len(cases) or len(survivors) <= 1:
+            break
+        ranks = pareto_ranks(survivors)
+        survivors = sorted(survivors, key=lambda t: (ranks[id(t)], -t.accuracy, t.mean_ms))
+        survivors = survivors[:max(1, math.ceil(len(survivors) / eta))]
+        budget = min(len(cases), budget * eta)
+
+    # 最后一轮之前就只剩一个配置时补齐全部样本
+    for trial in survivors:
+        trial.evaluate(cases, method, tolerance, match_options)
+    return survivors
+
+
+def choose(front, min_accuracy=None):
+    """min_accuracy 为None时选准确率最高者(其次最快)，否则选满足准确率下限的最快配置"""
+    if min_accuracy is not None:
+        candidates = [trial for trial in front if trial.accuracy >= min_accuracy]
+        if candidates:
+            return min(candidates, key=lambda t: t.mean_ms)
+    return max(front, key=lambda t: (t.accuracy, -t.mean_ms))
+
+
+def save_profile(name, profile, path):
+    """将配置写入命名参数配置文件，保留文件中的其他配置"""
+    path = Path(path)
+    try:
+        profiles = json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        profiles = {}
+    profiles[name] = profile
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(profiles, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus', help='使用 captcha_corpus.py 记录的语料库作为标注数据，默认使用合成验证码')
+    parser.add_argument('--count', type=int, default=48, help='合成验证码数量')
+    parser.add_argument('--seed', type=int, default=0, help='第一个合成验证码的种子')
+    parser.add_argument('--icons', type=int, default=3)
+    parser.add_argument('--method', default='template', help='匹配方法，none 表示 match_method=None')
+    parser.add_argument('--assignment', choices=['greedy', 'optimal'], help='冲突解决方式，默认使用 ICR.ASSIGNMENT')
+    parser.add_argument('--tolerance', type=float, default=15, help='中心点允许的误差(像素)')
+    parser.add_argument('--search', choices=['halving', 'random'], default='halving', help='搜索方式')
+    parser.add_argument('--trials', type=int, default=32, help='随机配置数量(不含默认配置)')
+    parser.add_argument('--search-seed', type=int, default=0, help='随机配置的种子')
+    parser.add_argument('--min-cases', type=int, default=6, help='逐次减半第一轮的样本数')
+    parser.add_argument('--eta', type=int, default=3, help='逐次减半每轮保留 1/eta 的配置')
+    parser.add_argument('--min-accuracy', type=float, help='选择满足该准确率的最快配置，默认选准确率最高的配置')
+    parser.add_argument('--save', metavar='NAME', help='将选中的配置以该名字保存')
+    parser.add_argument('--profile-file', default=str(ICR.PROFILE_FILE), help='命名参数配置文件')
+    parser.add_argument('--output', help='将结果写入文件，默认输出到标准输出')
+    args = parser.parse_args()
+
+    if args.corpus:
+        cases = corpus_cases(args.corpus)
+    else:
+        cases = synthetic_cases(args.count, args.seed, args.icons)
+    if not cases:
+        parser.error('没有可用的标注数据')
+    random.Random(args.search_seed).shuffle(cases)
+
+    method = None if args.method == 'none' else args.method
+    match_options = {'assignment': args.assignment}
+
+    # 预热：首次调用 OpenCV 各函数有额外开销
+    ICR.main(cases[0][1], cases[0][2], method, use_cache=False)
+
+    trials = [Trial(profile) for profile in sample_profiles(args.trials, random.Random(args.search_seed))]
+    finalists = search(trials, cases, method, args.tolerance, match_options, args.search, args.min_cases, args.eta)
+    # 默认配置总是在全部样本上评估，作为对照
+    default = trials[0]
+    if default not in finalists:
+        default.evaluate(cases, method, args.tolerance, match_options)
+        finalists.append(default)
+    ranks = pareto_ranks(finalists)
+    front = sorted((t for t in finalists if ranks[id(t)] == 0), key=lambda t: t.mean_ms)
+    chosen = choose(front, args.min_accuracy)
+
+    report = {
+        'config': {
+            'cases': len(cases),
+            'source': args.corpus or 'synthetic',
+            'method': args.method,
+            'search': args.search,
+            'trials': len(trials),
+            'tolerance': args.tolerance,
+            'evaluations': sum(trial.evaluated for trial in trials)
+        },
+        'default': default.as_dict(),
+        'front': [trial.as_dict() for trial in front],
+        'chosen': {**chosen.as_dict(), 'params': chosen.profile},
+        'trials': sorted((trial.as_dict() for trial in trials), key=lambda t: (-t['evaluated'], -t['accuracy']))
+    }
+    if args.save:
+        save_profile(args.save, chosen.profile, args.profile_file)
+        report['saved'] = {'name': args.save, 'file': args.profile_file}
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+"""
+验证码回放语料库
+
+签到时设置环境变量 CAPTCHA_CORPUS=<目录> 后，每次识别的验证码都会按内容哈希保存到语料库中:
+
+    <目录>/<哈希前2位>/<哈希>_captcha.jpg   背景图原始字节
+    <目录>/<哈希前2位>/<哈希>_sprite.jpg    sprite图原始字节
+    <目录>/<哈希前2位>/<哈希>.json          每次尝试的识别位置、匹配方法、各阶段耗时和服务器判定结果
+
+同一张验证码再次出现时只追加一条尝试记录。回放工具用任意 ICR 配置重新识别语料库中的全部验证码，
+与记录的判定结果对比得到准确率，并统计延迟，无需联网即可验证识别速度优化是否影响结果:
+
+    python captcha_corpus.py replay <目录> [--method template] [--assignment optimal] [--profile fast] [--jobs 2] [--json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+# 多账户签到的工作线程在同一进程中写语料库，同一条记录的读-改-写需要串行
+_record_lock = threading.Lock()
+
+
+def corpus_dir():
+    """环境变量 CAPTCHA_CORPUS 指定的语料库目录，未设置时返回None"""
+    directory = os.getenv("CAPTCHA_CORPUS", "").strip()
+    return Path(directory) if directory else None
+
+
+def content_hash(captcha_bytes, sprite_bytes):
+    """由两张图片内容计算的语料库键"""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(captcha_bytes).digest())
+    digest.update(hashlib.sha256(sprite_bytes).digest())
+    return digest.hexdigest()[:24]
+
+
+def record(directory, captcha_bytes, sprite_bytes, solution=None, passed=None):
+    """
+    将一次验证码尝试写入语料库
+
+    参数:
+        directory: 语料库目录
+        captcha_bytes: 背景图原始字节
+        sprite_bytes: sprite图原始字节
+        solution: 识别结果字典(positions、size、angles、method、stats 等)，识别失败时为None
+        passed: 服务器判定结果，True/False，未提交时为None
+
+    返回:
+        记录文件路径
+    """
+    key = content_hash(captcha_bytes, sprite_bytes)
+    entry_dir = Path(directory) / key[:2]
+    entry_dir.mkdir(parents=True, exist_ok=True)
+
+    for suffix, data in (('captcha', captcha_bytes), ('sprite', sprite_bytes)):
+        image_path = entry_dir / f"{key}_{suffix}.jpg"
+        if not image_path.exists():
+            image_path.write_bytes(data)
+
+    record_path = entry_dir / f"{key}.json"
+    solution = solution or {}
+    attempt = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'method': solution.get('method'),
+        'positions': [[float(x), float(y)] for x, y in solution.get('positions', [])],
+        'size': solution.get('size'),
+        'angles': solution.get('angles', []),
+        'stats': solution.get('stats'),
+        'remote': solution.get('remote', False),
+        'passed': passed
+    }
+
+    with _record_lock:
+        try:
+            entry = json.loads(record_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            entry = {'hash': key, 'attempts': []}
+        entry['attempts'].append(attempt)
+
+        # 先写临时文件再替换，避免读到半个文件；临时文件名包含线程号，多个进程或线程不会互相覆盖
+        tmp_path = record_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(entry, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp_path, record_path)
+    return record_path
+
+
+def verdict(entry):
+    """最后一次有判定结果的尝试，没有时返回None"""
+    for attempt in reversed(entry['attempts']):
+        if attempt['passed'] is not None:
+            return attempt
+    return None
+
+
+def same_positions(positions, recorded, tolerance):
+    """两组位置数量相同且对应点距离都不超过 tolerance 像素"""
+    if len(positions) != len(recorded):
+        return False
+    return all((x - rx) ** 2 + (y - ry) ** 2 <= tolerance ** 2
+               for (x, y), (rx, ry) in zip(positions, recorded))
+
+
+def compare(result, entry, tolerance):
+    """
+    将回放结果与记录对比
+
+    返回:
+        "correct": 记录为通过，且回放位置与通过时的位置一致
+        "regressed": 记录为通过，回放位置不同或识别失败
+        "unchanged": 记录为未通过，回放位置与记录相同(仍然错误)
+        "changed": 记录为未通过，回放位置不同(可能已修复)
+        "unknown": 没有判定结果
+    """
+    attempt = verdict(entry)
+    if attempt is None:
+        return "unknown"
+    same = 'error' not in result and same_positions(result['positions'], attempt['positions'], tolerance)
+    if attempt['passed']:
+        return "correct" if same else "regressed"
+    return "unchanged" if same else "changed"
+
+
+def replay(directory, match_method='template', jobs=1, use_cache=True, tolerance=10, output=None,
+           as_json=False, **match_options):
+    """
+    用指定配置重新识别语料库中的全部验证码
+
+    参数:
+        directory: 语料库目录
+        match_method: 匹配方法
+        jobs: 并行进程数
+        use_cache: 是否使用旋转结果缓存
+        tolerance: 判定位置一致的距离(背景图像素)
+        output: 输出流，默认标准输出
+        as_json: 以JSON行输出
+        match_options: 传给 ICR.main 的参数(匹配参数和 profile)
+
+    返回:
+        统计信息字典
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    import ICR
+
+    output = output or sys.stdout
+    entries = {}
+    tasks = []
+    for bg_path, sprite_path in ICR.find_captcha_pairs(directory):
+        record_path = bg_path.with_name(bg_path.name.replace('_captcha', '')).with_suffix('.json')
+        try:
+            entries[str(bg_path)] = json.loads(record_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            continue
+        tasks.append((bg_path, sprite_path, match_method, use_cache, match_options))
+
+    outcomes = dict.fromkeys(("correct", "regressed", "unchanged", "changed", "unknown"), 0)
+    latencies, recorded_latencies = [], []
+    stage_totals = {}
+    errors = 0
+    start_time = time.perf_counter()
+
+    def collect(result):
+        nonlocal errors
+        entry = entries[result['captcha']]
+        outcome = compare(result, entry, tolerance)
+        outcomes[outcome] += 1
+        if 'error' in result:
+            errors += 1
+        else:
+            latencies.append(result['latency_ms'])
+            for stage, value in result['stats']['timings_ms'].items():
+                stage_totals[stage] = stage_totals.get(stage, 0) + value
+        recorded = [attempt['stats']['total_ms'] for attempt in entry['attempts'] if attempt.get('stats')]
+        if recorded:
+            recorded_latencies.append(recorded[-1])
+
+        if as_json:
+            output.write(json.dumps({'hash': entry['hash'], 'outcome': outcome, **result}, ensure_ascii=False) + "\n")
+        elif outcome in ("regressed", "changed") or 'error' in result:
+            output.write(f"{entry['hash']}: {outcome} {result.get('error', result.get('positions'))}\n")
+
+    if jobs <= 1:
+        for task in tasks:
+            collect(ICR.solve_pair_files(task))
+    else:
+        with ProcessPoolExecutor(jobs, initializer=ICR.init_worker_threads,
+                                 initargs=(ICR.thread_budget.per_process(jobs),)) as pool:
+            for result in pool.map(ICR.solve_pair_files, tasks, chunksize=4):
+                collect(result)
+
+    elapsed = time.perf_counter() - start_time
+    judged = outcomes["correct"] + outcomes["regressed"]
+    summary = {
+        'summary': True,
+        'entries': len(tasks),
+        'errors': errors,
+        **outcomes,
+        'accuracy': round(outcomes["correct"] / judged, 4) if judged else None,
+        'elapsed_s': round(elapsed, 3),
+        'p50_ms': ICR.latency_percentile(latencies, 50),
+        'p95_ms': ICR.latency_percentile(latencies, 95),
+        'p99_ms': ICR.latency_percentile(latencies, 99),
+        'recorded_p50_ms': ICR.latency_percentile(recorded_latencies, 50),
+        'mean_stage_ms': {stage: round(total / len(latencies), 3) for stage, total in stage_totals.items()}
+    }
+    if as_json:
+        output.write(json.dumps(summary) + "\n")
+    else:
+        output.write(f"回放 {summary['entries']} 个验证码，准确率 {summary['accuracy']} "
+                     f"(通过记录中一致 {outcomes['correct']} 个，不一致 {outcomes['regressed']} 个；"
+                     f"未通过记录中结果变化 {outcomes['changed']} 个)，识别失败 {errors} 个\n"
+                     f"延迟 p50/p95/p99 = {summary['p50_ms']}/{summary['p95_ms']}/{summary['p99_ms']} ms，"
+                     f"记录时 p50 = {summary['recorded_p50_ms']} ms\n")
+    output.flush()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("replay", help="用指定配置重新识别语料库并与记录的判定结果对比")
+    replay_parser.add_argument("directory", help="语料库目录")
+    replay_parser.add_argument("--jobs", "-j", type=int, default=1, help="并行进程数")
+    replay_parser.add_argument("--method", default="template",
+                               help="匹配方法，见 ICR.match_sprite_to_background，none 表示直接比较")
+    replay_parser.add_argument("--assignment", choices=["greedy", "optimal"], help="冲突解决方式")
+    replay_parser.add_argument("--early-exit", type=float, help="提前退出阈值(相似度百分比)")
+    replay_parser.add_argument("--profile", help="命名参数配置，见 ICR.load_profile")
+    replay_parser.add_argument("--tolerance", type=float, default=10, help="判定位置一致的距离(像素)")
+    replay_parser.add_argument("--no-cache", action="store_true", help="不使用旋转结果缓存")
+    replay_parser.add_argument("--json", action="store_true", help="以JSON行输出每个验证码的结果")
+
+    args = parser.parse_args(argv)
+    match_options = {}
+    if args.assignment:
+        match_options['assignment'] = args.assignment
+    if args.early_exit is not None:
+        match_options['early_exit'] = args.early_exit
+    if args.profile:
+        match_options['profile'] = args.profile
+    method = None if args.method.lower() == "none" else args.method
+    summary = replay(args.directory, method, args.jobs, not args.no_cache, args.tolerance, None, args.json,
+                     **match_options)
+    return 1 if summary['regressed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
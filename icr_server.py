@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# _*_ coding:utf-8 _*_
+"""
+ICR 本地识别服务
+
+常驻进程保持 cv2/numpy 已导入、旋转缓存和映射表缓存已预热，通过本机 HTTP 接收验证码图片并返回位置。
+同时到达的请求合并为一批，sprite 图片相同的请求只做一次旋转分析（见 SolverService），
+在服务进程内依次求解，或分发到进程池中并行求解；单个请求出错不影响同一批的其他请求。
+
+启动:
+    python icr_server.py [--host 127.0.0.1] [--port 8765] [--jobs 1] [--max-batch 16]
+
+接口:
+    POST /solve     {"captcha": base64, "sprite": base64, "method": "template", ...} -> ICR.solve_images 的结果
+    POST /feedback  {"angles": [...]}  识别成功后记录匹配角度到角度直方图
+    GET  /stats     排队数、求解中的请求数、批次大小、识别耗时百分位数和缓存统计
+    GET  /health    存活检查
+
+rainyun.py 中设置环境变量 ICR_SERVER=http://127.0.0.1:8765 后会优先使用该服务，服务不可用时回退到进程内识别。
+"""
+import argparse
+import base64
+import binascii
+import json
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ICR
+
+logger = logging.getLogger(__name__)
+
+# solve 请求中可以传给 ICR.main 的参数
+MATCH_OPTIONS = ('profile', 'assignment', 'early_exit', 'coarse_step', 'coarse_top_k', 'pyramid_levels',
+                 'pyramid_top_k', 'prefilter_keep', 'prefilter_max_distance')
+
+
+def decode_request(request, angle_order=None):
+    """
+    校验并解码 /solve 请求
+
+    参数:
+        request: /solve 请求的JSON
+        angle_order: 服务进程中角度直方图的当前顺序，进程池中的子进程收不到 /feedback，由服务进程随请求传入
+
+    返回:
+        ICR.solve_image_batch 的任务 (背景图, sprite图, 匹配方法, 是否使用缓存, 匹配参数)
+    """
+    options = {key: request[key] for key in MATCH_OPTIONS if request.get(key) is not None}
+    if angle_order is not None:
+        options['angle_order'] = angle_order
+    method = request.get('method', 'template')
+    captcha = base64.b64decode(request['captcha'], validate=True)
+    sprite = base64.b64decode(request['sprite'], validate=True)
+    return captcha, sprite, None if method in (None, 'none') else method, request.get('use_cache', True), options
+
+
+def solve_batch(requests, angle_order=None, callback=None):
+    """
+    在求解线程或进程池中执行的一批识别请求，见 ICR.solve_image_batch；任何错误都只作为对应请求的结果返回
+
+    参数:
+        callback: 每个请求完成时调用 callback(请求索引, 结果字典)，只能在求解线程中使用
+
+    返回:
+        与 requests 一一对应的结果字典列表
+    """
+    results = [None] * len(requests)
+    tasks = []
+
+    def finish(request_idx, result):
+        results[request_idx] = result
+        if callback is not None:
+            callback(request_idx, result)
+
+    for request_idx, request in enumerate(requests):
+        try:
+            tasks.append((request_idx, decode_request(request, angle_order)))
+        except (binascii.Error, KeyError, TypeError, ValueError) as e:
+            finish(request_idx, {'error': f"invalid request: {type(e).__name__}: {e}"})
+    try:
+        ICR.solve_image_batch([task for _, task in tasks],
+                              lambda task_idx, result: finish(tasks[task_idx][0], result))
+    except Exception as e:
+        for request_idx, _ in tasks:
+            if results[request_idx] is None:
+                finish(request_idx, {'error': f"{type(e).__name__}: {e}"})
+    return results
+
+
+class SolverService:
+    """
+    识别请求调度与统计
+
+    调度线程每次取出队列中全部等待的请求（最多 max_batch 个）作为一批：sprite 图片相同的请求分到同一组，
+    每组作为一次调用交给求解线程或进程池，组内只做一次 sprite 旋转分析（背景图也相同时只预处理一次）。
+    同时只有 jobs 组在求解，求解期间到达的请求在队列中积累，进入下一批。
+
+    参数:
+        jobs: 求解进程数，1表示在服务进程的求解线程中依次求解
+        max_batch: 每批最多取出的请求数
+    """
+
+    def __init__(self, jobs: int = 1, max_batch: int = 16):
+        self.jobs = jobs
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+        # 等待分批的 (请求, 结果Future)
+        self._queue = deque()
+        self._queue_ready = threading.Condition(self._lock)
+        # 同时求解的组数不超过 jobs
+        self._slots = threading.Semaphore(jobs)
+        self._latencies = deque(maxlen=1024)
+        self._solve_times = deque(maxlen=1024)
+        self._batch_sizes = deque(maxlen=1024)
+        self.pending = 0
+        self.in_flight = 0
+        self.solved = 0
+        self.errors = 0
+        self.started = time.time()
+        threading.Thread(target=self._dispatch_loop, name="icr-dispatcher", daemon=True).start()
+
+    def _new_executor(self):
+        if self.jobs > 1:
+            return ProcessPoolExecutor(self.jobs, initializer=ICR.init_worker_threads,
+                                       initargs=(ICR.thread_budget.per_process(self.jobs),))
+        return ThreadPoolExecutor(1, thread_name_prefix="icr-solver")
+
+    def _submit(self, requests, callback=None):
+        if self.jobs > 1:
+            return self._executor.submit(solve_batch, requests, ICR.angle_histogram.order())
+        # 求解线程中每个请求完成后立即返回结果，不必等同组的其他请求
+        return self._executor.submit(solve_batch, requests, None, callback)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._queue_ready:
+                while not self._queue:
+                    self._queue_ready.wait()
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+                self._batch_sizes.append(len(batch))
+
+            # 按 sprite 图片分组，相同的sprite在同一次调用中复用旋转分析
+            groups = {}
+            for request, future in batch:
+                sprite = request.get('sprite')
+                groups.setdefault(sprite if isinstance(sprite, str) else id(request), []).append((request, future))
+            for group in groups.values():
+                self._slots.acquire()
+                with self._lock:
+                    self.in_flight += len(group)
+                self._run_group(group)
+
+    def _run_group(self, group):
+        """提交一组请求；子进程崩溃时只有该组返回错误，并重建进程池供后续请求使用"""
+        def finish(done):
+            try:
+                results = done.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    with self._lock:
+                        self._executor = self._new_executor()
+                results = [{'error': f"{type(e).__name__}: {e}"} for _ in group]
+            with self._lock:
+                self.in_flight -= len(group)
+            self._slots.release()
+            for (_, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+
+        def finish_one(request_idx, result):
+            group[request_idx][1].set_result(result)
+
+        requests = [request for request, _ in group]
+        try:
+            try:
+                submitted = self._submit(requests, finish_one)
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = self._new_executor()
+                submitted = self._submit(requests, finish_one)
+        except Exception as e:
+            submitted = Future()
+            submitted.set_exception(e)
+        submitted.add_done_callback(finish)
+
+    def solve(self, request) -> dict:
+        """将识别请求加入队列并等待结果"""
+        queued_at = time.perf_counter()
+        future = Future()
+        with self._queue_ready:
+            self.pending += 1
+            self._queue.append((request, future))
+            self._queue_ready.notify()
+        result = dict(future.result())
+
+        finished = time.perf_counter()
+        with self._lock:
+            self.pending -= 1
+            if 'error' in result:
+                self.errors += 1
+            else:
+                self.solved += 1
+                self._solve_times.append(result['stats']['total_ms'] / 1000)
+            self._latencies.append(finished - queued_at)
+        result['service_ms'] = round((finished - queued_at) * 1000, 3)
+        return result
+
+    def warm_up(self):
+        """用一张随机图片跑一次完整流程，避免第一个真实请求承担初始化开销"""
+        import cv2
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        bg = cv2.imencode('.png', rng.integers(0, 256, (120, 160, 3), dtype=np.uint8))[1].tobytes()
+        sprite = cv2.imencode('.png', rng.integers(0, 256, (30, 90, 3), dtype=np.uint8))[1].tobytes()
+        request = {'captcha': base64.b64encode(bg).decode('ascii'), 'sprite': base64.b64encode(sprite).decode('ascii'),
+                   'use_cache': False}
+        futures = [self._submit([request]) for _ in range(self.jobs)]
+        for future in futures:
+            future.result()
+
+    def stats(self) -> dict:
+        def percentiles(values):
+            values = [round(value * 1000, 3) for value in values]
+            return {f'p{q}_ms': ICR.latency_percentile(values, q) for q in (50, 95, 99)}
+
+        with self._lock:
+            return {
+                'uptime_s': round(time.time() - self.started, 1),
+                'queue_depth': len(self._queue),
+                'in_flight': self.in_flight,
+                'solved': self.solved,
+                'batches': len(self._batch_sizes),
+                'mean_batch_size': round(statistics.fmean(self._batch_sizes), 3) if self._batch_sizes else None,
+                'errors': self.errors,
+                'latency': percentiles(self._latencies),
+                'solve_time': percentiles(self._solve_times),
+                'rotation_cache': ICR.rotation_cache.stats() if ICR.rotation_cache is not None else None,
+                'rotation_engine': ICR.rotation_engine.stats() if ICR.rotation_engine is not None else None
+            }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service: SolverService = None
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json({'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(self.service.stats())
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        try:
+            data = self._read_json()
+        except ValueError:
+            self._send_json({'error': 'invalid json'}, 400)
+            return
+
+        if self.path == '/solve':
+            if not data.get('captcha') or not data.get('sprite'):
+                self._send_json({'error': 'captcha and sprite are required'}, 400)
+                return
+            self._send_json(self.service.solve(data))
+        elif self.path == '/feedback':
+            angles = data.get('angles', [])
+            try:
+                if not isinstance(angles, list):
+                    raise TypeError('angles must be a list')
+                angles = [int(angle) for angle in angles]
+            except (TypeError, ValueError) as e:
+                self._send_json({'error': f"invalid angles: {e}"}, 400)
+                return
+            ICR.angle_histogram.record(angles)
+            self._send_json({'status': 'ok'})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址，默认只允许本机访问')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--jobs', type=int, default=1, help='求解进程数，1表示在服务进程内依次求解')
+    parser.add_argument('--max-batch', type=int, default=16, help='每批最多合并的请求数')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    service = SolverService(args.jobs, args.max_batch)
+    service.warm_up()
+    RequestHandler.service = service
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    logger.info(f"ICR 识别服务已启动: http://{args.host}:{args.port} (进程数 {args.jobs})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import json
 import hashlib
 import re
 import subprocess
+from collections import deque
 from datetime import datetime, timedelta
 
 selenium_modules = None
@@ -380,12 +381,14 @@ def load_cookies(driver, account_id):
         logger.warning(f"加载 Cookie 失败: {e}")
         return False
 
+# 最近几次未通过的验证码从提交到刷新所花的秒数，用于估计低分时直接刷新节省的时间
+captcha_submit_seconds = deque(maxlen=20)
+
 def process_captcha(driver, wait):
     from selenium.webdriver.common.by import By
     from selenium.webdriver.support import expected_conditions as EC
     from selenium.webdriver.support.wait import WebDriverWait
     from selenium.common.exceptions import TimeoutException
-    import ICR
     
     try:
         wait.until(EC.presence_of_element_located((By.ID, "slideBg")))
@@ -393,12 +396,22 @@ def process_captcha(driver, wait):
         logger.info("未检测到可处理验证码内容，跳过验证码处理")
         return
 
-    download_captcha_img(driver, wait)
+    fetch_captcha, fetch_sprite = captcha_image_sources(driver, wait)
+    solution, captcha_bytes, sprite_bytes = solve_captcha(fetch_captcha, fetch_sprite)
+    positions = solution['positions'] if solution else []
     
-    positions = ICR.find_part_positions("temp/captcha.jpg", "temp/sprite.jpg", 'template')
+    min_score = float(os.getenv("CAPTCHA_MIN_SCORE", "0"))
+    score = solution.get('score') if solution else None
+    fast_fail = bool(positions) and score is not None and score < min_score
     
-    if positions:
+    if fast_fail:
+        saved = sum(captcha_submit_seconds) / len(captcha_submit_seconds) if captcha_submit_seconds else 10
+        logger.warning(f"识别得分 {score:.3f} 低于阈值 {min_score}，跳过提交直接刷新验证码（预计节省 {saved:.1f} 秒）")
+        record_captcha(captcha_bytes, sprite_bytes, solution, None)
+    elif positions:
         logger.info(f"识别到 {len(positions)} 个图案位置")
+        submit_start = time.perf_counter()
+        raw_w, raw_h = solution['size']
         
         for i, (x, y) in enumerate(positions):
             logger.info(f"图案 {i + 1} 位于 ({int(x)}, {int(y)})")
@@ -409,10 +422,6 @@ def process_captcha(driver, wait):
             bg_width = float(re.search(r'width:\s*([\d.]+)px', style).group(1))
             bg_height = float(re.search(r'height:\s*([\d.]+)px', style).group(1))
             
-            import cv2
-            captcha = cv2.imread("temp/captcha.jpg")
-            raw_w, raw_h = captcha.shape[1], captcha.shape[0]
-            
             final_x = int(x / raw_w * bg_width - bg_width / 2)
             final_y = int(y / raw_h * bg_height - bg_height / 2)
             
@@ -426,49 +435,169 @@ def process_captcha(driver, wait):
         result = wait.until(EC.visibility_of_element_located((By.XPATH, '//*[@id="tcOperation"]')))
         if result.get_attribute("class") == 'tc-opera pointer show-success':
             logger.info("验证码通过")
+            report_captcha_success(solution)
+            record_captcha(captcha_bytes, sprite_bytes, solution, True)
             return
         else:
-            logger.error("验证码未通过，正在重试")
+            logger.error(f"验证码未通过，正在重试（识别得分 {score}）")
+            record_captcha(captcha_bytes, sprite_bytes, solution, False)
+            # 失败的提交从点击到刷新前的等待结束所花的时间，即低分时直接刷新可以节省的时间
+            captcha_submit_seconds.append(time.perf_counter() - submit_start + 5)
     else:
         logger.error("验证码识别失败，正在重试")
+        if captcha_bytes and sprite_bytes:
+            record_captcha(captcha_bytes, sprite_bytes, solution, None)
     
     reload = driver.find_element(By.XPATH, '//*[@id="reload"]')
-    time.sleep(5)
+    if not fast_fail:
+        time.sleep(5)
     reload.click()
     time.sleep(5)
     process_captcha(driver, wait)
 
-def download_captcha_img(driver, wait):
+def captcha_image_sources(driver, wait):
+    """从页面读取两张验证码图片的地址，返回分别下载背景图和sprite图的两个函数（可在其他线程中调用）"""
     from selenium.webdriver.common.by import By
     from selenium.webdriver.support import expected_conditions as EC
     from selenium.webdriver.support.wait import WebDriverWait
     
-    if os.path.exists("temp"):
+    save_to_disk = captcha_save_enabled()
+    if save_to_disk and os.path.exists("temp"):
         for filename in os.listdir("temp"):
             file_path = os.path.join("temp", filename)
             if os.path.isfile(file_path) or os.path.islink(file_path):
                 os.remove(file_path)
     
+    # WebDriver 不是线程安全的，页面元素在这里全部读取完，下载函数只访问网络
     try:
         current_ua = driver.execute_script("return navigator.userAgent;")
     except Exception:
         current_ua = None
     
     slideBg = wait.until(EC.visibility_of_element_located((By.XPATH, '//*[@id="slideBg"]')))
-    img1_style = slideBg.get_attribute("style")
-    img1_url = get_url_from_style(img1_style)
-    logger.info("开始下载验证码图片(1): " + img1_url)
-    download_image(img1_url, "captcha.jpg", user_agent=current_ua)
-    
+    img1_url = get_url_from_style(slideBg.get_attribute("style"))
     sprite = wait.until(EC.visibility_of_element_located((By.XPATH, '//*[@id="instruction"]/div/img')))
     img2_url = sprite.get_attribute("src")
-    logger.info("开始下载验证码图片(2): " + img2_url)
-    download_image(img2_url, "sprite.jpg", user_agent=current_ua)
+    
+    def fetch_captcha():
+        logger.info("开始下载验证码图片(1): " + img1_url)
+        return download_image(img1_url, "captcha.jpg" if save_to_disk else None, user_agent=current_ua)
+    
+    def fetch_sprite():
+        logger.info("开始下载验证码图片(2): " + img2_url)
+        return download_image(img2_url, "sprite.jpg" if save_to_disk else None, user_agent=current_ua)
+    
+    return fetch_captcha, fetch_sprite
 
-def download_image(url, filename, user_agent=None):
-    import requests
+def solve_captcha(fetch_captcha, fetch_sprite):
+    """
+    下载并识别验证码，返回 (识别结果, 背景图字节, sprite图字节)，识别失败时识别结果为None
     
-    os.makedirs("temp", exist_ok=True)
+    设置 ICR_SERVER 时两张图并行下载后交给本地识别服务；未设置或服务不可用时在当前进程内以流水线方式识别：
+    背景图下载完成后立即开始预处理，sprite 图同时在另一个线程中下载并做旋转分析
+    """
+    server = icr_server_url()
+    if server:
+        import requests
+        import base64
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(1) as pool:
+            sprite_future = pool.submit(fetch_sprite)
+            captcha_bytes = fetch_captcha()
+            sprite_bytes = sprite_future.result()
+        if not captcha_bytes or not sprite_bytes:
+            return None, captcha_bytes, sprite_bytes
+        
+        payload = {
+            'captcha': base64.b64encode(captcha_bytes).decode('ascii'),
+            'sprite': base64.b64encode(sprite_bytes).decode('ascii'),
+            'method': 'template'
+        }
+        try:
+            response = requests.post(f"{server}/solve", json=payload,
+                                     timeout=float(os.getenv("ICR_SERVER_TIMEOUT", "30")))
+            response.raise_for_status()
+            result = response.json()
+            if 'error' not in result:
+                result['remote'] = True
+                result['method'] = payload['method']
+                logger.info(f"验证码识别服务耗时 {result['service_ms']:.1f}ms")
+                return result, captcha_bytes, sprite_bytes
+            logger.warning(f"验证码识别服务返回错误: {result['error']}，改为本地识别")
+        except Exception as e:
+            logger.warning(f"验证码识别服务不可用: {e}，改为本地识别")
+        fetch_captcha, fetch_sprite = (lambda: captcha_bytes), (lambda: sprite_bytes)
+    
+    import ICR
+    images = {}
+    
+    def source(name, fetch):
+        # 保留原始字节供语料库使用，解码后的背景图尺寸用于换算点击坐标
+        def load():
+            images[name] = fetch()
+            img = decode_image(images[name])
+            if img is None:
+                raise ValueError(f"{name} 图片下载或解码失败")
+            images[name + '_shape'] = img.shape
+            return img
+        return load
+    
+    stats = ICR.SolveStats()
+    try:
+        matches = ICR.main_pipelined(source('captcha', fetch_captcha), source('sprite', fetch_sprite), 'template',
+                                     stats=stats)
+    except Exception as e:
+        logger.error(f"验证码识别异常: {e}")
+        return None, images.get('captcha'), images.get('sprite')
+    logger.info(f"验证码识别统计: {stats.summary()}")
+    height, width = images['captcha_shape'][:2]
+    solution = {'positions': ICR.convert_matches_to_positions(matches), 'size': [width, height],
+                'angles': stats.angles, 'margins': stats.margins, 'score': stats.score, 'method': 'template',
+                'stats': stats.as_dict(), 'remote': False}
+    return solution, images['captcha'], images['sprite']
+
+def report_captcha_success(solution):
+    """验证码通过后记录匹配角度，供提前退出模式调整角度评估顺序"""
+    if solution.get('remote'):
+        import requests
+        try:
+            requests.post(f"{icr_server_url()}/feedback", json={'angles': solution['angles']}, timeout=5)
+        except Exception as e:
+            logger.warning(f"上报识别结果失败: {e}")
+    else:
+        import ICR
+        ICR.angle_histogram.record(solution['angles'])
+
+def record_captcha(captcha_bytes, sprite_bytes, solution, passed):
+    """设置了 CAPTCHA_CORPUS 时把本次验证码及判定结果保存到回放语料库"""
+    import captcha_corpus
+    
+    directory = captcha_corpus.corpus_dir()
+    if directory is None:
+        return
+    try:
+        captcha_corpus.record(directory, captcha_bytes, sprite_bytes, solution, passed)
+    except Exception as e:
+        logger.warning(f"保存验证码语料失败: {e}")
+
+def icr_server_url():
+    return os.getenv("ICR_SERVER", "").strip().rstrip('/') or None
+
+def captcha_save_enabled():
+    return os.getenv("CAPTCHA_SAVE", "false").lower() == "true"
+
+def decode_image(data):
+    if not data:
+        return None
+    import ICR
+    img = ICR.load_image(data)
+    if img is None:
+        logger.error("验证码图片解码失败")
+    return img
+
+def download_image(url, filename=None, user_agent=None):
+    import requests
     
     headers = {}
     if user_agent:
@@ -477,16 +606,18 @@ def download_image(url, filename, user_agent=None):
     try:
         response = requests.get(url, headers=headers, timeout=10)
         if response.status_code == 200:
-            path = os.path.join("temp", filename)
-            with open(path, "wb") as f:
-                f.write(response.content)
-            return True
+            if filename:
+                os.makedirs("temp", exist_ok=True)
+                path = os.path.join("temp", filename)
+                with open(path, "wb") as f:
+                    f.write(response.content)
+            return response.content
         else:
             logger.error(f"下载图片失败！状态码: {response.status_code}")
-            return False
+            return None
     except Exception as e:
         logger.error(f"下载图片异常: {e}")
-        return False
+        return None
 
 def get_url_from_style(style):
     import re
@@ -0,0 +1,333 @@
+"""
+加速实现与保留的参考实现的一致性测试
+
+输入均来自 benchmarks/synthetic.py 生成的合成验证码，经 ICR.prepare_background / ICR.prepare_sprite
+得到与 ICR.main 相同的背景掩码、背景区域和sprite旋转结果。
+
+运行:
+    python -m pytest tests
+"""
+import functools
+import itertools
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import ICR  # noqa: E402
+import synthetic  # noqa: E402
+
+SEEDS = range(4)
+
+
+@functools.lru_cache(maxsize=None)
+def captcha(seed):
+    """返回 (背景掩码, 背景区域, 旋转分析数据, sprite掩码)"""
+    bg, sprite, _ = synthetic.generate(seed, 3 + seed % 2)
+    params = ICR.load_profile('default')
+    _, bg_mask, bg_regions = ICR.prepare_background(bg, params)
+    _, sprite_mask, _, rotation_data = ICR.prepare_sprite(sprite, params, use_cache=False)
+    return bg_mask, bg_regions, rotation_data, sprite_mask
+
+
+def template_pairs(seed, margin=0, angle_step=5):
+    """
+    (旋转后的sprite ROI, 背景ROI, 背景矩形) 组合，每隔 angle_step 个角度取一个
+
+    背景区域向四周扩大 margin 个像素(不超出图像)，使滑动窗口数量足以走到批量计算的分支
+    """
+    bg_mask, bg_regions, rotation_data, _ = captcha(seed)
+    height, width = bg_mask.shape
+    for data in rotation_data:
+        rotations = data['rotations']
+        for rot_idx in range(0, len(rotations), angle_step):
+            for x, y, w, h in bg_regions:
+                bg_x, bg_y = max(0, x - margin), max(0, y - margin)
+                bg_w, bg_h = min(width, x + w + margin) - bg_x, min(height, y + h + margin) - bg_y
+                rotated_roi = ICR.crop_rotated_roi(rotations, rot_idx, bg_w, bg_h)
+                yield rotated_roi, bg_mask[bg_y:bg_y + bg_h, bg_x:bg_x + bg_w], (bg_x, bg_y, bg_w, bg_h)
+
+
+@pytest.mark.parametrize('einsum_limit', [ICR.VECTORIZED_EINSUM_LIMIT, 0])
+@pytest.mark.parametrize('margin', [0, 12])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_vectorized_search_matches_brute_search(seed, margin, einsum_limit, monkeypatch):
+    # brute_search 固定走逐窗口调用 binary_similarity 的原始循环；einsum_limit 为0时所有搜索都走 matchTemplate 分支
+    monkeypatch.setattr(ICR, 'BRUTE_PACKED_MIN_WINDOWS', float('inf'))
+    monkeypatch.setattr(ICR, 'VECTORIZED_EINSUM_LIMIT', einsum_limit)
+    for rotated_roi, bg_roi, bg_rect in template_pairs(seed, margin):
+        h_r, w_r = rotated_roi.shape
+        assert (ICR.vectorized_search(rotated_roi, bg_roi, bg_rect, w_r, h_r)
+                == ICR.brute_search(rotated_roi, bg_roi, bg_rect, w_r, h_r))
+
+
+@functools.lru_cache(maxsize=None)
+def noisy_rectangles(seed, threshold):
+    """以较高阈值二值化合成背景，纹理噪声会产生大量小区域，足以走到网格索引合并的分支"""
+    bg, _, _ = synthetic.generate(seed, 3 + seed % 2)
+    mask = ICR.load_and_preprocess(bg, threshold)
+    rectangles = ICR.extract_black_regions(mask, min_area=0, merged=False)
+    assert len(rectangles) > ICR.PAIRWISE_MERGE_LIMIT
+    return rectangles
+
+
+@pytest.mark.parametrize('threshold', [100, 120])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_merge_rectangles_matches_pairwise(seed, threshold):
+    rectangles = noisy_rectangles(seed, threshold)
+    assert ICR.merge_rectangles(rectangles) == ICR.merge_rectangles_pairwise(rectangles)
+
+
+@pytest.mark.parametrize('max_distance', [1, 5, 12])
+@pytest.mark.parametrize('threshold', [100, 120])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_merge_close_rectangles_matches_pairwise(seed, threshold, max_distance):
+    rectangles = noisy_rectangles(seed, threshold)
+    assert (ICR.merge_close_rectangles(rectangles, max_distance)
+            == ICR.merge_close_rectangles_pairwise(rectangles, max_distance))
+
+
+@functools.lru_cache(maxsize=None)
+def region_masks(seed):
+    """ICR 实际使用的背景、sprite掩码，以及纹理噪声产生大量区域的背景二值图"""
+    bg, _, _ = synthetic.generate(seed, 3 + seed % 2)
+    bg_mask, _, _, sprite_mask = captcha(seed)
+    return bg_mask, sprite_mask, ICR.load_and_preprocess(bg, 100), ICR.load_and_preprocess(bg, 150)
+
+
+@pytest.mark.parametrize('options', [
+    {'min_area': 0, 'merged': False},
+    {'min_area': 50, 'merge_distance': 5},
+    {'min_area': 100, 'sort_mode': 'position-tl'},
+    {'min_area': 10, 'merged': False, 'merge_distance': 3, 'sort_mode': 'position-l'},
+])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_component_regions_match_contours(seed, options):
+    for mask in region_masks(seed):
+        contour_counts, component_counts = {}, {}
+        assert (ICR.extract_black_regions(mask, backend='components', counts=component_counts, **options)
+                == ICR.extract_black_regions(mask, backend='contours', counts=contour_counts, **options))
+        assert component_counts == contour_counts
+
+
+@pytest.mark.parametrize('margin', [0, 12])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_packed_brute_search_matches_loop(seed, margin, monkeypatch):
+    for rotated_roi, bg_roi, bg_rect in template_pairs(seed, margin):
+        h_r, w_r = rotated_roi.shape
+        monkeypatch.setattr(ICR, 'BRUTE_PACKED_MIN_WINDOWS', float('inf'))
+        expected = ICR.brute_search(rotated_roi, bg_roi, bg_rect, w_r, h_r)
+        monkeypatch.setattr(ICR, 'BRUTE_PACKED_MIN_WINDOWS', 0)
+        assert ICR.brute_search(rotated_roi, bg_roi, bg_rect, w_r, h_r) == expected
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_packed_batch_similarity_matches_binary_similarity(seed):
+    bg_mask, bg_regions, rotation_data, _ = captcha(seed)
+    for data in rotation_data:
+        rotations = data['rotations']
+        for x, y, w, h in bg_regions:
+            bg_roi = bg_mask[y:y + h, x:x + w]
+            # 模板宽度覆盖不足一个字和跨越多个字的情况
+            for width in (w, 70, 130):
+                bg_resized = cv2.resize(bg_roi, (width, h), interpolation=cv2.INTER_NEAREST)
+                sprites = [cv2.resize(rotations.image(rot_idx), (width, h), interpolation=cv2.INTER_NEAREST)
+                           for rot_idx in range(len(rotations))]
+                assert (ICR.packed_batch_similarity(sprites, bg_resized).tolist()
+                        == [ICR.binary_similarity(sprite, bg_resized) for sprite in sprites])
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_direct_batch_similarity_matches_match_rotation(seed):
+    bg_mask, bg_regions, rotation_data, _ = captcha(seed)
+    for data in rotation_data:
+        rotations = data['rotations']
+        for bg_rect in bg_regions:
+            x, y, w, h = bg_rect
+            expected = [ICR.match_rotation(rotations, rot_idx, bg_rect, bg_mask, None)[1]
+                        for rot_idx in range(len(rotations))]
+            assert ICR.direct_batch_similarity(rotations, bg_mask[y:y + h, x:x + w]) == expected
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_rotation_engine_matches_opencv_rotate(seed):
+    _, _, rotation_data, sprite_mask = captcha(seed)
+    _, sprite, _ = synthetic.generate(seed, 3 + seed % 2)
+    # 与sprite掩码同尺寸的灰度图
+    gray = cv2.resize(cv2.cvtColor(sprite, cv2.COLOR_BGR2GRAY), sprite_mask.shape[::-1])
+    engine = ICR.RotationEngine()
+    for data in rotation_data:
+        x, y, w, h = data['original_region']
+        # 二值掩码以及带灰度过渡的原图区域，后者能暴露插值系数的差异
+        for region_roi in (sprite_mask[y:y + h, x:x + w], gray[y:y + h, x:x + w]):
+            for angle in range(-45, 46):
+                expected = ICR.opencv_rotate(region_roi, -angle)
+                # 第一次只记录键并直接调用 opencv_rotate，第二次才使用映射表
+                assert np.array_equal(engine.rotate(region_roi, -angle), expected)
+                assert np.array_equal(engine.rotate(region_roi, -angle), expected)
+    assert engine.misses > 0
+
+
+def test_rotation_engine_respects_byte_limit():
+    engine = ICR.RotationEngine(max_bytes=256 * 1024)
+    for size in (30, 50, 80):
+        region = np.zeros((size, size), dtype=np.uint8)
+        for angle in range(-45, 46):
+            engine.maps_for(region.shape, angle)
+            stats = engine.stats()
+            assert stats['bytes'] <= engine.max_bytes
+            assert stats['bytes'] == sum(map1.nbytes + map2.nbytes for map1, map2, _ in engine._maps.values())
+    assert 0 < engine.stats()['entries'] < 91
+    # 单个映射表超过上限时不缓存，但仍然返回
+    tiny = ICR.RotationEngine(max_bytes=1024)
+    assert tiny.maps_for((80, 80), 30) is not None and tiny.stats()['entries'] == 0
+
+
+def best_permutation_total(scores):
+    """穷举所有互不相同的行列分配，返回得分总和的最大值"""
+    n, m = scores.shape
+    if n <= m:
+        return max(sum(scores[i, j] for i, j in enumerate(cols)) for cols in itertools.permutations(range(m), n))
+    return best_permutation_total(scores.T)
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (3, 3), (3, 5), (5, 3), (4, 6)])
+@pytest.mark.parametrize('seed', range(20))
+def test_linear_assignment_matches_exhaustive_search(seed, shape):
+    # 取值范围很小的整数代价，覆盖大量相同得分的情况
+    cost = np.random.default_rng(seed).integers(0, 5, shape).astype(np.float64)
+    rows, cols = ICR.linear_assignment(cost)
+    assert len(rows) == min(shape) and len(set(rows.tolist())) == len(set(cols.tolist())) == min(shape)
+    assert cost[rows, cols].sum() == -best_permutation_total(-cost)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_optimal_assignment_against_greedy(seed):
+    bg_mask, bg_regions, rotation_data, _ = captcha(seed)
+    search_options = {'coarse_step': 6, 'coarse_top_k': 3, 'pyramid_levels': 2, 'pyramid_top_k': 5,
+                      'early_exit': None, 'angle_order': None}
+    all_matches = []
+    for sprite_idx, sprite_data in enumerate(rotation_data):
+        all_matches.extend(ICR.collect_sprite_matches(sprite_idx, sprite_data, range(len(bg_regions)), bg_regions,
+                                                      bg_mask, 'template', search_options))
+
+    greedy = ICR.assign_matches(list(all_matches), len(rotation_data), len(bg_regions), True, 'greedy')
+    optimal = ICR.assign_matches(list(all_matches), len(rotation_data), len(bg_regions), True, 'optimal')
+
+    scores = np.full((len(rotation_data), len(bg_regions)), -np.inf)
+    for match in all_matches:
+        scores[match.sprite_idx, match.bg_idx] = max(scores[match.sprite_idx, match.bg_idx], match.similarity)
+
+    assert [match.sprite_idx for match in optimal] == list(range(len(rotation_data)))
+    assert len({match.bg_idx for match in optimal}) == len(optimal)
+    total = sum(match.similarity for match in optimal)
+    assert total == pytest.approx(best_permutation_total(scores))
+    assert total >= sum(match.similarity for match in greedy) - 1e-9
+    # 贪心选择没有冲突时（每个sprite都取到各自的最高分），两种方式结果相同
+    if [match.bg_idx for match in greedy] == scores.argmax(axis=1).tolist():
+        assert [(match.bg_idx, match.rot_idx) for match in optimal] == [(match.bg_idx, match.rot_idx)
+                                                                         for match in greedy]
+
+
+@pytest.mark.parametrize('shape', [(3, 3), (4, 3), (3, 5)])
+@pytest.mark.parametrize('seed', range(20))
+def test_optimal_assignment_with_conflicts(seed, shape):
+    # 合成验证码上贪心选择很少冲突，这里用随机得分构造冲突，背景区域也可能比sprite少
+    rotations = captcha(0)[2][0]['rotations']
+    scores = np.random.default_rng(seed).integers(0, 100, shape).astype(np.float64)
+    all_matches = [ICR.Match(sprite_idx, bg_idx, rotations, 0, scores[sprite_idx, bg_idx], None, None)
+                   for sprite_idx in range(shape[0]) for bg_idx in range(shape[1])]
+
+    greedy = ICR.assign_matches(list(all_matches), *shape, True, 'greedy')
+    optimal = ICR.assign_matches(list(all_matches), *shape, True, 'optimal')
+
+    assert [match.sprite_idx for match in optimal] == list(range(shape[0]))
+    assert [match.sprite_idx for match in greedy] == list(range(shape[0]))
+    assert len({match.bg_idx for match in optimal}) == min(shape)
+    if shape[0] <= shape[1]:
+        total = sum(match.similarity for match in optimal)
+        assert total == best_permutation_total(scores)
+        assert total >= sum(match.similarity for match in greedy)
+    else:
+        # 分不到不同区域的sprite使用各自得分最高的区域
+        shared = [match for match in optimal if sum(other.bg_idx == match.bg_idx for other in optimal) > 1]
+        assert any(match.similarity == scores[match.sprite_idx].max() for match in shared)
+
+
+@pytest.mark.parametrize('margin', [0, 12])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_fft_batch_search_matches_template_search(seed, margin):
+    for rotated_roi, bg_roi, bg_rect in template_pairs(seed, margin):
+        h_r, w_r = rotated_roi.shape
+        (fft_rect, fft_similarity), = ICR.fft_batch_search([rotated_roi], ICR.prepare_fft_background(bg_roi), bg_rect)
+        _, similarity = ICR.template_search(rotated_roi, bg_roi, bg_rect, w_r, h_r)
+        # matchTemplate 使用单精度计算，只比较到千分之一个百分点；得分几乎相同的位置可能取到不同的一个，
+        # 因此检查 FFT 选中的位置在 matchTemplate 中也是最高分
+        assert fft_similarity == pytest.approx(similarity, abs=1e-3)
+        scores = cv2.matchTemplate(bg_roi, rotated_roi, cv2.TM_CCOEFF_NORMED)
+        assert scores[fft_rect[1] - bg_rect[1], fft_rect[0] - bg_rect[0]] * 100 == pytest.approx(similarity, abs=1e-3)
+
+
+@pytest.mark.parametrize('coarse_step', [6, 15, 23])
+def test_coarse_to_fine_reaches_every_angle(coarse_step):
+    # 每个角度一个不同尺寸的条目，避免去重合并
+    angles = list(range(-45, 46))
+    rotations = ICR.RotationSet.from_images(angles, [np.zeros((1, i + 1), np.uint8) for i in range(len(angles))],
+                                            [1.0] * len(angles))
+    for target in angles:
+        # 只有一个峰的得分
+        evaluated = {}
+
+        def evaluate(bg_idx, rot_idx):
+            evaluated[rot_idx] = -abs(int(rotations.angles[rot_idx]) - target)
+            return evaluated[rot_idx]
+
+        ICR.coarse_to_fine_rotations(rotations, [0], evaluate, coarse_step, top_k=1)
+        assert int(rotations.angles[max(evaluated, key=evaluated.get)]) == target
+
+
+def test_solve_image_batch_matches_solve_images():
+    # 同一批中包含相同的sprite、完全相同的请求和无法解码的图片
+    encoded = [[cv2.imencode('.png', image)[1].tobytes() for image in synthetic.generate(seed, 3)[:2]]
+               for seed in range(3)]
+    pairs = encoded + [encoded[0], (encoded[1][0], encoded[0][1]), (b'broken', encoded[0][1])]
+    tasks = [(bg, sprite, 'template', False, {}) for bg, sprite in pairs]
+    for task, result in zip(tasks, ICR.solve_image_batch(tasks)):
+        expected = ICR.solve_images(*task[:4])
+        assert ('error' in result) == ('error' in expected)
+        assert result.get('positions') == expected.get('positions')
+        assert result.get('angles') == expected.get('angles')
+
+
+@pytest.mark.parametrize('assignment', ['greedy', 'optimal'])
+@pytest.mark.parametrize('seed, icons', [(1, 4), (2, 5)])
+def test_prefilter_still_matches_every_sprite(seed, icons, assignment):
+    # 直接比较模式要求背景区域互不相同，预筛选后多个sprite只剩同一个区域时也要每个sprite都有结果
+    bg, sprite, _ = synthetic.generate(seed, icons)
+    params = ICR.load_profile('default')
+    _, bg_mask, bg_regions = ICR.prepare_background(bg, params)
+    rotation_data = ICR.prepare_sprite(sprite, params, use_cache=False)[3]
+    matches = ICR.match_sprite_to_background(bg_regions, bg_mask, rotation_data, None, prefilter_keep=1,
+                                             assignment=assignment)
+    assert [match.sprite_idx for match in matches] == list(range(len(rotation_data)))
+
+
+def test_rotation_cache_stats_per_solve(monkeypatch):
+    # 每次求解都记录自己的缓存命中、未命中和节省的时间，而不只是全局计数
+    monkeypatch.setattr(ICR, 'rotation_cache', ICR.RotationCache())
+    bg, sprite, _ = synthetic.generate(0, 3)
+    bg, sprite = (cv2.imencode('.png', image)[1].tobytes() for image in (bg, sprite))
+    first, second = ICR.SolveStats(), ICR.SolveStats()
+    ICR.main(bg, sprite, 'template', stats=first)
+    ICR.main(bg, sprite, 'template', stats=second)
+    regions = first.counts['cache_misses']
+    assert regions > 0 and 'cache_hits' not in first.counts
+    assert second.counts['cache_hits'] == regions and 'cache_misses' not in second.counts
+    assert second.timings['cache_saved'] > 0 and 'cache_saved' not in first.timings
+    assert f"旋转缓存命中 {regions}/{regions}" in second.summary()